@@ -62,6 +62,81 @@ class SonicsHydroviewer(TethysAppBase):
                 url='get-forecast-data-csv',
                 controller='sonics_hydroviewer.controllers.get_forecast_data_csv'
             ),
+            UrlMap(
+                name='get_batch_time_series',
+                url='get-batch-time-series',
+                controller='sonics_hydroviewer.controllers.get_batch_time_series'
+            ),
+            UrlMap(
+                name='get_hydrograph_data',
+                url='get-hydrograph-data',
+                controller='sonics_hydroviewer.controllers.get_hydrograph_data'
+            ),
+            UrlMap(
+                name='get_time_series_data',
+                url='get-time-series-data',
+                controller='sonics_hydroviewer.controllers.get_time_series_data'
+            ),
+            UrlMap(
+                name='get_region_export',
+                url='get-region-export',
+                controller='sonics_hydroviewer.controllers.get_region_export'
+            ),
+            UrlMap(
+                name='get_flood_exceedance',
+                url='get-flood-exceedance',
+                controller='sonics_hydroviewer.controllers.get_flood_exceedance'
+            ),
+            UrlMap(
+                name='get_forecast_skill',
+                url='get-forecast-skill',
+                controller='sonics_hydroviewer.controllers.get_forecast_skill'
+            ),
+            UrlMap(
+                name='get_hydrographs_async',
+                url='get-hydrographs-async',
+                controller='sonics_hydroviewer.controllers.get_hydrographs_async'
+            ),
+            UrlMap(
+                name='get_time_series_async',
+                url='get-time-series-async',
+                controller='sonics_hydroviewer.controllers.get_time_series_async'
+            ),
+            UrlMap(
+                name='get_hydrograph_data_async',
+                url='get-hydrograph-data-async',
+                controller='sonics_hydroviewer.controllers.get_hydrograph_data_async'
+            ),
+            UrlMap(
+                name='get_time_series_data_async',
+                url='get-time-series-data-async',
+                controller='sonics_hydroviewer.controllers.get_time_series_data_async'
+            ),
+            UrlMap(
+                name='get_reach_at',
+                url='get-reach-at',
+                controller='sonics_hydroviewer.controllers.get_reach_at'
+            ),
+            UrlMap(
+                name='get_metrics',
+                url='metrics',
+                controller='sonics_hydroviewer.controllers.get_metrics'
+            ),
+            UrlMap(
+                name='get_region_summary',
+                url='get-region-summary',
+                controller='sonics_hydroviewer.controllers.get_region_summary'
+            ),
+            UrlMap(
+                name='get_region_bounds',
+                url='get-region-bounds',
+                controller='sonics_hydroviewer.controllers.get_region_bounds'
+            ),
+            UrlMap(
+                name='get_region_boundary',
+                url='get-region-boundary',
+                controller='sonics_hydroviewer.controllers.get_region_boundary'
+            ),
         )
 
         return url_maps
@@ -75,4 +150,92 @@ class SonicsHydroviewer(TethysAppBase):
                 required=True,
                 default='/home/tethys/sonics',
             ),
-        )
\ No newline at end of file
+            CustomSetting(
+                name='drainage_lines',
+                type=CustomSetting.TYPE_STRING,
+                description="Local drainage lines file (GeoJSON or any format geopandas reads) used to find the clicked reach",
+                required=False,
+            ),
+            CustomSetting(
+                name='max_batch_comids',
+                type=CustomSetting.TYPE_INTEGER,
+                description="Maximum number of comids in one get-batch-time-series request",
+                required=False,
+                default=500,
+            ),
+            CustomSetting(
+                name='response_cache',
+                type=CustomSetting.TYPE_STRING,
+                description="Response cache backend for the chart and CSV endpoints: memory, file or none",
+                required=False,
+                default='memory',
+            ),
+            CustomSetting(
+                name='response_cache_size',
+                type=CustomSetting.TYPE_INTEGER,
+                description="Maximum number of responses kept in the response cache",
+                required=False,
+                default=256,
+            ),
+            CustomSetting(
+                name='response_cache_mb',
+                type=CustomSetting.TYPE_FLOAT,
+                description="Maximum megabytes of response content kept in the response cache",
+                required=False,
+                default=256.0,
+            ),
+            CustomSetting(
+                name='hydrograph_points',
+                type=CustomSetting.TYPE_INTEGER,
+                description="Point budget of the downsampled historical simulation charts",
+                required=False,
+                default=2000,
+            ),
+            CustomSetting(
+                name='max_blocking_workers',
+                type=CustomSetting.TYPE_INTEGER,
+                description="Maximum number of NetCDF reads and return period fits the async views run at once",
+                required=False,
+                default=8,
+            ),
+            CustomSetting(
+                name='coalesce_timeout',
+                type=CustomSetting.TYPE_FLOAT,
+                description="Seconds a request waits for an identical request in flight before computing its own response",
+                required=False,
+                default=30.0,
+            ),
+            CustomSetting(
+                name='profile_sample_rate',
+                type=CustomSetting.TYPE_FLOAT,
+                description="Share of the requests profiled with cProfile, saved to the profiles folder of the app workspace",
+                required=False,
+                default=0.0,
+            ),
+        )
+
+    @classmethod
+    def warm_up(cls):
+        """
+        Preloads the region index, the drainage line index, the latest forecast file and its comid coordinate and maps
+        its shared arrays, and builds the region membership and boundaries when ingest has not, so the first request
+        served by a worker does not pay for them.
+        """
+        from .regions import load_region_index, build_region_membership
+        from .catalog import get_catalog
+        from .datasets import open_forecast, comid_positions
+        from .store import open_reach_store
+        from .reaches import load_reach_index
+        from .shared import open_shared_forecast
+        from .boundaries import update_region_boundaries
+
+        load_region_index()
+        update_region_boundaries(cls.get_app_workspace().path)
+        drainage_lines = cls.get_custom_setting('drainage_lines')
+        if drainage_lines:
+            load_reach_index(drainage_lines)
+        nc_file = get_catalog(cls.get_custom_setting('folder')).latest()
+        comid_positions(open_forecast(nc_file))
+        comid_positions(open_reach_store(nc_file, cls.get_app_workspace().path))
+        open_shared_forecast(nc_file, cls.get_app_workspace().path)
+        build_region_membership(nc_file, cls.get_app_workspace().path)
@@ -0,0 +1,311 @@
+"""
+Compaction of the SONICS forecast archive. Every legacy PISCO_HyD_ARNOVIC_v1.0_YYYYMMDD.nc repeats the whole qr
+historical simulation next to a few days of qr_eta and qr_gfs, so the archive grows quadratically. Compaction appends
+the new days of qr to one history store in the forecast folder and rewrites each daily file without qr, recording
+the store and which of its time steps belong to the file. open_archived reads both layouts as the legacy one.
+
+Usage:
+    python -m tethysapp.sonics_hydroviewer.archive <forecast_folder> [--no-verify]
+"""
+import os
+import sys
+import shutil
+import argparse
+
+import numpy as np
+
+# history store in the forecast folder, its name does not match the forecast file pattern of the catalog
+HISTORY_FILE = 'PISCO_HyD_ARNOVIC_v1.0_history.nc'
+
+# global attributes of a compacted daily file
+HISTORY_ATTR = 'history_store'
+HISTORY_START_ATTR = 'history_start'
+HISTORY_TIMES_ATTR = 'history_times'
+HISTORY_ATTRS = (HISTORY_ATTR, HISTORY_START_ATTR, HISTORY_TIMES_ATTR)
+
+# chunks of the history qr, small enough in comids for reach reads and in time for daily appends
+TIME_CHUNK = 2048
+COMID_CHUNK = 16
+
+# comids copied or compared per block
+BLOCK_SIZE = 1024
+
+
+def history_path(folder):
+	return os.path.join(folder, HISTORY_FILE)
+
+
+def open_archived(nc_file):
+	"""
+	Returns an xarray.Dataset of a forecast file in either layout. For a compacted file, qr and its time coordinate
+	are the history_times steps of the history store from history_start, so the dataset matches the legacy file, the store path
+	being kept in its encoding instead of its attributes. Closing it closes both files.
+	"""
+	import xarray as xr
+
+	dataset = xr.open_dataset(nc_file)
+	name = dataset.attrs.get(HISTORY_ATTR)
+	if name is None or 'qr' in dataset.variables:
+		return dataset
+
+	path = os.path.join(os.path.dirname(nc_file), name)
+	history = xr.open_dataset(path)
+	qr = history['qr'].isel(time=history_slice(dataset.attrs))
+	merged = dataset.assign(qr=qr)
+	merged.attrs = {attr: value for attr, value in dataset.attrs.items() if attr not in HISTORY_ATTRS}
+	merged.encoding[HISTORY_ATTR] = path
+
+	def close():
+		dataset.close()
+		history.close()
+
+	merged.set_close(close)
+	return merged
+
+
+def archive_version(nc_file, dataset=None):
+	"""
+	Returns the mtime of nc_file, paired with the mtime of its history store when dataset, opened from nc_file by
+	open_archived, is compacted. Pools compare it to know when a handle must be reopened.
+	"""
+	mtime = os.path.getmtime(nc_file)
+	path = dataset.encoding.get(HISTORY_ATTR) if dataset is not None else None
+	if path is None:
+		return mtime
+	return mtime, os.path.getmtime(path)
+
+
+def history_slice(attrs):
+	"""
+	Returns the slice of the history store time steps that belong to a compacted file with global attributes attrs.
+	"""
+	start = int(attrs.get(HISTORY_START_ATTR, 0))
+	return slice(start, start + int(attrs[HISTORY_TIMES_ATTR]))
+
+
+def open_history_variables(src, nc_file):
+	"""
+	Returns the history store of a compacted netCDF4.Dataset src, opened with netCDF4, and the slice of its time
+	steps that belong to src, or (None, None) for a legacy file.
+	"""
+	import netCDF4 as nc
+
+	if HISTORY_ATTR not in src.ncattrs() or 'qr' in src.variables:
+		return None, None
+	history = nc.Dataset(os.path.join(os.path.dirname(nc_file), src.getncattr(HISTORY_ATTR)))
+	history.set_auto_maskandscale(False)
+	return history, history_slice({attr: src.getncattr(attr) for attr in src.ncattrs()})
+
+
+def compression(variable):
+	"""
+	Returns the createVariable compression arguments that reproduce those of a netCDF4 variable.
+	"""
+	filters = variable.filters() or {}
+	return {'zlib': bool(filters.get('zlib')), 'complevel': filters.get('complevel') or 4,
+			'shuffle': bool(filters.get('shuffle'))}
+
+
+def _create_history(path, src):
+	import netCDF4 as nc
+
+	history = nc.Dataset(path, 'w', format='NETCDF4')
+	history.createDimension('comid', len(src.dimensions['comid']))
+	history.createDimension('time', None)
+	for name in ('comid', 'time'):
+		variable = src.variables[name]
+		out = history.createVariable(name, variable.datatype, variable.dimensions)
+		out.setncatts({attr: variable.getncattr(attr) for attr in variable.ncattrs() if attr != '_FillValue'})
+		if name == 'comid':
+			out[:] = variable[:]
+
+	qr = src.variables['qr']
+	dimensions = ('time', 'comid')
+	chunksizes = (TIME_CHUNK, min(COMID_CHUNK, len(src.dimensions['comid'])))
+	out = history.createVariable('qr', qr.datatype, dimensions, fill_value=getattr(qr, '_FillValue', None),
+								 chunksizes=chunksizes, **compression(qr))
+	out.setncatts({attr: qr.getncattr(attr) for attr in qr.ncattrs() if attr != '_FillValue'})
+	return history
+
+
+def _qr_block(variable, times, comids):
+	# qr as (time, comid) whatever the dimension order of the file
+	index = [times if dim == 'time' else comids for dim in variable.dimensions]
+	block = variable[tuple(index)]
+	return block if variable.dimensions[0] == 'time' else block.T
+
+
+def _append(src, history, verify):
+	"""
+	Appends the days of the qr of src missing from history after checking the comids, the times and, with verify,
+	the flows of the days already stored. The time axis of src must start within the store, keyed by timestamp, so a
+	rolling history window only adds its new days.
+	Returns:
+	  tuple, (why src cannot be compacted or None, position of the first time of src in the store)
+	"""
+	if not np.array_equal(src.variables['comid'][:], history.variables['comid'][:]):
+		return 'different drainage network than the history store', None
+	if src.variables['time'].getncattr('units') != history.variables['time'].getncattr('units'):
+		return 'different time units than the history store', None
+
+	times = src.variables['time'][:]
+	stored_times = history.variables['time'][:]
+	start = int(np.searchsorted(stored_times, times[0])) if stored_times.size else 0
+	if stored_times.size and (start == stored_times.size or stored_times[start] != times[0]):
+		return 'history does not start within the history store', None
+	overlap = min(stored_times.size - start, times.size)
+	if not np.array_equal(times[:overlap], stored_times[start:start + overlap]):
+		return 'time axis does not match the history store', None
+
+	n_comids = len(src.dimensions['comid'])
+	qr, out = src.variables['qr'], history.variables['qr']
+	if verify and overlap:
+		for first in range(0, n_comids, BLOCK_SIZE):
+			comids = slice(first, first + BLOCK_SIZE)
+			if not np.array_equal(_qr_block(qr, slice(0, overlap), comids), out[start:start + overlap, comids],
+								  equal_nan=True):
+				return 'qr differs from the history store', None
+
+	if times.size > overlap:
+		end = stored_times.size + times.size - overlap
+		history.variables['time'][stored_times.size:end] = times[overlap:]
+		for first in range(0, n_comids, BLOCK_SIZE):
+			comids = slice(first, first + BLOCK_SIZE)
+			out[stored_times.size:end, comids] = _qr_block(qr, slice(overlap, times.size), comids)
+	return None, start
+
+
+def _write_compacted(src, out_path, history_name, start):
+	import netCDF4 as nc
+
+	with nc.Dataset(out_path, 'w', format='NETCDF4') as dst:
+		dst.setncatts({attr: src.getncattr(attr) for attr in src.ncattrs()})
+		dst.setncattr(HISTORY_ATTR, history_name)
+		dst.setncattr(HISTORY_START_ATTR, start)
+		dst.setncattr(HISTORY_TIMES_ATTR, len(src.dimensions['time']))
+		for name, dimension in src.dimensions.items():
+			if name != 'time':
+				dst.createDimension(name, None if dimension.isunlimited() else len(dimension))
+
+		for name, variable in src.variables.items():
+			if 'time' in variable.dimensions:
+				continue
+			chunking = variable.chunking()
+			out = dst.createVariable(name, variable.datatype, variable.dimensions,
+									 fill_value=getattr(variable, '_FillValue', None),
+									 chunksizes=None if chunking == 'contiguous' else chunking, **compression(variable))
+			out.setncatts({attr: variable.getncattr(attr) for attr in variable.ncattrs() if attr != '_FillValue'})
+			out[:] = variable[:]
+
+
+def _compact(paths, history, verify):
+	"""
+	Appends the qr of the legacy files of paths to a copy of the history store and writes their compacted versions
+	next to them, then swaps the store and the files in with os.replace. Readers holding the old store keep reading
+	it, and a failure leaves the archive as it was.
+	Returns:
+	  dict, why each file left as it was could not be compacted, by file name
+	"""
+	import netCDF4 as nc
+
+	tmp_history = history + '.tmp'
+	if os.path.exists(history):
+		shutil.copy2(history, tmp_history)
+	store = None
+	skipped, written = {}, []
+
+	try:
+		for nc_file in paths:
+			with nc.Dataset(nc_file) as src:
+				src.set_auto_maskandscale(False)
+				if 'qr' not in src.variables:
+					reason = 'already compacted'
+				elif src.variables['qr'].dimensions not in (('time', 'comid'), ('comid', 'time')):
+					reason = 'unexpected qr dimensions'
+				else:
+					if store is None:
+						store = nc.Dataset(tmp_history, 'a') if os.path.exists(tmp_history) else \
+							_create_history(tmp_history, src)
+						store.set_auto_maskandscale(False)
+					reason, start = _append(src, store, verify)
+				if reason is None:
+					written.append((nc_file, nc_file + '.compact.tmp'))
+					_write_compacted(src, written[-1][1], os.path.basename(history), start)
+			if reason is not None:
+				skipped[os.path.basename(nc_file)] = reason
+		if store is not None:
+			store.close()
+			store = None
+	except BaseException:
+		if store is not None:
+			store.close()
+		for _, tmp_path in written:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+		if os.path.exists(tmp_history):
+			os.remove(tmp_history)
+		raise
+
+	if not written:
+		if os.path.exists(tmp_history):
+			os.remove(tmp_history)
+		return skipped
+
+	# the store first, so every compacted file finds its days in it
+	os.replace(tmp_history, history)
+	for nc_file, tmp_path in written:
+		stat = os.stat(nc_file)
+		os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+		os.replace(tmp_path, nc_file)
+	return skipped
+
+
+def compact_file(nc_file, verify=True):
+	"""
+	Moves the qr of a legacy forecast file into the history store of its folder and rewrites the file without it,
+	keeping its mtime so the tables derived from it stay valid.
+	Returns:
+	  str, why the file was left as it is, or None when it was compacted
+	"""
+	skipped = _compact([nc_file], history_path(os.path.dirname(nc_file)), verify)
+	return skipped.get(os.path.basename(nc_file))
+
+
+def compact_archive(folder, verify=True):
+	"""
+	Compacts every forecast file of folder from the oldest date, so the history store is only ever appended to. The
+	store is copied once per run rather than modified in place, as web workers may be reading it.
+	Returns:
+	  dict, archive bytes before and after and the files left as they were, with the reason
+	"""
+	from .catalog import ForecastCatalog
+
+	catalog = ForecastCatalog(folder)
+	paths = [catalog.path_for(date) for date in catalog.dates]
+	history = history_path(folder)
+
+	def archive_bytes():
+		return sum(os.path.getsize(p) for p in paths) + (os.path.getsize(history) if os.path.exists(history) else 0)
+
+	report = {'files': len(paths), 'bytes_before': archive_bytes()}
+	report['skipped'] = _compact(paths, history, verify)
+	report['bytes_after'] = archive_bytes()
+	return report
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Move the qr history of SONICS forecast files into one store.')
+	parser.add_argument('folder', help='forecast folder')
+	parser.add_argument('--no-verify', dest='verify', action='store_false',
+						help='do not compare the stored days with the qr of each file')
+	args = parser.parse_args(argv)
+
+	report = compact_archive(args.folder, args.verify)
+	for name, reason in sorted(report['skipped'].items()):
+		print('{0}: {1}'.format(name, reason))
+	print('{0} files, {1:.1f} MB before, {2:.1f} MB after'.format(
+		report['files'], report['bytes_before'] / 2 ** 20, report['bytes_after'] / 2 ** 20))
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+Build step for the region boundaries drawn when zooming to a region.
+
+Every region of public/geojson/index.json is simplified at several levels of detail and written as GeoJSON and
+quantized TopoJSON, each with gzip and (when the brotli package is installed) brotli precompressed variants, along
+with a bounds.json holding the bounding box of every region.
+
+It runs from ingest and warm-up, or by hand:
+    python -m tethysapp.sonics_hydroviewer.boundaries <output_directory>
+"""
+import os
+import sys
+import gzip
+import json
+import argparse
+
+from .regions import GEOJSON_DIR, load_region_index
+
+# (minimum map zoom, simplification tolerance in degrees) of each level of detail
+LEVELS = ((0, 0.02), (8, 0.004), (11, 0.0005))
+
+QUANTIZATION = 10000
+
+FORMATS = ('geojson', 'topojson')
+
+
+def level_for_zoom(zoom):
+	return max(level for level, (min_zoom, _) in enumerate(LEVELS) if zoom >= min_zoom)
+
+
+def region_geometries(region, region_index):
+	"""
+	Returns the polygons of the geojsons of a region as shapely geometries.
+	"""
+	from shapely.geometry import shape
+
+	geometries = []
+	for geojson in region_index[region]['geojsons']:
+		with open(os.path.join(GEOJSON_DIR, geojson)) as f:
+			for feature in json.load(f)['features']:
+				if feature['geometry']['type'] in ('Polygon', 'MultiPolygon'):
+					geometries.append(shape(feature['geometry']))
+	return geometries
+
+
+def simplify_polygons(geometries, tolerance):
+	"""
+	Returns the polygons of geometries simplified with shapely as lists of [x, y] rings. Topology is preserved, so
+	small islands stay visible at coarse levels instead of collapsing.
+	"""
+	import shapely
+
+	polygons = []
+	for polygon in shapely.get_parts(shapely.simplify(geometries, tolerance, preserve_topology=True)):
+		if polygon.is_empty:
+			continue
+		rings = [polygon.exterior] + list(polygon.interiors)
+		polygons.append([[[x, y] for x, y, *_ in ring.coords] for ring in rings])
+	return polygons
+
+
+def bounding_box(geometries):
+	import shapely
+
+	return [float(value) for value in shapely.total_bounds(geometries)]
+
+
+def to_geojson(polygons, bbox, precision=5):
+	coordinates = [[[[round(x, precision), round(y, precision)] for x, y in ring] for ring in polygon]
+				   for polygon in polygons]
+	return {
+		'type': 'FeatureCollection',
+		'bbox': bbox,
+		'features': [{
+			'type': 'Feature',
+			'properties': {},
+			'geometry': {'type': 'MultiPolygon', 'coordinates': coordinates},
+		}],
+	}
+
+
+def to_topojson(polygons, bbox, quantization=QUANTIZATION):
+	"""
+	Quantized, delta-encoded TopoJSON with one arc per ring.
+	"""
+	x0, y0, x1, y1 = bbox
+	kx = (x1 - x0) / (quantization - 1) or 1
+	ky = (y1 - y0) / (quantization - 1) or 1
+
+	arcs = []
+	geometry = []
+	for polygon in polygons:
+		rings = []
+		for ring in polygon:
+			arc, previous = [], None
+			for x, y in ring:
+				point = (int(round((x - x0) / kx)), int(round((y - y0) / ky)))
+				if point != previous:
+					arc.append(point if previous is None else (point[0] - previous[0], point[1] - previous[1]))
+					previous = point
+			if len(arc) >= 4:
+				rings.append([len(arcs)])
+				arcs.append(arc)
+		if rings:
+			geometry.append(rings)
+
+	return {
+		'type': 'Topology',
+		'bbox': bbox,
+		'transform': {'scale': [kx, ky], 'translate': [x0, y0]},
+		'objects': {'boundary': {'type': 'MultiPolygon', 'arcs': geometry}},
+		'arcs': arcs,
+	}
+
+
+def boundary_path(directory, region, level, fmt, encoding=None):
+	name = '{0}.{1}.{2}'.format(region, level, fmt)
+	return os.path.join(directory, name + ('.' + encoding if encoding else ''))
+
+
+def _write(path, content):
+	# replaced in one step, so a rebuild never serves a partial file
+	tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+	with open(tmp_path, 'wb') as f:
+		f.write(content)
+	os.replace(tmp_path, path)
+
+
+def _write_variants(path, content):
+	_write(path, content)
+	_write(path + '.gz', gzip.compress(content, 9))
+	try:
+		import brotli
+	except ImportError:
+		return
+	_write(path + '.br', brotli.compress(content, quality=11))
+
+
+def build_region_boundaries(directory):
+	"""
+	Writes every level of detail, format and encoding of every region to directory, bounds.json last.
+	"""
+	os.makedirs(directory, exist_ok=True)
+	region_index = load_region_index()
+	bounds = {}
+
+	for region in region_index:
+		geometries = region_geometries(region, region_index)
+		bounds[region] = bounding_box(geometries)
+		for level, (_, tolerance) in enumerate(LEVELS):
+			polygons = simplify_polygons(geometries, tolerance)
+			for fmt, document in (('geojson', to_geojson(polygons, bounds[region])),
+								  ('topojson', to_topojson(polygons, bounds[region]))):
+				content = json.dumps(document, separators=(',', ':')).encode('utf-8')
+				_write_variants(boundary_path(directory, region, level, fmt), content)
+
+	_write(os.path.join(directory, 'bounds.json'), json.dumps(bounds).encode('utf-8'))
+
+	return bounds
+
+
+def boundaries_directory(workspace):
+	return os.path.join(workspace, 'region_boundaries')
+
+
+def sources_mtime():
+	"""
+	Returns the latest mtime of public/geojson/index.json and of the geojsons it lists.
+	"""
+	region_index = load_region_index()
+	names = ['index.json'] + [geojson for region in region_index for geojson in region_index[region]['geojsons']]
+	return max(os.path.getmtime(os.path.join(GEOJSON_DIR, name)) for name in names)
+
+
+def update_region_boundaries(workspace):
+	"""
+	Ingest and warm-up step: builds the region boundaries of the app workspace when they are missing or older than
+	the geojsons they come from. Returns their directory.
+	"""
+	directory = boundaries_directory(workspace)
+	bounds_path = os.path.join(directory, 'bounds.json')
+	if not os.path.exists(bounds_path) or os.path.getmtime(bounds_path) < sources_mtime():
+		build_region_boundaries(directory)
+	return directory
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Build the multi-resolution region boundaries.')
+	parser.add_argument('directory', help='output directory, the region_boundaries folder of the app workspace')
+	args = parser.parse_args(argv)
+
+	build_region_boundaries(args.directory)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,270 @@
+import os
+import pickle
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+from .app import SonicsHydroviewer as app
+from .catalog import get_catalog
+from .metrics import stage, lap, registry
+from .coalesce import SingleFlight
+
+# seconds a request waits for an identical one in flight before computing its own response
+DEFAULT_COALESCE_TIMEOUT = 30.0
+
+# megabytes of response content a cache backend keeps when the response_cache_mb setting is not set
+DEFAULT_CACHE_MB = 256
+
+
+class MemoryBackend(object):
+	"""
+	Keeps cached responses in process memory, evicting the least recently used past max_entries or past max_bytes of
+	response content.
+	"""
+
+	def __init__(self, max_entries=256, max_bytes=DEFAULT_CACHE_MB * 2 ** 20):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.size = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				self._entries.move_to_end(key)
+			return entry
+
+	def set(self, key, entry):
+		with self._lock:
+			previous = self._entries.pop(key, None)
+			if previous is not None:
+				self.size -= len(previous[0])
+			self._entries[key] = entry
+			self.size += len(entry[0])
+			while len(self._entries) > self.max_entries or (self.size > self.max_bytes and len(self._entries) > 1):
+				_, (content, _) = self._entries.popitem(last=False)
+				self.size -= len(content)
+
+
+class FileBackend(object):
+	"""
+	Keeps cached responses as pickle files in a directory shared by every worker process. Reads touch the file mtime
+	so eviction past max_entries or max_bytes removes the least recently used files. Each process tracks the file
+	sizes in an index built by one scan and updated on writes, and scans the directory again only when the index
+	goes over a limit, to see the files of the other processes before evicting.
+	"""
+
+	def __init__(self, directory, max_entries=1024, max_bytes=DEFAULT_CACHE_MB * 2 ** 20):
+		self.directory = directory
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self._lock = threading.Lock()
+		os.makedirs(directory, exist_ok=True)
+		self._scan()
+
+	def _path(self, key):
+		return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.pickle')
+
+	def _scan(self):
+		# file sizes by path, least recently used first
+		stats = []
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith('.pickle'):
+				try:
+					stat = entry.stat()
+				except OSError:
+					continue
+				stats.append((stat.st_mtime, entry.path, stat.st_size))
+		stats.sort()
+		self._sizes = OrderedDict((path, size) for _, path, size in stats)
+		self.size = sum(self._sizes.values())
+
+	def _over_limit(self):
+		return len(self._sizes) > self.max_entries or (self.size > self.max_bytes and len(self._sizes) > 1)
+
+	def get(self, key):
+		path = self._path(key)
+		try:
+			with open(path, 'rb') as f:
+				entry = pickle.load(f)
+			os.utime(path)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return None
+		with self._lock:
+			if path in self._sizes:
+				self._sizes.move_to_end(path)
+		return entry
+
+	def set(self, key, entry):
+		path = self._path(key)
+		tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+		with open(tmp_path, 'wb') as f:
+			pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+		size = os.path.getsize(tmp_path)
+		os.replace(tmp_path, path)
+
+		with self._lock:
+			self.size += size - self._sizes.pop(path, 0)
+			self._sizes[path] = size
+			if not self._over_limit():
+				return
+			self._scan()
+			while self._over_limit():
+				old_path, old_size = self._sizes.popitem(last=False)
+				self.size -= old_size
+				try:
+					os.remove(old_path)
+				except OSError:
+					pass
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_response_cache():
+	"""
+	Returns the response cache backend selected by the response_cache custom setting ('memory', 'file' or 'none').
+	"""
+	global _backend
+	with _backend_lock:
+		if _backend is None:
+			kind = app.get_custom_setting('response_cache') or 'memory'
+			size = app.get_custom_setting('response_cache_size') or 256
+			max_bytes = int((app.get_custom_setting('response_cache_mb') or DEFAULT_CACHE_MB) * 2 ** 20)
+			if kind == 'file':
+				_backend = FileBackend(os.path.join(app.get_app_workspace().path, 'response_cache'), size, max_bytes)
+			elif kind == 'memory':
+				_backend = MemoryBackend(size, max_bytes)
+			else:
+				_backend = False
+	return _backend
+
+
+def _is_error(response):
+	# the controllers report failures as a 200 JSON response with an error member
+	return response.status_code != 200 or (not response.streaming and response.content.startswith(b'{"error"'))
+
+
+_flights = SingleFlight()
+_coalesce_timeout = None
+
+
+def coalesce_timeout():
+	global _coalesce_timeout
+	if _coalesce_timeout is None:
+		_coalesce_timeout = app.get_custom_setting('coalesce_timeout') or DEFAULT_COALESCE_TIMEOUT
+	return _coalesce_timeout
+
+
+def _copy_response(response):
+	copy = HttpResponse(response.content, status=response.status_code)
+	for header in ('Content-Type', 'Content-Disposition'):
+		if response.has_header(header):
+			copy[header] = response[header]
+	return copy
+
+
+def coalesced(endpoint, key, call):
+	"""
+	Runs call once for the concurrent requests with the same key: the others wait up to coalesce_timeout() seconds
+	and get a copy of its response, or have its exception raised. Requests that time out, or whose shared response is
+	streamed, call again and are counted as duplicate_work; shared responses are counted as coalesced.
+	Returns:
+	  tuple, (response, whether it was shared)
+	"""
+	try:
+		response, shared = _flights.do(key, call, coalesce_timeout())
+	except TimeoutError:
+		registry.increment('duplicate_work', endpoint)
+		return call(), False
+
+	if shared:
+		lap('coalesce')
+		if response.streaming:
+			registry.increment('duplicate_work', endpoint)
+			return call(), False
+		registry.increment('coalesced', endpoint)
+		return _copy_response(response), True
+	return response, False
+
+
+def cached_response(endpoint, dependencies=None, dated=True):
+	"""
+	Caches the responses of a controller keyed by (endpoint, resolved forecast file, file mtime, query parameters),
+	the parameters carrying the comid and output format, and answers conditional requests with 304 using ETag and
+	Last-Modified headers derived from the same key. Concurrent misses for the same key are coalesced into one call.
+	dependencies, a function of the app workspace path, lists the derived files the response also reads, whose paths
+	and mtimes are added to the key so the response changes when ingest writes them. Controllers that always read the
+	latest forecast file pass dated=False, so they are keyed on it and any startdate parameter is ignored.
+	"""
+
+	def decorator(controller):
+		@functools.wraps(controller)
+		def wrapper(request, *args, **kwargs):
+			try:
+				with stage('cache_key'):
+					get_data = request.GET
+					catalog = get_catalog(app.get_custom_setting('folder'))
+					if dated:
+						nc_file = catalog.resolve(get_data.get('startdate', ''))
+						params = get_data.items()
+					else:
+						nc_file = catalog.latest()
+						params = [(name, value) for name, value in get_data.items() if name != 'startdate']
+					mtime = os.path.getmtime(nc_file)
+					key = (endpoint, nc_file, mtime, tuple(sorted(params)))
+					if dependencies is not None:
+						versions = tuple((path, os.path.getmtime(path))
+										 for path in dependencies(app.get_app_workspace().path))
+						key += (versions,)
+						mtime = max([mtime] + [version for _, version in versions])
+			except Exception:
+				# let the controller report the bad request
+				return controller(request, *args, **kwargs)
+
+			etag = '"{0}"'.format(hashlib.sha1(repr(key).encode()).hexdigest())
+			last_modified = http_date(mtime)
+
+			if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+			if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+			if (if_none_match is not None and etag in if_none_match) or \
+					(if_none_match is None and if_modified_since is not None and int(mtime) <= if_modified_since):
+				response = HttpResponseNotModified()
+				response['ETag'] = etag
+				response['Last-Modified'] = last_modified
+				return response
+
+			with stage('cache'):
+				backend = get_response_cache()
+				entry = backend.get(key) if backend else None
+
+			if entry is not None:
+				content, headers = entry
+				response = HttpResponse(content)
+				for header, value in headers.items():
+					response[header] = value
+			else:
+				response, shared = coalesced(endpoint, key, lambda: controller(request, *args, **kwargs))
+				if _is_error(response):
+					return response
+				# streamed exports are revalidated with the headers below but not stored, shared responses already were
+				if backend and not shared and not response.streaming:
+					headers = {header: response[header] for header in ('Content-Type', 'Content-Disposition')
+							   if response.has_header(header)}
+					backend.set(key, (response.content, headers))
+
+			response['ETag'] = etag
+			response['Last-Modified'] = last_modified
+			response['Cache-Control'] = 'no-cache'
+			return response
+
+		return wrapper
+
+	return decorator
@@ -0,0 +1,109 @@
+import os
+import re
+import threading
+import datetime as dt
+
+FORECAST_FILE_PATTERN = re.compile(r'(\d{8})\.nc$')
+
+
+def parse_forecast_date(filename):
+	"""
+	Returns the forecast date of a PISCO_HyD_ARNOVIC_v1.0_YYYYMMDD.nc file name, or None when it has no valid date.
+	"""
+	match = FORECAST_FILE_PATTERN.search(filename)
+	if match is None:
+		return None
+	try:
+		return dt.datetime.strptime(match.group(1), '%Y%m%d').date()
+	except ValueError:
+		return None
+
+
+class ForecastCatalog(object):
+	"""
+	Maps forecast dates to the files in the SONICS forecast folder.
+
+	The folder is only rescanned when its mtime changes, which happens whenever a file is added, removed or renamed,
+	and only new file names are parsed on a rescan.
+	"""
+
+	def __init__(self, folder):
+		self.folder = folder
+		self._mtime = None
+		self._names = {}
+		self._paths = {}
+		self._dates = []
+		self._lock = threading.Lock()
+
+	def refresh(self):
+		mtime = os.stat(self.folder).st_mtime
+		if mtime == self._mtime:
+			return
+
+		with self._lock:
+			if mtime == self._mtime:
+				return
+			names = {entry.name for entry in os.scandir(self.folder) if entry.name.endswith('.nc')}
+			known = {name: date for name, date in self._names.items() if name in names}
+			for name in names - set(known):
+				known[name] = parse_forecast_date(name)
+			paths = {date: os.path.join(self.folder, name) for name, date in known.items() if date is not None}
+			# swap complete mappings so concurrent lookups never see a partial update
+			self._names, self._paths, self._dates = known, paths, sorted(paths)
+			self._mtime = mtime
+
+	@property
+	def dates(self):
+		self.refresh()
+		return self._dates
+
+	def latest(self):
+		"""
+		Returns the path of the most recent forecast file.
+		"""
+		dates = self.dates
+		if not dates:
+			raise FileNotFoundError('No forecast files in {0}'.format(self.folder))
+		return self._paths[dates[-1]]
+
+	def bounds(self):
+		"""
+		Returns the first and last forecast dates.
+		"""
+		dates = self.dates
+		if not dates:
+			raise FileNotFoundError('No forecast files in {0}'.format(self.folder))
+		return dates[0], dates[-1]
+
+	def path_for(self, date):
+		"""
+		Returns the forecast file for date, given as a datetime.date or a YYYYMMDD string.
+		"""
+		self.refresh()
+		if isinstance(date, str):
+			date = dt.datetime.strptime(date, '%Y%m%d').date()
+		try:
+			return self._paths[date]
+		except KeyError:
+			raise FileNotFoundError('No forecast file for {0}'.format(date))
+
+	def resolve(self, startdate):
+		"""
+		Returns the forecast file for the startdate request parameter, the latest file when it is empty.
+		"""
+		return self.path_for(startdate) if startdate else self.latest()
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(folder):
+	"""
+	Returns the process-wide catalog of folder.
+	"""
+	with _catalogs_lock:
+		catalog = _catalogs.get(folder)
+		if catalog is None:
+			catalog = _catalogs[folder] = ForecastCatalog(folder)
+	return catalog
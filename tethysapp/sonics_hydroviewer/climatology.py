@@ -0,0 +1,176 @@
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from .store import open_reach_store
+from .versions import new_version, publish_version, read_pointer, latest_pointer
+
+PERCENTILES = (10, 25, 50, 75, 90)
+
+PERCENTILE_NAMES = tuple('p{0}'.format(p) for p in PERCENTILES)
+
+# days on each side of a day of year pooled into its percentiles
+WINDOW_DAYS = 7
+
+DAYS = 366
+
+# cells of the (comid, sample, day of year) array built per block, about 128 MB of float32
+MAX_CELLS = 2 ** 25
+
+
+def day_of_year(times):
+	"""
+	Zero based day of year of datetime64 values, 365 only for December 31 of leap years.
+	"""
+	return (times.astype('datetime64[D]') - times.astype('datetime64[Y]')).astype(int)
+
+
+def _sorted_percentiles(samples):
+	"""
+	Percentiles along axis 1 of samples shaped (comid, sample, day of year), ignoring NaN, with the linear
+	interpolation of np.percentile. Sorting once and indexing avoids the per-row fallback of np.nanpercentile.
+	Returns:
+	  np.ndarray, float32 shaped (comid, day of year, percentile)
+	"""
+	ordered = np.sort(samples, axis=1)
+	counts = np.count_nonzero(~np.isnan(samples), axis=1)
+	result = np.empty(counts.shape + (len(PERCENTILES),), dtype=np.float32)
+
+	for k, percentile in enumerate(PERCENTILES):
+		position = np.maximum(counts - 1, 0) * (percentile / 100)
+		lower = np.floor(position).astype(np.int64)
+		upper = np.ceil(position).astype(np.int64)
+		low = np.take_along_axis(ordered, lower[:, None, :], axis=1)[:, 0, :]
+		high = np.take_along_axis(ordered, upper[:, None, :], axis=1)[:, 0, :]
+		values = low + (high - low) * (position - lower)
+		values[counts == 0] = np.nan
+		result[:, :, k] = values
+
+	return result
+
+
+def daily_percentiles(values, times, window=WINDOW_DAYS):
+	"""
+	Day of year PERCENTILES of every row of values, pooling the days within window days of each day of year.
+	Args:
+	  values (np.ndarray): flows shaped (comid, time)
+	  times (np.ndarray): datetime64 values of the time axis
+	Returns:
+	  np.ndarray, float32 shaped (comid, DAYS, percentile)
+	"""
+	years = times.astype('datetime64[Y]').astype(int)
+	years -= years.min()
+	by_day = np.full((values.shape[0], years.max() + 1, DAYS), np.nan, dtype=np.float32)
+	by_day[:, years, day_of_year(times)] = values
+
+	samples = np.concatenate([np.roll(by_day, shift, axis=2) for shift in range(-window, window + 1)], axis=1)
+	return _sorted_percentiles(samples)
+
+
+class ClimatologyTable(object):
+	"""
+	Day of year flow percentiles of every comid, shaped (comid, DAYS, percentile). Loaded tables are memory mapped,
+	so a lookup only reads the rows of one comid.
+	"""
+
+	def __init__(self, comids, values):
+		self.comids = comids
+		self.values = values
+		self._positions = {str(comid): i for i, comid in enumerate(comids.tolist())}
+
+	def lookup(self, comid, times):
+		"""
+		Returns the percentiles of comid for the days of year of times as a dict keyed by PERCENTILE_NAMES.
+		"""
+		rows = np.asarray(self.values[self._positions[str(comid)]])[day_of_year(times)]
+		return {name: rows[:, k] for k, name in enumerate(PERCENTILE_NAMES)}
+
+	@classmethod
+	def build(cls, nc_file, workspace):
+		dataset = open_reach_store(nc_file, workspace)
+		comids = dataset['comid'].values
+		times = dataset['time'].values
+		years = np.unique(times.astype('datetime64[Y]')).size
+		block_size = max(1, MAX_CELLS // (years * (2 * WINDOW_DAYS + 1) * DAYS))
+
+		values = np.empty((comids.size, DAYS, len(PERCENTILES)), dtype=np.float32)
+		for start in range(0, comids.size, block_size):
+			block = dataset['qr'].isel(comid=slice(start, start + block_size)).transpose('comid', 'time').values
+			values[start:start + block_size] = daily_percentiles(block, times)
+		return cls(comids, values)
+
+	def save(self, path):
+		"""
+		Writes the comids and values to the version directory path, published afterwards with publish_version.
+		"""
+		np.save(os.path.join(path, 'comids.npy'), self.comids)
+		np.save(os.path.join(path, 'values.npy'), self.values)
+
+	@classmethod
+	def load(cls, path):
+		return cls(np.load(os.path.join(path, 'comids.npy')), np.load(os.path.join(path, 'values.npy'), mmap_mode='r'))
+
+
+def table_directory(workspace):
+	return os.path.join(workspace, 'climatology')
+
+
+def build_climatology(nc_file, workspace):
+	"""
+	Ingest step: computes the day of year percentiles of the qr history of nc_file and stores them in the workspace,
+	replacing the tables of older forecast files since the history barely changes from one file to the next.
+	"""
+	directory = table_directory(workspace)
+	name = os.path.splitext(os.path.basename(nc_file))[0]
+
+	table = ClimatologyTable.build(nc_file, workspace)
+	path = new_version(directory, name)
+	try:
+		table.save(path)
+	except BaseException:
+		shutil.rmtree(path, ignore_errors=True)
+		raise
+	publish_version(directory, name, path)
+	return table
+
+
+_table = (None, None)
+_table_lock = threading.Lock()
+
+
+def latest_table_path(workspace):
+	"""
+	Returns the pointer of the most recent climatology table, or None when the ingest step has not run yet.
+	"""
+	return latest_pointer(table_directory(workspace))
+
+
+def climatology_files(workspace):
+	"""
+	Returns the pointer of the most recent climatology table, for the response cache key of the charts that show it.
+	"""
+	path = latest_table_path(workspace)
+	return [path] if path else []
+
+
+def load_climatology(workspace):
+	"""
+	Returns the most recent climatology table, or None when the ingest step has not run yet. Its comids and values
+	come from the same version, reread when the pointer is replaced.
+	"""
+	global _table
+	pointer = latest_table_path(workspace)
+	if pointer is None:
+		return None
+
+	try:
+		version = (pointer, os.stat(pointer).st_mtime_ns)
+		with _table_lock:
+			if _table[0] != version:
+				_table = (version, ClimatologyTable.load(read_pointer(pointer)))
+			return _table[1]
+	except FileNotFoundError:
+		# replaced by a newer ingest while being opened
+		return None
@@ -0,0 +1,54 @@
+import threading
+
+
+class _Flight(object):
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class SingleFlight(object):
+	"""
+	Runs one call per key at a time. Callers arriving while the call for their key is in flight wait for it and share
+	its result, or have its exception raised.
+	"""
+
+	def __init__(self):
+		self._flights = {}
+		self._lock = threading.Lock()
+
+	def do(self, key, func, timeout=None):
+		"""
+		Returns the result of func, called by this thread or by the one already running it for key.
+		Args:
+		  timeout (float): seconds to wait for a call in flight, None to wait until it ends
+		Returns:
+		  tuple, (result, whether the result came from another thread)
+		Raises:
+		  TimeoutError: the call in flight did not end within timeout
+		"""
+		with self._lock:
+			flight = self._flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self._flights[key] = _Flight()
+
+		if not leader:
+			if not flight.done.wait(timeout):
+				raise TimeoutError('call for {0!r} still running after {1} s'.format(key, timeout))
+			if flight.error is not None:
+				raise flight.error
+			return flight.result, True
+
+		try:
+			flight.result = func()
+		except BaseException as e:
+			flight.error = e
+			raise
+		finally:
+			with self._lock:
+				del self._flights[key]
+			flight.done.set()
+		return flight.result, False
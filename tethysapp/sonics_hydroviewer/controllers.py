@@ -1,59 +1,53 @@
 from tethys_sdk.gizmos import *
 from django.shortcuts import render
 from tethys_sdk.gizmos import PlotlyView
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, FileResponse
 
 import os
 import sys
-import json
-import math
-import requests
-import geoglows
-import pandas as pd
-import xarray as xr
-import netCDF4 as nc
-import datetime as dt
-from glob import glob
-from lmoments3 import distr
-import plotly.graph_objs as go
+import numpy as np
 from .app import SonicsHydroviewer as app
-
-
+from .datasets import select_reaches, read_reach, open_forecast
+from .return_periods import load_return_period_table, RETURN_PERIOD_NAMES
+from .store import open_reach_store
+from .shared import open_shared_forecast
+from .catalog import get_catalog, parse_forecast_date
+from .cache import cached_response
+from .exports import export_response, outer_join, zip_response, netcdf_response
+from .regions import region_positions, load_region_index, reach_coordinates
+from .boundaries import boundaries_directory, boundary_path, level_for_zoom, FORMATS as BOUNDARY_FORMATS
+from .exceedance import load_exceedance_table, top_reaches, SEVERITY_CLASSES, MAX_TOP_REACHES
+from .verification import load_skill_table
+from .metrics import timed_endpoint, lap, registry
+from .offload import async_view
+from .workers import connect_request_started
+from .climatology import load_climatology, climatology_files
+from .reaches import load_reach_index, DEFAULT_TOLERANCE
+from .downsample import downsample, time_window, DEFAULT_POINTS, MIN_POINTS
+
+
+@timed_endpoint('home')
 def home(request):
 	"""
 	Controller for the app home page.
 	"""
 
 	folder = app.get_custom_setting('folder')
-	print(folder)
-	forecast_nc_list = sorted(glob(os.path.join(folder, "*.nc")))
-	print(forecast_nc_list)
-
-	dates_array = []
-
-	for file in forecast_nc_list:
-		dates_array.append(file[len(folder) + 1 + 23:-3])
-
-	dates = []
-
-	for date in dates_array:
-		date_f = dt.datetime(int(date[0:4]), int(date[4:6]), int(date[6:8])).strftime('%Y-%m-%d')
-		dates.append([date_f, date])
-
-	dates.append(['Select Date', dates[-1][1]])
-	dates.reverse()
+	lap('settings')
+	start_date, end_date = get_catalog(folder).bounds()
+	lap('catalog')
 
 	date_picker = DatePicker(name='datesSelect',
 							 display_text='Date',
 							 autoclose=True,
 							 format='yyyy-mm-dd',
-							 start_date=dates[-1][0],
-							 end_date=dates[1][0],
+							 start_date=start_date.strftime('%Y-%m-%d'),
+							 end_date=end_date.strftime('%Y-%m-%d'),
 							 start_view='month',
 							 today_button=True,
 							 initial='')
 
-	region_index = json.load(open(os.path.join(os.path.dirname(__file__), 'public', 'geojson', 'index.json')))
+	region_index = load_region_index()
 	regions = SelectInput(
 		display_text='Zoom to a Region:',
 		name='regions',
@@ -67,26 +61,18 @@ def home(request):
 		"regions": regions
 	}
 
-	return render(request, 'sonics_hydroviewer/home.html', context)
-
-
-def gve_1(loc: float, scale: float, shape: float, rp: int or float) -> float:
-	"""
-	Solves the Gumbel Type I probability distribution function (pdf) = exp(-exp(-b)) where b is the covariate. Provide
-	the standard deviation and mean of the list of annual maximum flows. Compare scipy.stats.gumbel_r
-	Args:
-	  std (float): the standard deviation of the series
-	  xbar (float): the mean of the series
-	  skew (float): the skewness of the series
-	  rp (int or float): the return period in years
-	Returns:
-	  float, the flow corresponding to the return period specified
-	"""
-
-	return ((scale / shape) * (1 - math.exp(shape * (math.log(-math.log(1 - (1 / rp))))))) + loc
+	response = render(request, 'sonics_hydroviewer/home.html', context)
+	lap('render')
+	return response
 
 
+@timed_endpoint('hydrographs')
+@cached_response('hydrographs', dated=False)
 def get_hydrographs(request):
+	import geoglows
+	import pandas as pd
+	import plotly.graph_objs as go
+
 	try:
 		get_data = request.GET
 		# get stream attributes
@@ -96,43 +82,31 @@ def get_hydrographs(request):
 		watershed = get_data['watershed']
 
 		folder = app.get_custom_setting('folder')
-		forecast_nc_list = sorted(glob(os.path.join(folder, "*.nc")), reverse=True)
-		nc_file = forecast_nc_list[0]
-
-		qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr
-		time_dataset = qout_datasets.time
+		workspace = app.get_app_workspace().path
+		lap('settings')
+		nc_file = get_catalog(folder).latest()
+		lap('catalog')
 
-		historical_simulation_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values,
-												columns=['Streamflow (m3/s)'])
-		historical_simulation_df.index.name = 'Datetime'
+		dataset = open_shared_forecast(nc_file, workspace) or open_reach_store(nc_file, workspace)
+		lap('open')
+		reach = read_reach(dataset, comid)
+		lap('read')
 
 		'''Getting Return Periods'''
-		max_annual_flow = historical_simulation_df.groupby(historical_simulation_df.index.strftime("%Y")).max()
-		params = distr.gev.lmom_fit(max_annual_flow.iloc[:, 0].values.tolist())
-
-		return_periods = [10, 5, 2.33]
-
-		return_periods_values = []
-
-		for rp in return_periods:
-			return_periods_values.append(gve_1(params['loc'], params['scale'], params['c'], rp))
-
-		d = {'rivid': [comid], 'return_period_10': [return_periods_values[0]],
-			 'return_period_5': [return_periods_values[1]], 'return_period_2_33': [return_periods_values[2]]}
-
-		rperiods = pd.DataFrame(data=d)
-		rperiods.set_index('rivid', inplace=True)
+		rperiods = load_return_period_table(nc_file, workspace).lookup(comid)
+		lap('return_periods')
 
 		'''Plotting hydrograph'''
+		shown = downsample(reach.time, reach.qr, _point_budget(request))
+		historical_simulation_df = pd.DataFrame({'Streamflow (m3/s)': reach.qr[shown]},
+												index=pd.DatetimeIndex(reach.time[shown], name='Datetime'))
 		hydroviewer_figure = geoglows.plots.historic_simulation(historical_simulation_df)
 
-		x_vals = (
-			historical_simulation_df.index[0], historical_simulation_df.index[len(historical_simulation_df.index) - 1],
-			historical_simulation_df.index[len(historical_simulation_df.index) - 1], historical_simulation_df.index[0])
-		max_visible = max(historical_simulation_df.max())
+		x_vals = (reach.time[0], reach.time[-1], reach.time[-1], reach.time[0])
+		max_visible = np.nanmax(reach.qr)
 
 		'''Getting Return Periods'''
-		r2_33 = int(rperiods.iloc[0]['return_period_2_33'])
+		r2_33 = int(rperiods['return_period_2_33'])
 
 		colors = {
 			'2.33 Year': 'rgba(243, 255, 0, .4)',
@@ -159,8 +133,8 @@ def get_hydrographs(request):
 				visible=visible,
 				line=dict(color=color, width=0))
 
-		r5 = int(rperiods.iloc[0]['return_period_5'])
-		r10 = int(rperiods.iloc[0]['return_period_10'])
+		r5 = int(rperiods['return_period_5'])
+		r10 = int(rperiods['return_period_10'])
 
 		hydroviewer_figure.add_trace(
 			template('Return Periods', (r10 * 0.05, r10 * 0.05, r10 * 0.05, r10 * 0.05), 'rgba(0,0,0,0)', fill='none'))
@@ -172,12 +146,15 @@ def get_hydrographs(request):
 		hydroviewer_figure['layout']['xaxis'].update(autorange=True)
 
 		chart_obj = PlotlyView(hydroviewer_figure)
+		lap('figure')
 
 		context = {
 			'gizmo_object': chart_obj,
 		}
 
-		return render(request, 'sonics_hydroviewer/gizmo_ajax.html', context)
+		response = render(request, 'sonics_hydroviewer/gizmo_ajax.html', context)
+		lap('render')
+		return response
 
 	except Exception as e:
 		exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -189,6 +166,8 @@ def get_hydrographs(request):
 		})
 
 
+@timed_endpoint('simulated_discharge_csv')
+@cached_response('simulated_discharge_csv', dated=False)
 def get_simulated_discharge_csv(request):
 	"""
 	Get historic simulations from ERA Interim
@@ -203,22 +182,19 @@ def get_simulated_discharge_csv(request):
 		watershed = get_data['watershed']
 
 		folder = app.get_custom_setting('folder')
-		forecast_nc_list = sorted(glob(os.path.join(folder, "*.nc")), reverse=True)
-		nc_file = forecast_nc_list[0]
-
-		qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr
-		time_dataset = qout_datasets.time
-
-		historical_simulation_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-		historical_simulation_df.index.name = 'Datetime'
-
-		pairs = [list(a) for a in zip(historical_simulation_df.index, historical_simulation_df.iloc[:, 0])]
-
-		response = HttpResponse(content_type='text/csv')
-		response['Content-Disposition'] = 'attachment; filename=simulated_discharge_{0}.csv'.format(comid)
-
-		historical_simulation_df.to_csv(encoding='utf-8', header=True, path_or_buf=response)
-
+		workspace = app.get_app_workspace().path
+		lap('settings')
+		nc_file = get_catalog(folder).latest()
+		lap('catalog')
+
+		dataset = open_shared_forecast(nc_file, workspace) or open_reach_store(nc_file, workspace)
+		lap('open')
+		reach = read_reach(dataset, comid)
+		lap('read')
+
+		response = export_response(request, 'simulated_discharge_{0}'.format(comid), 'Datetime', reach.time,
+								   [('Streamflow (m3/s)', reach.qr)])
+		lap('export')
 		return response
 
 	except Exception as e:
@@ -231,7 +207,11 @@ def get_simulated_discharge_csv(request):
 		})
 
 
+@timed_endpoint('time_series')
+@cached_response('time_series')
 def get_time_series(request):
+	import plotly.graph_objs as go
+
 	try:
 		get_data = request.GET
 		# get stream attributes
@@ -242,88 +222,38 @@ def get_time_series(request):
 		startdate = get_data['startdate']
 
 		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
 
 		'''Getting Forecast Stats'''
-		if startdate != '':
-			nc_file = folder + '/PISCO_HyD_ARNOVIC_v1.0_' + startdate + '.nc'
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr
-			time_dataset = qout_datasets.time
-			historical_simulation_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			initial_condition = historical_simulation_df.loc[historical_simulation_df.index == pd.to_datetime(historical_simulation_df.index[-1])]
-
-			'''ETA Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_eta
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_eta
-			forecast_eta_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_eta_df.index.name = 'Datetime'
-			forecast_eta_df = forecast_eta_df.append(initial_condition)
-			forecast_eta_df.sort_index(inplace=True)
-
-			'''GFS Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_gfs
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_gfs
-			forecast_gfs_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_gfs_df.index.name = 'Datetime'
-			forecast_gfs_df = forecast_gfs_df.append(initial_condition)
-			forecast_gfs_df.sort_index(inplace=True)
-
-		else:
+		nc_file = get_catalog(folder).resolve(startdate)
+		lap('catalog')
+		dataset = open_shared_forecast(nc_file, workspace) or open_reach_store(nc_file, workspace)
+		lap('open')
+		reach = read_reach(dataset, comid)
+		lap('read')
 
-			forecast_nc_list = sorted(glob(os.path.join(folder, "*.nc")), reverse=True)
-			nc_file = forecast_nc_list[0]
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr
-			time_dataset = qout_datasets.time
-			historical_simulation_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			initial_condition = historical_simulation_df.loc[historical_simulation_df.index == pd.to_datetime(historical_simulation_df.index[-1])]
-
-			'''ETA Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_eta
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_eta
-			forecast_eta_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_eta_df.index.name = 'Datetime'
-			forecast_eta_df = forecast_eta_df.append(initial_condition)
-			forecast_eta_df.sort_index(inplace=True)
-
-			'''GFS Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_gfs
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_gfs
-			forecast_gfs_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_gfs_df.index.name = 'Datetime'
-			forecast_gfs_df = forecast_gfs_df.append(initial_condition)
-			forecast_gfs_df.sort_index(inplace=True)
+		'''ETA and GFS Forecasts'''
+		time_eta, forecast_eta = _with_initial_condition(reach.time_eta, reach.qr_eta, reach.time[-1], reach.qr[-1])
+		time_gfs, forecast_gfs = _with_initial_condition(reach.time_gfs, reach.qr_gfs, reach.time[-1], reach.qr[-1])
 
 		'''Return Periods'''
-		max_annual_flow = historical_simulation_df.groupby(historical_simulation_df.index.strftime("%Y")).max()
-		params = distr.gev.lmom_fit(max_annual_flow.iloc[:, 0].values.tolist())
-
-		return_periods = [10, 5, 2.33]
-
-		return_periods_values = []
-
-		for rp in return_periods:
-			return_periods_values.append(gve_1(params['loc'], params['scale'], params['c'], rp))
-
-		d = {'rivid': [comid], 'return_period_10': [return_periods_values[0]],
-			 'return_period_5': [return_periods_values[1]], 'return_period_2_33': [return_periods_values[2]]}
-
-		rperiods = pd.DataFrame(data=d)
-		rperiods.set_index('rivid', inplace=True)
+		rperiods = load_return_period_table(nc_file, workspace).lookup(comid)
+		lap('return_periods')
 
 		'''Plotting Forecast'''
 
-		dates = forecast_gfs_df.index.tolist()
-		startdate = dates[0]
-		enddate = dates[-1]
+		startdate = time_gfs[0]
 
 		gfs_forecast = go.Scatter(name='GFS Forecast',
-								  x=forecast_gfs_df.index,
-								  y=forecast_gfs_df['Streamflow (m3/s)'],
+								  x=time_gfs,
+								  y=forecast_gfs,
 								  showlegend=True,
 								  line=dict(color='black', dash='dash'))
 
 		eta_forecast = go.Scatter(name='ETA Forecast',
-								  x=forecast_eta_df.index,
-								  y=forecast_eta_df['Streamflow (m3/s)'],
+								  x=time_eta,
+								  y=forecast_eta,
 								  showlegend=True,
 								  line=dict(color='blue', dash='dash'))
 
@@ -334,30 +264,26 @@ def get_time_series(request):
 
 		hydroviewer_figure = go.Figure(data=[gfs_forecast, eta_forecast], layout=layout)
 
-		x_vals = (forecast_gfs_df.index[0], forecast_gfs_df.index[len(forecast_gfs_df.index) - 1],
-				  forecast_gfs_df.index[len(forecast_gfs_df.index) - 1], forecast_gfs_df.index[0])
-		max_visible = max(forecast_gfs_df.max())
-		max_visible = max(max(forecast_eta_df.max()), max_visible)
+		x_vals = (time_gfs[0], time_gfs[-1], time_gfs[-1], time_gfs[0])
+		max_visible = max(np.nanmax(forecast_gfs), np.nanmax(forecast_eta))
 
 		'''Adding Recent Days'''
-		records_df = historical_simulation_df.loc[
-			historical_simulation_df.index >= pd.to_datetime(startdate - dt.timedelta(days=8))]
-		records_df = records_df.loc[records_df.index <= pd.to_datetime(startdate + dt.timedelta(days=2))]
+		recent = (reach.time >= startdate - np.timedelta64(8, 'D')) & (reach.time <= startdate + np.timedelta64(2, 'D'))
 
-		if len(records_df.index) > 0:
+		if recent.any():
+			time_records, records = reach.time[recent], reach.qr[recent]
 			hydroviewer_figure.add_trace(go.Scatter(
 				name='1st days forecasts',
-				x=records_df.index,
-				y=records_df.iloc[:, 0].values,
+				x=time_records,
+				y=records,
 				line=dict(color='#FFA15A', )
 			))
 
-			x_vals = (records_df.index[0], forecast_gfs_df.index[len(forecast_gfs_df.index) - 1],
-					  forecast_gfs_df.index[len(forecast_gfs_df.index) - 1], records_df.index[0])
-			max_visible = max(max(records_df.max()), max_visible)
+			x_vals = (time_records[0], time_gfs[-1], time_gfs[-1], time_records[0])
+			max_visible = max(np.nanmax(records), max_visible)
 
 		'''Getting Return Periods'''
-		r2_33 = int(rperiods.iloc[0]['return_period_2_33'])
+		r2_33 = int(rperiods['return_period_2_33'])
 
 		colors = {
 			'2.33 Year': 'rgba(243, 255, 0, .4)',
@@ -384,8 +310,8 @@ def get_time_series(request):
 				visible=visible,
 				line=dict(color=color, width=0))
 
-		r5 = int(rperiods.iloc[0]['return_period_5'])
-		r10 = int(rperiods.iloc[0]['return_period_10'])
+		r5 = int(rperiods['return_period_5'])
+		r10 = int(rperiods['return_period_10'])
 
 		hydroviewer_figure.add_trace(template('Return Periods', (r10 * 0.05, r10 * 0.05, r10 * 0.05, r10 * 0.05), 'rgba(0,0,0,0)', fill='none'))
 		hydroviewer_figure.add_trace(template(f'2.33 Year: {r2_33}', (r2_33, r2_33, r5, r5), colors['2.33 Year']))
@@ -395,12 +321,15 @@ def get_time_series(request):
 		hydroviewer_figure['layout']['xaxis'].update(autorange=True)
 
 		chart_obj = PlotlyView(hydroviewer_figure)
+		lap('figure')
 
 		context = {
 			'gizmo_object': chart_obj,
 		}
 
-		return render(request, 'sonics_hydroviewer/gizmo_ajax.html', context)
+		response = render(request, 'sonics_hydroviewer/gizmo_ajax.html', context)
+		lap('render')
+		return response
 
 
 	except Exception as e:
@@ -412,6 +341,8 @@ def get_time_series(request):
 			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
 		})
 
+@timed_endpoint('forecast_data_csv')
+@cached_response('forecast_data_csv')
 def get_forecast_data_csv(request):
 	"""""
 	Returns Forecast data as csv
@@ -427,68 +358,316 @@ def get_forecast_data_csv(request):
 		startdate = get_data['startdate']
 
 		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
 
 		'''Getting Forecast Stats'''
-		if startdate != '':
-			nc_file = folder + '/PISCO_HyD_ARNOVIC_v1.0_' + startdate + '.nc'
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr
-			time_dataset = qout_datasets.time
-			historical_simulation_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			initial_condition = historical_simulation_df.loc[historical_simulation_df.index == pd.to_datetime(historical_simulation_df.index[-1])]
-
-			'''ETA Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_eta
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_eta
-			forecast_eta_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_eta_df.index.name = 'Datetime'
-			forecast_eta_df = forecast_eta_df.append(initial_condition)
-			forecast_eta_df.sort_index(inplace=True)
-			forecast_eta_df.rename(columns={"Streamflow (m3/s)": "ETA Streamflow (m3/s)"}, inplace=True)
-
-			'''GFS Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_gfs
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_gfs
-			forecast_gfs_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_gfs_df.index.name = 'Datetime'
-			forecast_gfs_df = forecast_gfs_df.append(initial_condition)
-			forecast_gfs_df.sort_index(inplace=True)
-			forecast_gfs_df.rename(columns={"Streamflow (m3/s)": "GFS Streamflow (m3/s)"}, inplace=True)
+		nc_file = get_catalog(folder).resolve(startdate)
+		lap('catalog')
+		dataset = open_shared_forecast(nc_file, workspace) or open_reach_store(nc_file, workspace)
+		lap('open')
+		reach = read_reach(dataset, comid)
+		lap('read')
+
+		'''ETA and GFS Forecasts'''
+		forecast_eta = _with_initial_condition(reach.time_eta, reach.qr_eta, reach.time[-1], reach.qr[-1])
+		forecast_gfs = _with_initial_condition(reach.time_gfs, reach.qr_gfs, reach.time[-1], reach.qr[-1])
+		times, (eta, gfs) = outer_join(forecast_eta, forecast_gfs)
+
+		response = export_response(request, 'streamflow_forecast_{0}_{1}'.format(comid, startdate), 'Datetime', times,
+								   [('ETA Streamflow (m3/s)', eta), ('GFS Streamflow (m3/s)', gfs)])
+		lap('export')
+		return response
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+				'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+def _isoformat(times):
+	return np.datetime_as_string(times, unit='s').tolist()
+
+
+def _epoch_ms(times):
+	return np.asarray(times, dtype='datetime64[ms]').astype(np.int64).tolist()
+
+
+def _series(values):
+	"""
+	Converts a float array to a JSON serializable list rounded to 3 decimals, with NaN as null.
+	"""
+	values = np.round(np.asarray(values, dtype=float), 3)
+	return np.where(np.isnan(values), None, values).tolist()
+
+
+def _with_initial_condition(times, flows, initial_time, initial_flow):
+	"""
+	Adds the last simulated value to a forecast series, keeping it sorted by time.
+	"""
+	times = np.append(times, initial_time)
+	order = np.argsort(times, kind='stable')
+	return times[order], np.append(flows, initial_flow)[order]
+
+
+def _parse_time(value):
+	"""
+	Parses a start or end request parameter, given as epoch milliseconds or as an ISO date as Plotly reports ranges.
+	"""
+	if not value:
+		return None
+	if value.lstrip('-').isdigit():
+		return np.datetime64(int(value), 'ms')
+	return np.datetime64(value.strip().replace(' ', 'T'))
+
+
+def _point_budget(request):
+	points = request.GET.get('points')
+	budget = int(points) if points else app.get_custom_setting('hydrograph_points') or DEFAULT_POINTS
+	return max(budget, MIN_POINTS)
+
 
+def _data_response(request, data):
+	"""
+	Encodes data as JSON, or as msgpack when the request asks for format=msgpack and msgpack is installed.
+	"""
+	if request.GET.get('format') == 'msgpack':
+		try:
+			import msgpack
+		except ImportError:
+			return JsonResponse({'error': 'format=msgpack is not available, msgpack is not installed'}, status=400)
+		response = HttpResponse(msgpack.packb(data), content_type='application/msgpack')
+	else:
+		response = JsonResponse(data)
+	lap('serialize')
+	return response
+
+
+@timed_endpoint('hydrograph_data')
+@cached_response('hydrograph_data', dated=False)
+def get_hydrograph_data(request):
+	"""
+	Returns the historical simulation and return periods of a comid as arrays, for charts drawn by the client. The
+	simulation is downsampled to the point budget with its annual peaks kept; a zoomed chart asks for the visible
+	start and end, which are sent at full resolution while they fit the budget.
+	"""
+
+	try:
+		get_data = request.GET
+		comid = get_data['comid']
+		start = _parse_time(get_data.get('start'))
+		end = _parse_time(get_data.get('end'))
+
+		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
+		nc_file = get_catalog(folder).latest()
+		lap('catalog')
+
+		dataset = open_shared_forecast(nc_file, workspace) or open_reach_store(nc_file, workspace)
+		lap('open')
+		reach = read_reach(dataset, comid)
+		lap('read')
+		rperiods = load_return_period_table(nc_file, workspace).lookup(comid)
+		lap('return_periods')
+
+		window = time_window(reach.time, start, end)
+		times, flows = reach.time[window], reach.qr[window]
+		shown = downsample(times, flows, _point_budget(request))
+		lap('downsample')
+
+		return _data_response(request, {
+			'comid': comid,
+			'time': _epoch_ms(times[shown]),
+			'flow': _series(flows[shown]),
+			'downsampled': bool(shown.size < times.size),
+			'return_periods': rperiods,
+		})
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('time_series_data')
+@cached_response('time_series_data', dependencies=climatology_files)
+def get_time_series_data(request):
+	"""
+	Returns the ETA and GFS forecasts, the recent simulated days, the day of year flow percentiles over the same days
+	and the return periods of a comid as arrays, for charts drawn by the client.
+	"""
+
+	try:
+		get_data = request.GET
+		comid = get_data['comid']
+		startdate = get_data.get('startdate', '')
+
+		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
+		nc_file = get_catalog(folder).resolve(startdate)
+		lap('catalog')
+
+		dataset = open_shared_forecast(nc_file, workspace) or open_reach_store(nc_file, workspace)
+		lap('open')
+		reach = read_reach(dataset, comid)
+		lap('read')
+		rperiods = load_return_period_table(nc_file, workspace).lookup(comid)
+		lap('return_periods')
+
+		time_eta, forecast_eta = _with_initial_condition(reach.time_eta, reach.qr_eta, reach.time[-1], reach.qr[-1])
+		time_gfs, forecast_gfs = _with_initial_condition(reach.time_gfs, reach.qr_gfs, reach.time[-1], reach.qr[-1])
+
+		'''Recent Days'''
+		recent = (reach.time >= time_gfs[0] - np.timedelta64(8, 'D')) & \
+			(reach.time <= time_gfs[0] + np.timedelta64(2, 'D'))
+
+		'''Climatology'''
+		climatology = None
+		table = load_climatology(workspace)
+		if table is not None:
+			first = min(time_gfs[0], time_eta[0], reach.time[recent][0] if recent.any() else time_gfs[0])
+			days = np.arange(first.astype('datetime64[D]'), max(time_gfs[-1], time_eta[-1]).astype('datetime64[D]') + 1)
+			climatology = {name: _series(values) for name, values in table.lookup(comid, days).items()}
+			climatology['time'] = _epoch_ms(days)
+		lap('climatology')
+
+		return _data_response(request, {
+			'comid': comid,
+			'time_eta': _epoch_ms(time_eta),
+			'eta': _series(forecast_eta),
+			'time_gfs': _epoch_ms(time_gfs),
+			'gfs': _series(forecast_gfs),
+			'time_records': _epoch_ms(reach.time[recent]),
+			'records': _series(reach.qr[recent]),
+			'climatology': climatology,
+			'return_periods': rperiods,
+		})
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('batch_time_series')
+def get_batch_time_series(request):
+	"""
+	Returns the historical simulation, ETA and GFS forecasts and return periods of a comma separated list of comids
+	as JSON, read with one selection over the comid dimension.
+	"""
+
+	try:
+		get_data = request.GET if request.method == 'GET' else request.POST
+		comids = [comid.strip() for comid in get_data.get('comids', '').split(',') if comid.strip()]
+		startdate = get_data.get('startdate', '')
+
+		max_comids = app.get_custom_setting('max_batch_comids') or 500
+		if not comids:
+			return JsonResponse({'error': 'no comids requested'}, status=400)
+		if len(comids) > max_comids:
+			return JsonResponse({'error': 'at most {0} comids can be requested at once'.format(max_comids)}, status=400)
+
+		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
+
+		nc_file = get_catalog(folder).resolve(startdate)
+		lap('catalog')
+		dataset = open_reach_store(nc_file, workspace)
+		lap('open')
+		positions, found, missing = select_reaches(dataset, comids)
+
+		reaches = dataset[['qr', 'qr_eta', 'qr_gfs']].isel(comid=positions)
+		historical = reaches['qr'].transpose('comid', ...).values
+		forecast_eta = reaches['qr_eta'].transpose('comid', ...).values
+		forecast_gfs = reaches['qr_gfs'].transpose('comid', ...).values
+		lap('read')
+		rperiods = load_return_period_table(nc_file, workspace).lookup_many(found)
+		lap('return_periods')
+
+		response = JsonResponse({
+			'forecast_file': os.path.basename(nc_file),
+			'time': _isoformat(reaches['time'].values),
+			'time_eta': _isoformat(reaches['time_eta'].values),
+			'time_gfs': _isoformat(reaches['time_gfs'].values),
+			'missing': missing,
+			'reaches': {
+				comid: {
+					'historical': _series(historical[i]),
+					'eta': _series(forecast_eta[i]),
+					'gfs': _series(forecast_gfs[i]),
+					'return_periods': dict(zip(RETURN_PERIOD_NAMES, rperiods[i].tolist())),
+				} for i, comid in enumerate(found)
+			},
+		})
+		lap('serialize')
+		return response
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('region_export')
+def get_region_export(request):
+	"""
+	Exports the historical simulation and ETA/GFS forecasts of every reach inside a region of
+	public/geojson/index.json, or of a comma separated comids list, as a streamed zip of CSV files or, with
+	format=netcdf, as a subset NetCDF file.
+	"""
+
+	try:
+		get_data = request.GET
+		startdate = get_data.get('startdate', '')
+
+		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
+		nc_file = get_catalog(folder).resolve(startdate)
+		lap('catalog')
+		dataset = open_reach_store(nc_file, workspace)
+		lap('open')
+
+		if get_data.get('region'):
+			name = get_data['region']
+			positions = region_positions(name, dataset, workspace)
+			if positions is None:
+				return JsonResponse({'error': 'region membership not built yet, run the ingest step'}, status=503)
 		else:
+			name = 'reaches'
+			comids = [comid.strip() for comid in get_data.get('comids', '').split(',') if comid.strip()]
+			positions = select_reaches(dataset, comids)[0]
+		lap('select')
+
+		if len(positions) == 0:
+			return JsonResponse({'error': 'no reaches to export'}, status=400)
 
-			forecast_nc_list = sorted(glob(os.path.join(folder, "*.nc")), reverse=True)
-			nc_file = forecast_nc_list[0]
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr
-			time_dataset = qout_datasets.time
-			historical_simulation_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			initial_condition = historical_simulation_df.loc[historical_simulation_df.index == pd.to_datetime(historical_simulation_df.index[-1])]
-
-			'''ETA Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_eta
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_eta
-			forecast_eta_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_eta_df.index.name = 'Datetime'
-			forecast_eta_df = forecast_eta_df.append(initial_condition)
-			forecast_eta_df.sort_index(inplace=True)
-			forecast_eta_df.rename(columns={"Streamflow (m3/s)": "ETA Streamflow (m3/s)"}, inplace=True)
-
-			'''GFS Forecast'''
-			qout_datasets = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).qr_gfs
-			time_dataset = xr.open_dataset(nc_file, autoclose=True).sel(comid=comid).time_gfs
-			forecast_gfs_df = pd.DataFrame(qout_datasets.values, index=time_dataset.values, columns=['Streamflow (m3/s)'])
-			forecast_gfs_df.index.name = 'Datetime'
-			forecast_gfs_df = forecast_gfs_df.append(initial_condition)
-			forecast_gfs_df.sort_index(inplace=True)
-			forecast_gfs_df.rename(columns={"Streamflow (m3/s)": "GFS Streamflow (m3/s)"}, inplace=True)
-
-		forecast_df = pd.concat([forecast_eta_df, forecast_gfs_df], axis=1)
-
-		# Writing CSV
-		response = HttpResponse(content_type='text/csv')
-		response['Content-Disposition'] = 'attachment; filename=streamflow_forecast_{0}_{1}.csv'.format(comid, startdate)
-
-		forecast_df.to_csv(encoding='utf-8', header=True, path_or_buf=response)
+		filename = 'sonics_{0}_{1}'.format(name, parse_forecast_date(os.path.basename(nc_file)).strftime('%Y%m%d'))
 
+		if get_data.get('format') == 'netcdf':
+			response = netcdf_response(dataset, positions, filename)
+		else:
+			response = zip_response(dataset, positions, filename)
+		lap('export')
 		return response
 
 	except Exception as e:
@@ -497,5 +676,266 @@ def get_forecast_data_csv(request):
 		print("line: " + str(exc_tb.tb_lineno))
 
 		return JsonResponse({
-				'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
-		})
\ No newline at end of file
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('flood_exceedance')
+@cached_response('flood_exceedance')
+def get_flood_exceedance(request):
+	"""
+	Returns the severity class and the peak to 2.33 year threshold ratio of the ETA and GFS forecasts of every comid,
+	as parallel arrays, so the map can style all the reaches with one request. With coordinates=1 the lon and lat of
+	each reach are added, for the markers the map draws over the drainage lines.
+	"""
+
+	try:
+		get_data = request.GET
+		startdate = get_data.get('startdate', '')
+		min_severity = int(get_data.get('min_severity', 0))
+
+		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
+		nc_file = get_catalog(folder).resolve(startdate)
+		lap('catalog')
+
+		table = load_exceedance_table(nc_file, workspace)
+		lap('exceedance')
+		selected = table.classes >= min_severity
+
+		data = {
+			'forecast_file': os.path.basename(nc_file),
+			'classes': SEVERITY_CLASSES,
+			'comids': table.comids[selected].tolist(),
+			'severity': table.classes[selected].tolist(),
+			'peak_ratio': _series(table.ratios[selected]),
+		}
+		if get_data.get('coordinates') == '1':
+			lon, lat = reach_coordinates(open_forecast(nc_file))
+			data['lon'] = _series(lon[selected])
+			data['lat'] = _series(lat[selected])
+			lap('coordinates')
+		return _data_response(request, data)
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('region_summary')
+@cached_response('region_summary')
+def get_region_summary(request):
+	"""
+	Summarizes the forecast inside a region of public/geojson/index.json: the count of reaches in each severity class
+	and the n reaches whose ETA/GFS peaks rank highest against their return periods.
+	"""
+
+	try:
+		get_data = request.GET
+		region = get_data['region']
+		startdate = get_data.get('startdate', '')
+		n = min(max(int(get_data.get('n', 10)), 1), MAX_TOP_REACHES)
+
+		if region not in load_region_index():
+			return JsonResponse({'error': 'unknown region'}, status=400)
+
+		folder = app.get_custom_setting('folder')
+		workspace = app.get_app_workspace().path
+		lap('settings')
+		nc_file = get_catalog(folder).resolve(startdate)
+		lap('catalog')
+
+		positions = region_positions(region, open_reach_store(nc_file, workspace), workspace)
+		if positions is None:
+			return JsonResponse({'error': 'region membership not built yet, run the ingest step'}, status=503)
+		lap('select')
+		table = load_exceedance_table(nc_file, workspace)
+		top = top_reaches(table, positions, n)
+		lap('exceedance')
+		thresholds = load_return_period_table(nc_file, workspace).values[top]
+		lap('return_periods')
+
+		return _data_response(request, {
+			'forecast_file': os.path.basename(nc_file),
+			'region': region,
+			'reaches': int(positions.size),
+			'classes': SEVERITY_CLASSES,
+			'severity_counts': np.bincount(table.classes[positions], minlength=len(SEVERITY_CLASSES)).tolist(),
+			'comids': table.comids[top].tolist(),
+			'severity': table.classes[top].tolist(),
+			'peak_ratio': _series(table.ratios[top]),
+			'return_periods': {name: _series(thresholds[:, k]) for k, name in enumerate(RETURN_PERIOD_NAMES)},
+		})
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('region_bounds')
+def get_region_bounds(request):
+	"""
+	Returns the precomputed bounding box of every region, as [min lon, min lat, max lon, max lat].
+	"""
+
+	try:
+		path = os.path.join(boundaries_directory(app.get_app_workspace().path), 'bounds.json')
+		if not os.path.exists(path):
+			return JsonResponse({'error': 'region boundaries not built yet, run the ingest step'}, status=503)
+		lap('boundaries')
+		response = FileResponse(open(path, 'rb'), content_type='application/json')
+		response['Cache-Control'] = 'public, max-age=2592000'
+		return response
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('region_boundary')
+def get_region_boundary(request):
+	"""
+	Returns the boundary of a region simplified for the requested map zoom, as quantized TopoJSON or GeoJSON, served
+	from the precompressed variant matching the Accept-Encoding of the request.
+	"""
+
+	try:
+		get_data = request.GET
+		region = get_data['region']
+		zoom = float(get_data.get('zoom', 0))
+		fmt = get_data.get('format', 'topojson')
+
+		if region not in load_region_index() or fmt not in BOUNDARY_FORMATS:
+			return JsonResponse({'error': 'unknown region or format'}, status=400)
+
+		path = boundary_path(boundaries_directory(app.get_app_workspace().path), region, level_for_zoom(zoom), fmt)
+		if not os.path.exists(path):
+			return JsonResponse({'error': 'region boundaries not built yet, run the ingest step'}, status=503)
+		lap('boundaries')
+
+		accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+		encoding = None
+		for name, extension in (('br', 'br'), ('gzip', 'gz')):
+			if name in accept_encoding and os.path.exists(path + '.' + extension):
+				encoding, path = name, path + '.' + extension
+				break
+
+		response = FileResponse(open(path, 'rb'), content_type='application/json')
+		if encoding:
+			response['Content-Encoding'] = encoding
+		response['Cache-Control'] = 'public, max-age=2592000'
+		response['Vary'] = 'Accept-Encoding'
+		return response
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('forecast_skill')
+def get_forecast_skill(request):
+	"""
+	Returns the skill of the archived ETA and GFS forecasts of a comid per lead day, as computed by the verification job.
+	"""
+
+	try:
+		comid = request.GET['comid']
+		table = load_skill_table(app.get_app_workspace().path)
+		skill = table.lookup(comid)
+		lap('skill')
+
+		return _data_response(request, {
+			'comid': comid,
+			'lead_days': table.lead_days.tolist(),
+			'files': len(table.files),
+			'skill': {model: {name: values.tolist() if name == 'pairs' else _series(values)
+							  for name, values in metrics.items()}
+					  for model, metrics in skill.items()},
+		})
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+@timed_endpoint('reach_at')
+def get_reach_at(request):
+	"""
+	Returns the COMID, watershed, subbasin and region of the drainage line nearest to a clicked lon/lat, looked up in
+	the local drainage_lines file instead of a GeoServer GetFeatureInfo request.
+	"""
+
+	try:
+		get_data = request.GET
+		lon = float(get_data['lon'])
+		lat = float(get_data['lat'])
+		tolerance = float(get_data.get('tolerance', DEFAULT_TOLERANCE))
+
+		drainage_lines = app.get_custom_setting('drainage_lines')
+		if not drainage_lines:
+			return JsonResponse({'error': 'no drainage_lines file configured'}, status=404)
+		lap('settings')
+
+		index = load_reach_index(drainage_lines)
+		lap('index')
+		reach = index.nearest(lon, lat, tolerance)
+		lap('query')
+
+		if reach is None:
+			return JsonResponse({'error': 'no reach within the tolerance'}, status=404)
+		return JsonResponse(reach)
+
+	except Exception as e:
+		exc_type, exc_obj, exc_tb = sys.exc_info()
+		print("error: " + str(e))
+		print("line: " + str(exc_tb.tb_lineno))
+
+		return JsonResponse({
+			'error': f'{"error: " + str(e), "line: " + str(exc_tb.tb_lineno)}',
+		})
+
+
+def get_metrics(request):
+	"""
+	Returns the stage latency histograms and the coalescing counters of this worker process in the Prometheus text
+	format.
+	"""
+	return HttpResponse(registry.exposition(), content_type='text/plain; version=0.0.4')
+
+
+# async versions of the reach views the map requests on every click, running the blocking reads in the bounded
+# executor of offload.py so a few concurrent users do not tie up every worker
+get_hydrographs_async = async_view(get_hydrographs)
+get_time_series_async = async_view(get_time_series)
+get_hydrograph_data_async = async_view(get_hydrograph_data)
+get_time_series_data_async = async_view(get_time_series_data)
+
+
+# warm-up starts from the server post-fork hooks of workers.py, or else on the first request this process serves
+connect_request_started()
@@ -0,0 +1,129 @@
+import os
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+
+class DatasetPool(object):
+	"""
+	Process-wide pool of open SONICS NetCDF datasets.
+
+	Entries are keyed by the absolute file path and validated against the file mtime, and the history store mtime for
+	compacted files, so a forecast file that is rewritten in place is reopened on the next request. The least recently
+	used handle is closed once the pool grows past max_size.
+	"""
+
+	def __init__(self, max_size=8):
+		self.max_size = max_size
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, nc_file):
+		"""
+		Returns an open xarray.Dataset for nc_file, reusing the pooled handle when the file has not changed.
+		"""
+		from .archive import open_archived, archive_version
+
+		path = os.path.abspath(nc_file)
+
+		with self._lock:
+			entry = self._entries.get(path)
+		if entry is not None and entry[0] == archive_version(path, entry[1]):
+			with self._lock:
+				if path in self._entries:
+					self._entries.move_to_end(path)
+			return entry[1]
+
+		dataset = open_archived(path)
+		mtime = archive_version(path, dataset)
+
+		with self._lock:
+			entry = self._entries.pop(path, None)
+			if entry is not None and entry[0] == mtime:
+				# another thread opened the same file meanwhile, keep its handle
+				dataset.close()
+				self._entries[path] = entry
+				return entry[1]
+			if entry is not None:
+				entry[1].close()
+			self._entries[path] = (mtime, dataset)
+			while len(self._entries) > self.max_size:
+				_, (_, evicted) = self._entries.popitem(last=False)
+				evicted.close()
+
+		return dataset
+
+	def clear(self):
+		with self._lock:
+			while self._entries:
+				_, (_, dataset) = self._entries.popitem(last=False)
+				dataset.close()
+
+
+dataset_pool = DatasetPool()
+
+
+def open_forecast(nc_file):
+	"""
+	Returns the pooled dataset for a SONICS forecast file.
+	"""
+	return dataset_pool.get(nc_file)
+
+
+# keyed by id() since datasets are not hashable, entries are dropped when the dataset is garbage collected
+_positions = {}
+
+
+def comid_positions(dataset):
+	"""
+	Returns a dict mapping each comid of dataset, as a string, to its position along the comid dimension.
+	"""
+	positions = _positions.get(id(dataset))
+	if positions is None:
+		positions = {str(comid): i for i, comid in enumerate(dataset['comid'].values.tolist())}
+		_positions[id(dataset)] = positions
+		weakref.finalize(dataset, _positions.pop, id(dataset), None)
+	return positions
+
+
+def select_reaches(dataset, comids):
+	"""
+	Resolves comids to sorted positions along the comid dimension of dataset so they can be read with one isel.
+	Returns:
+	  tuple, (positions, found comids in position order, comids not in the dataset)
+	"""
+	positions = comid_positions(dataset)
+	found = sorted({str(comid) for comid in comids if str(comid) in positions}, key=positions.get)
+	missing = [comid for comid in comids if str(comid) not in positions]
+	return np.array([positions[comid] for comid in found], dtype=int), found, missing
+
+
+ReachSeries = namedtuple('ReachSeries', ['comid', 'time', 'qr', 'time_eta', 'qr_eta', 'time_gfs', 'qr_gfs'])
+
+REACH_VARIABLES = ('qr', 'qr_eta', 'qr_gfs')
+
+
+def read_reach(dataset, comid):
+	"""
+	Reads the historical simulation and the ETA and GFS forecasts of one comid with a single positional selection, or
+	as views of the mapped arrays when dataset is a SharedForecast.
+	Returns:
+	  ReachSeries, float32 flows and datetime64 times as NumPy arrays
+	Raises:
+	  KeyError: comid is not in the dataset
+	"""
+	from .shared import SharedForecast
+
+	if isinstance(dataset, SharedForecast):
+		return dataset.read_reach(comid)
+
+	position = comid_positions(dataset).get(str(comid))
+	if position is None:
+		raise KeyError('comid {0} not found'.format(comid))
+
+	reach = dataset[list(REACH_VARIABLES)].isel(comid=position).load()
+	flows = {name: reach[name].values.astype(np.float32, copy=False) for name in REACH_VARIABLES}
+	return ReachSeries(str(comid), dataset['time'].values, flows['qr'], dataset['time_eta'].values, flows['qr_eta'],
+					   dataset['time_gfs'].values, flows['qr_gfs'])
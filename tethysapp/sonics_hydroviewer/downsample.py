@@ -0,0 +1,93 @@
+import numpy as np
+
+# points of a downsampled historical hydrograph when neither the request nor the settings give a budget
+DEFAULT_POINTS = 2000
+
+# smallest budget accepted from a request
+MIN_POINTS = 10
+
+
+def lttb(x, y, budget):
+	"""
+	Largest-Triangle-Three-Buckets selection of budget points of a series, keeping the first and last points.
+	Args:
+	  x (np.ndarray): increasing float positions
+	  y (np.ndarray): values aligned with x, without NaN
+	  budget (int): number of points to keep
+	Returns:
+	  np.ndarray, sorted positions of the selected points
+	"""
+	n = x.size
+	if budget >= n or budget < 3:
+		return np.arange(n)
+
+	# budget - 2 buckets over the interior points, the bucket means serve as the third point of the triangles
+	edges = np.linspace(1, n - 1, budget - 1).astype(np.int64)
+	counts = np.diff(edges)
+	mean_x = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+	mean_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+
+	selected = np.empty(budget, dtype=np.int64)
+	selected[0], selected[-1] = 0, n - 1
+	a = 0
+	for i in range(budget - 2):
+		start, stop = edges[i], edges[i + 1]
+		if i + 1 < counts.size:
+			next_x, next_y = mean_x[i + 1], mean_y[i + 1]
+		else:
+			next_x, next_y = x[-1], y[-1]
+		area = np.abs((x[a] - next_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (next_y - y[a]))
+		a = start + int(np.argmax(area))
+		selected[i + 1] = a
+	return selected
+
+
+def annual_peaks(times, values):
+	"""
+	Returns the position of the first maximum of every calendar year of a series without NaN.
+	"""
+	if values.size == 0:
+		return np.empty(0, dtype=np.int64)
+	years = times.astype('datetime64[Y]')
+	starts = np.concatenate(([0], np.flatnonzero(years[1:] != years[:-1]) + 1))
+	maxima = np.maximum.reduceat(values, starts)
+	year_of = np.repeat(np.arange(starts.size), np.diff(np.append(starts, values.size)))
+	candidates = np.flatnonzero(values == maxima[year_of])
+	_, first = np.unique(year_of[candidates], return_index=True)
+	return candidates[first]
+
+
+def downsample(times, values, budget):
+	"""
+	Selects at most budget points of a daily series with LTTB, keeping the annual peaks exactly. When the budget
+	cannot hold every annual peak besides the first and last points, the highest peaks are kept instead.
+	Args:
+	  times (np.ndarray): sorted datetime64 values
+	  values (np.ndarray): flows aligned with times, NaN for missing days
+	  budget (int): number of points to keep
+	Returns:
+	  np.ndarray, sorted positions of the selected points
+	"""
+	if times.size <= budget:
+		return np.arange(times.size)
+
+	valid = np.flatnonzero(~np.isnan(values))
+	if valid.size <= budget:
+		return valid
+	x = times[valid].astype('datetime64[s]').astype(np.int64).astype(float)
+	y = values[valid].astype(float)
+	peaks = annual_peaks(times[valid], y)
+	if budget - peaks.size < 3:
+		highest = peaks[np.argsort(-y[peaks], kind='stable')[:max(budget - 2, 0)]]
+		return valid[np.union1d([0, valid.size - 1], highest)[:budget]]
+	selected = lttb(x, y, budget - peaks.size)
+	return valid[np.union1d(selected, peaks)]
+
+
+def time_window(times, start=None, end=None):
+	"""
+	Returns the slice of sorted times within [start, end], either bound being optional.
+	"""
+	first = np.searchsorted(times, start, side='left') if start is not None else 0
+	last = np.searchsorted(times, end, side='right') if end is not None else times.size
+	return slice(first, last)
@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .datasets import open_forecast
+from .return_periods import load_return_period_table, RETURN_PERIODS
+
+# severity 0 means the forecast peak stays under the 2.33 year threshold
+SEVERITY_CLASSES = ('none', '2.33 Year', '5 Year', '10 Year')
+
+# comids read from the forecast file per vectorized block
+BLOCK_SIZE = 8192
+
+# most reaches a region summary ranks
+MAX_TOP_REACHES = 100
+
+
+def severity(peaks, thresholds):
+	"""
+	Classifies forecast peaks against the return period thresholds.
+	Args:
+	  peaks (np.ndarray): forecast peak flow of every comid
+	  thresholds (np.ndarray): thresholds shaped (comid, return period) in RETURN_PERIODS order
+	Returns:
+	  tuple, (severity class index, peak / 2.33 year threshold ratio)
+	The class is that of the longest return period whose threshold the peak reaches, so a missing (NaN) threshold
+	never lowers it. A NaN peak, or a reach without thresholds, is class 0, and the ratio is NaN without a peak or a
+	2.33 year threshold.
+	"""
+	order = np.argsort(RETURN_PERIODS)
+	exceeded = peaks[:, None] >= thresholds[:, order]
+	classes = np.where(exceeded.any(axis=1), order.size - np.argmax(exceeded[:, ::-1], axis=1), 0).astype(np.int8)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		ratio = (peaks / thresholds[:, order[0]]).astype(np.float32)
+	return classes, ratio
+
+
+def top_reaches(table, positions, n):
+	"""
+	Returns the n positions among positions with the highest severity class, ties broken by the highest peak ratio,
+	reaches without a ratio last.
+	"""
+	classes = table.classes[positions].astype(np.int16)
+	ratios = np.nan_to_num(table.ratios[positions], nan=-np.inf)
+	return positions[np.lexsort((-ratios, -classes))[:n]]
+
+
+class ExceedanceTable(object):
+	"""
+	Severity class and peak ratio of the ETA and GFS forecast peaks of every comid in one forecast file.
+	"""
+
+	def __init__(self, comids, classes, ratios):
+		self.comids = comids
+		self.classes = classes
+		self.ratios = ratios
+
+	@classmethod
+	def build(cls, nc_file, workspace):
+		dataset = open_forecast(nc_file)
+		comids = dataset['comid'].values
+		peaks = np.empty(comids.size, dtype=np.float32)
+
+		for start in range(0, comids.size, BLOCK_SIZE):
+			block = dataset[['qr_eta', 'qr_gfs']].isel(comid=slice(start, start + BLOCK_SIZE))
+			peaks[start:start + BLOCK_SIZE] = np.fmax(
+				np.fmax.reduce(block['qr_eta'].transpose('comid', ...).values, axis=1),
+				np.fmax.reduce(block['qr_gfs'].transpose('comid', ...).values, axis=1))
+
+		thresholds = load_return_period_table(nc_file, workspace).values
+		return cls(comids, *severity(peaks, thresholds))
+
+	def save(self, path):
+		tmp_path = path + '.tmp.npz'
+		np.savez(tmp_path, comids=self.comids, classes=self.classes, ratios=self.ratios)
+		os.replace(tmp_path, path)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as table:
+			return cls(table['comids'], table['classes'], table['ratios'])
+
+
+def table_path(nc_file, workspace):
+	name = os.path.splitext(os.path.basename(nc_file))[0]
+	return os.path.join(workspace, 'exceedance', name + '.npz')
+
+
+def build_exceedance_table(nc_file, workspace):
+	"""
+	Ingest step: classifies the forecast peaks of every comid of nc_file and stores the table in the workspace.
+	"""
+	path = table_path(nc_file, workspace)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	table = ExceedanceTable.build(nc_file, workspace)
+	table.save(path)
+	return table
+
+
+_tables = OrderedDict()
+_tables_lock = threading.Lock()
+
+# serializes the loads and builds without blocking lookups of loaded tables
+_build_lock = threading.Lock()
+
+
+def _cached_table(path, mtime):
+	with _tables_lock:
+		entry = _tables.get(path)
+		if entry is not None and entry[0] == mtime:
+			_tables.move_to_end(path)
+			return entry[1]
+	return None
+
+
+def load_exceedance_table(nc_file, workspace, max_tables=4):
+	"""
+	Returns the exceedance table of nc_file, building it on first use when the ingest step has not run yet.
+	"""
+	path = table_path(nc_file, workspace)
+	mtime = os.path.getmtime(nc_file)
+	table = _cached_table(path, mtime)
+	if table is not None:
+		return table
+
+	with _build_lock:
+		# another request may have loaded it while this one waited
+		table = _cached_table(path, mtime)
+		if table is not None:
+			return table
+
+		if os.path.exists(path) and os.path.getmtime(path) >= mtime:
+			table = ExceedanceTable.load(path)
+		else:
+			table = build_exceedance_table(nc_file, workspace)
+
+		with _tables_lock:
+			_tables[path] = (mtime, table)
+			while len(_tables) > max_tables:
+				_tables.popitem(last=False)
+
+	return table
@@ -0,0 +1,209 @@
+import io
+import os
+import zipfile
+import tempfile
+
+import numpy as np
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+
+# rows formatted per chunk of a streamed CSV
+CSV_CHUNK_ROWS = 4096
+
+# reaches read per selection in the bulk exports
+EXPORT_BLOCK_SIZE = 256
+
+EXPORT_VARIABLES = ('qr', 'qr_eta', 'qr_gfs')
+
+
+def format_times(times):
+	"""
+	Formats datetime64 values like pandas does in to_csv, dropping the time of day when every value is at midnight.
+	"""
+	times = np.asarray(times, dtype='datetime64[s]')
+	if np.all(times == times.astype('datetime64[D]')):
+		return np.datetime_as_string(times, unit='D')
+	return np.char.replace(np.datetime_as_string(times, unit='s'), 'T', ' ')
+
+
+def format_values(values):
+	values = np.asarray(values)
+	return np.where(np.isnan(values), '', values.astype(str))
+
+
+def iter_csv(index_name, times, columns, chunk_rows=CSV_CHUNK_ROWS):
+	"""
+	Yields a CSV document chunk by chunk straight from the arrays.
+	Args:
+	  index_name (str): header of the time column
+	  times (np.ndarray): datetime64 values of the rows
+	  columns (list): (header, values) pairs, values aligned with times
+	"""
+	yield ','.join([index_name] + [name for name, _ in columns]) + '\n'
+	for start in range(0, len(times), chunk_rows):
+		stop = start + chunk_rows
+		fields = [format_times(times[start:stop])] + [format_values(values[start:stop]) for _, values in columns]
+		yield ''.join(','.join(row) + '\n' for row in zip(*fields))
+
+
+def csv_response(filename, index_name, times, columns):
+	response = StreamingHttpResponse(iter_csv(index_name, times, columns), content_type='text/csv')
+	response['Content-Disposition'] = 'attachment; filename={0}.csv'.format(filename)
+	return response
+
+
+def parquet_response(filename, index_name, times, columns):
+	import pandas as pd
+
+	dataframe = pd.DataFrame({name: values for name, values in columns}, index=pd.DatetimeIndex(times, name=index_name))
+	buffer = io.BytesIO()
+	dataframe.to_parquet(buffer)
+
+	response = HttpResponse(buffer.getvalue(), content_type='application/vnd.apache.parquet')
+	response['Content-Disposition'] = 'attachment; filename={0}.parquet'.format(filename)
+	return response
+
+
+def export_response(request, filename, index_name, times, columns):
+	"""
+	Returns the series as a streamed CSV, or as a Parquet file when the request asks for format=parquet and pyarrow
+	is installed.
+	"""
+	if request.GET.get('format') == 'parquet':
+		try:
+			import pyarrow
+		except ImportError:
+			return JsonResponse({'error': 'format=parquet is not available, pyarrow is not installed'}, status=400)
+		return parquet_response(filename, index_name, times, columns)
+	return csv_response(filename, index_name, times, columns)
+
+
+def outer_join(*series):
+	"""
+	Aligns (times, values) pairs on the union of their times, filling the gaps with NaN.
+	Returns:
+	  tuple, (times, [values aligned with times, ...])
+	"""
+	times = np.unique(np.concatenate([t for t, _ in series]))
+	aligned = []
+	for t, values in series:
+		column = np.full(times.shape, np.nan, dtype=np.result_type(np.asarray(values).dtype, np.float32))
+		column[np.searchsorted(times, t)] = values
+		aligned.append(column)
+	return times, aligned
+
+
+class _ChunkSink(io.RawIOBase):
+	"""
+	Unseekable file object collecting what zipfile writes, so the archive can be yielded as it is built.
+	"""
+
+	def __init__(self):
+		self._chunks = []
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		self._chunks.append(bytes(data))
+		return len(data)
+
+	def drain(self):
+		data = b''.join(self._chunks)
+		self._chunks = []
+		return data
+
+
+def iter_zip(members):
+	"""
+	Yields a zip archive as it is written.
+	Args:
+	  members (iterable): (name, iterator of str chunks) pairs, written one after the other
+	"""
+	sink = _ChunkSink()
+	with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+		for name, chunks in members:
+			with archive.open(name, 'w', force_zip64=True) as member:
+				for chunk in chunks:
+					member.write(chunk.encode('utf-8'))
+					data = sink.drain()
+					if data:
+						yield data
+	yield sink.drain()
+
+
+def _time_dimension(array):
+	return [dim for dim in array.dims if dim != 'comid'][0]
+
+
+def iter_reaches_csv(dataset, variable, positions, block_size=EXPORT_BLOCK_SIZE):
+	"""
+	Yields the series of variable for the reaches at positions as a long format CSV (comid, Datetime, Streamflow),
+	reading one block of reaches per selection.
+	"""
+	array = dataset[variable]
+	times = format_times(dataset[_time_dimension(array)].values)
+	comids = dataset['comid'].values
+
+	yield 'comid,Datetime,Streamflow (m3/s)\n'
+	for start in range(0, len(positions), block_size):
+		block = positions[start:start + block_size]
+		values = array.isel(comid=block).transpose('comid', ...).values
+		for comid, row in zip(comids[block].tolist(), values):
+			prefix = '{0},'.format(comid)
+			yield ''.join(prefix + t + ',' + v + '\n' for t, v in zip(times, format_values(row)))
+
+
+def zip_response(dataset, positions, filename):
+	"""
+	Streams a zip with one long format CSV per variable of EXPORT_VARIABLES for the reaches at positions.
+	"""
+	members = ((variable + '.csv', iter_reaches_csv(dataset, variable, positions)) for variable in EXPORT_VARIABLES)
+	response = StreamingHttpResponse(iter_zip(members), content_type='application/zip')
+	response['Content-Disposition'] = 'attachment; filename={0}.zip'.format(filename)
+	return response
+
+
+def write_subset_netcdf(dataset, positions, path, block_size=EXPORT_BLOCK_SIZE):
+	"""
+	Writes the EXPORT_VARIABLES of the reaches at positions to a comid-major NetCDF file one block at a time.
+	"""
+	import netCDF4 as nc
+
+	with nc.Dataset(path, 'w', format='NETCDF4') as out:
+		out.createDimension('comid', len(positions))
+		comid = out.createVariable('comid', dataset['comid'].dtype, ('comid',))
+		comid[:] = dataset['comid'].values[positions]
+
+		for variable in EXPORT_VARIABLES:
+			array = dataset[variable]
+			time_dim = _time_dimension(array)
+			if time_dim not in out.dimensions:
+				times = dataset[time_dim].values
+				out.createDimension(time_dim, times.size)
+				time = out.createVariable(time_dim, 'f8', (time_dim,))
+				time.units = 'seconds since 1970-01-01 00:00:00'
+				time.calendar = 'standard'
+				time[:] = (times - np.datetime64('1970-01-01')) / np.timedelta64(1, 's')
+
+			out_variable = out.createVariable(variable, 'f4', ('comid', time_dim), fill_value=np.float32(np.nan),
+											  chunksizes=(1, out.dimensions[time_dim].size))
+			out_variable.units = 'm3/s'
+			for start in range(0, len(positions), block_size):
+				block = positions[start:start + block_size]
+				out_variable[start:start + len(block)] = array.isel(comid=block).transpose('comid', ...).values
+
+
+def netcdf_response(dataset, positions, filename):
+	"""
+	Streams a subset NetCDF file with the reaches at positions, written to a temporary file first. The file is
+	unlinked once opened, so its space is freed when the response closes the handle, whether or not it is streamed.
+	"""
+	fd, path = tempfile.mkstemp(suffix='.nc')
+	os.close(fd)
+	try:
+		write_subset_netcdf(dataset, positions, path)
+		f = open(path, 'rb')
+	finally:
+		os.remove(path)
+
+	return FileResponse(f, content_type='application/x-netcdf', as_attachment=True, filename='{0}.nc'.format(filename))
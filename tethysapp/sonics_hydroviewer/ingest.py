@@ -0,0 +1,42 @@
+"""
+Precomputation run when a new SONICS forecast file lands in the forecast folder.
+
+Usage:
+    python -m tethysapp.sonics_hydroviewer.ingest <forecast_file.nc> <app_workspace>
+"""
+import sys
+import argparse
+
+from .return_periods import build_return_period_table
+from .store import build_reach_store
+from .exceedance import build_exceedance_table
+from .climatology import build_climatology
+from .regions import build_region_membership
+from .shared import build_shared_forecast
+from .boundaries import update_region_boundaries
+
+
+def ingest_forecast(nc_file, workspace):
+	"""
+	Runs every ingest step for nc_file, storing the results in the app workspace.
+	"""
+	build_reach_store(nc_file, workspace)
+	build_return_period_table(nc_file, workspace)
+	build_exceedance_table(nc_file, workspace)
+	build_climatology(nc_file, workspace)
+	build_region_membership(nc_file, workspace)
+	build_shared_forecast(nc_file, workspace)
+	update_region_boundaries(workspace)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Precompute SONICS Hydroviewer tables for a forecast file.')
+	parser.add_argument('nc_file', help='PISCO_HyD_ARNOVIC forecast file')
+	parser.add_argument('workspace', help='app workspace directory')
+	args = parser.parse_args(argv)
+
+	ingest_forecast(args.nc_file, args.workspace)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,196 @@
+import os
+import time
+import random
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+
+from .app import SonicsHydroviewer as app
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# profiles kept in the workspace, the oldest are removed past this count
+MAX_PROFILES = 100
+
+
+class Histogram(object):
+	"""
+	Cumulative latency histogram with the BUCKETS bounds, in the layout of a Prometheus histogram.
+	"""
+
+	def __init__(self):
+		self.counts = [0] * len(BUCKETS)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, seconds):
+		for i, bound in enumerate(BUCKETS):
+			if seconds <= bound:
+				self.counts[i] += 1
+		self.sum += seconds
+		self.count += 1
+
+
+class Registry(object):
+	"""
+	Latency histograms of the process keyed by (endpoint, stage), and event counters keyed by (counter, endpoint).
+	"""
+
+	def __init__(self):
+		self._histograms = {}
+		self._counters = {}
+		self._lock = threading.Lock()
+
+	def increment(self, counter, endpoint, amount=1):
+		with self._lock:
+			self._counters[(counter, endpoint)] = self._counters.get((counter, endpoint), 0) + amount
+
+	def count(self, counter, endpoint):
+		with self._lock:
+			return self._counters.get((counter, endpoint), 0)
+
+	def observe(self, endpoint, stage, seconds):
+		with self._lock:
+			histogram = self._histograms.get((endpoint, stage))
+			if histogram is None:
+				histogram = self._histograms[(endpoint, stage)] = Histogram()
+			histogram.observe(seconds)
+
+	def exposition(self, name='sonics_hydroviewer_stage_seconds', prefix='sonics_hydroviewer_'):
+		"""
+		Returns the histograms and counters in the Prometheus text exposition format.
+		"""
+		lines = [
+			'# HELP {0} Latency of the controller stages.'.format(name),
+			'# TYPE {0} histogram'.format(name),
+		]
+		with self._lock:
+			for (endpoint, stage), histogram in sorted(self._histograms.items()):
+				labels = 'endpoint="{0}",stage="{1}"'.format(endpoint, stage)
+				for bound, count in zip(BUCKETS, histogram.counts):
+					le = '+Inf' if bound == float('inf') else repr(bound)
+					lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, le, count))
+				lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, repr(histogram.sum)))
+				lines.append('{0}_count{{{1}}} {2}'.format(name, labels, histogram.count))
+			for counter in sorted({counter for counter, _ in self._counters}):
+				lines.append('# TYPE {0}{1}_total counter'.format(prefix, counter))
+				for (other, endpoint), value in sorted(self._counters.items()):
+					if other == counter:
+						lines.append('{0}{1}_total{{endpoint="{2}"}} {3}'.format(prefix, counter, endpoint, value))
+		return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+_local = threading.local()
+
+
+class RequestTimer(object):
+	"""
+	Durations of the stages of one request, in the order they ran.
+	"""
+
+	def __init__(self):
+		self.stages = []
+		self.last = time.perf_counter()
+
+	def add(self, stage, seconds):
+		self.stages.append((stage, seconds))
+		self.last = time.perf_counter()
+
+	def lap(self, stage):
+		self.add(stage, time.perf_counter() - self.last)
+
+	def server_timing(self):
+		return ', '.join('{0};dur={1:.1f}'.format(stage, seconds * 1000) for stage, seconds in self.stages)
+
+
+def lap(name):
+	"""
+	Records the time since the previous stage ended, or since the request started, as a stage of the request being
+	served by this thread. Controllers call it after each phase.
+	"""
+	timer = getattr(_local, 'timer', None)
+	if timer is not None:
+		timer.lap(name)
+
+
+@contextmanager
+def stage(name):
+	"""
+	Times the enclosed block as a stage of the request being served by this thread, doing nothing outside of one.
+	"""
+	timer = getattr(_local, 'timer', None)
+	if timer is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		timer.add(name, time.perf_counter() - start)
+
+
+_sample_rate = None
+
+
+def profile_sample_rate():
+	global _sample_rate
+	if _sample_rate is None:
+		_sample_rate = app.get_custom_setting('profile_sample_rate') or 0.0
+	return _sample_rate
+
+
+def _save_profile(profiler, endpoint):
+	directory = os.path.join(app.get_app_workspace().path, 'profiles')
+	os.makedirs(directory, exist_ok=True)
+	name = '{0}-{1:.0f}-{2}.prof'.format(endpoint, time.time() * 1000, os.getpid())
+	profiler.dump_stats(os.path.join(directory, name))
+
+	profiles = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.prof')),
+					  key=lambda entry: entry.stat().st_mtime)
+	for entry in profiles[:max(len(profiles) - MAX_PROFILES, 0)]:
+		try:
+			os.remove(entry.path)
+		except OSError:
+			pass
+
+
+def timed_endpoint(endpoint):
+	"""
+	Times a controller and the stages it marks with lap() or stage(), returning them in a Server-Timing header and adding them
+	to the latency histograms. A profile_sample_rate share of the requests is profiled with cProfile, the stats being
+	saved to the profiles folder of the app workspace.
+	"""
+
+	def decorator(controller):
+		@functools.wraps(controller)
+		def wrapper(request, *args, **kwargs):
+			timer = _local.timer = RequestTimer()
+			profiler = cProfile.Profile() if random.random() < profile_sample_rate() else None
+			start = time.perf_counter()
+			try:
+				if profiler is not None:
+					response = profiler.runcall(controller, request, *args, **kwargs)
+				else:
+					response = controller(request, *args, **kwargs)
+			finally:
+				_local.timer = None
+			timer.add('total', time.perf_counter() - start)
+
+			for name, seconds in timer.stages:
+				registry.observe(endpoint, name, seconds)
+			response['Server-Timing'] = timer.server_timing()
+
+			if profiler is not None:
+				try:
+					_save_profile(profiler, endpoint)
+				except OSError as e:
+					print("profile error: " + str(e))
+			return response
+
+		return wrapper
+
+	return decorator
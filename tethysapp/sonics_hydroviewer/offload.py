@@ -0,0 +1,53 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .app import SonicsHydroviewer as app
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+	"""
+	Returns the executor running the blocking work of the async views, its size capped by the max_blocking_workers
+	custom setting.
+	"""
+	global _executor
+	with _executor_lock:
+		if _executor is None:
+			workers = app.get_custom_setting('max_blocking_workers') or 8
+			_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sonics-blocking')
+	return _executor
+
+
+def _call(func, *args, **kwargs):
+	try:
+		return func(*args, **kwargs)
+	finally:
+		# what Django does when a request finishes, for the connections the settings lookups opened in this thread
+		close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+	"""
+	Runs func in the bounded executor without blocking the event loop.
+	"""
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(get_executor(), functools.partial(_call, func, *args, **kwargs))
+
+
+def async_view(view):
+	"""
+	Returns an async version of a sync controller, which runs it, NetCDF reads and return period fits included, in
+	the bounded executor so the event loop keeps serving other requests meanwhile.
+	"""
+
+	@functools.wraps(view)
+	async def wrapper(request, *args, **kwargs):
+		return await run_blocking(view, request, *args, **kwargs)
+
+	return wrapper
@@ -64,11 +64,181 @@ function init_map() {
     });
 }
 
+function max_value(values) {
+    return values.reduce(function (a, b) { return (b !== null && b > a) ? b : a; }, -Infinity);
+}
+
+function return_period_traces(return_periods, x_start, x_end, max_visible) {
+    var r2_33 = Math.trunc(return_periods['return_period_2_33']);
+    var r5 = Math.trunc(return_periods['return_period_5']);
+    var r10 = Math.trunc(return_periods['return_period_10']);
+    var visible = max_visible > r2_33 ? true : 'legendonly';
+    var x_vals = [x_start, x_end, x_end, x_start];
+    var top = Math.max(r10 + r10 * 0.05, max_visible);
+
+    function template(name, y, color, fill) {
+        return {
+            name: name,
+            x: x_vals,
+            y: y,
+            type: 'scatter',
+            legendgroup: 'returnperiods',
+            fill: fill || 'toself',
+            visible: visible,
+            line: {color: color, width: 0}
+        };
+    }
+
+    return [
+        template('Return Periods', [r10 * 0.05, r10 * 0.05, r10 * 0.05, r10 * 0.05], 'rgba(0,0,0,0)', 'none'),
+        template('2.33 Year: ' + r2_33, [r2_33, r2_33, r5, r5], 'rgba(243, 255, 0, .4)'),
+        template('5 Year: ' + r5, [r5, r5, r10, r10], 'rgba(255, 165, 0, .4)'),
+        template('10 Year: ' + r10, [r10, r10, top, top], 'rgba(255, 0, 0, .4)')
+    ];
+}
+
+function plot_hydrograph(data, params) {
+    var traces = [{
+        name: 'Historical Simulation',
+        x: data.time,
+        y: data.flow,
+        type: 'scatter',
+        line: {color: 'blue'}
+    }];
+    traces = traces.concat(return_period_traces(data.return_periods, data.time[0], data.time[data.time.length - 1],
+                                                max_value(data.flow)));
+
+    Plotly.newPlot('hydrographs-chart', traces, {
+        title: 'Historical Simulation at ' + data.comid,
+        xaxis: {title: 'Date (UTC +0:00)', type: 'date', autorange: true},
+        yaxis: {title: 'Streamflow (m<sup>3</sup>/s)', autorange: true},
+        showlegend: true
+    });
+
+    // the server sends a downsampled overview, zooming in fetches the visible window at full resolution
+    var chart = document.getElementById('hydrographs-chart');
+    chart.removeAllListeners('plotly_relayout');
+    chart.on('plotly_relayout', function (event) {
+        if (event['xaxis.autorange']) {
+            Plotly.restyle(chart, {x: [data.time], y: [data.flow]}, [0]);
+            return;
+        }
+        if (!data.downsampled || event['xaxis.range[0]'] === undefined) {
+            return;
+        }
+        $.getJSON('get-hydrograph-data-async', $.extend({}, params, {
+            start: event['xaxis.range[0]'],
+            end: event['xaxis.range[1]']
+        }), function (zoomed) {
+            if (zoomed.error || zoomed.time.length == 0) {
+                return;
+            }
+            var start = zoomed.time[0];
+            var end = zoomed.time[zoomed.time.length - 1];
+            // overview points before and after the window around the full resolution ones
+            var x = [], y = [];
+            var i;
+            for (i = 0; i < data.time.length && data.time[i] < start; i++) {
+                x.push(data.time[i]);
+                y.push(data.flow[i]);
+            }
+            x = x.concat(zoomed.time);
+            y = y.concat(zoomed.flow);
+            for (; i < data.time.length; i++) {
+                if (data.time[i] > end) {
+                    x.push(data.time[i]);
+                    y.push(data.flow[i]);
+                }
+            }
+            Plotly.restyle(chart, {x: [x], y: [y]}, [0]);
+        });
+    });
+}
+
+function climatology_traces(climatology) {
+    // day of year percentiles of the historical simulation, drawn as bands behind the forecasts
+    function band(name, lower, upper, color) {
+        return [{
+            x: climatology.time,
+            y: climatology[lower],
+            type: 'scatter',
+            mode: 'lines',
+            line: {width: 0},
+            legendgroup: name,
+            showlegend: false,
+            hoverinfo: 'skip'
+        }, {
+            name: name,
+            x: climatology.time,
+            y: climatology[upper],
+            type: 'scatter',
+            mode: 'lines',
+            fill: 'tonexty',
+            fillcolor: color,
+            line: {width: 0},
+            legendgroup: name
+        }];
+    }
+
+    return band('10th - 90th percentile', 'p10', 'p90', 'rgba(120, 120, 120, .15)')
+        .concat(band('25th - 75th percentile', 'p25', 'p75', 'rgba(120, 120, 120, .3)'))
+        .concat([{
+            name: 'Median',
+            x: climatology.time,
+            y: climatology.p50,
+            type: 'scatter',
+            mode: 'lines',
+            line: {color: 'rgb(90, 90, 90)', dash: 'dot'}
+        }]);
+}
+
+function plot_forecast(data) {
+    var traces = [{
+        name: 'GFS Forecast',
+        x: data.time_gfs,
+        y: data.gfs,
+        type: 'scatter',
+        line: {color: 'black', dash: 'dash'}
+    }, {
+        name: 'ETA Forecast',
+        x: data.time_eta,
+        y: data.eta,
+        type: 'scatter',
+        line: {color: 'blue', dash: 'dash'}
+    }];
+    var x_start = data.time_gfs[0];
+    var x_end = data.time_gfs[data.time_gfs.length - 1];
+    var max_visible = Math.max(max_value(data.gfs), max_value(data.eta));
+
+    if (data.time_records.length > 0) {
+        traces.push({
+            name: '1st days forecasts',
+            x: data.time_records,
+            y: data.records,
+            type: 'scatter',
+            line: {color: '#FFA15A'}
+        });
+        x_start = data.time_records[0];
+        max_visible = Math.max(max_value(data.records), max_visible);
+    }
+    traces = traces.concat(return_period_traces(data.return_periods, x_start, x_end, max_visible));
+    if (data.climatology) {
+        traces = climatology_traces(data.climatology).concat(traces);
+    }
+
+    Plotly.newPlot('forecast-chart', traces, {
+        title: 'SONICS Forecast at ' + data.comid,
+        xaxis: {title: 'Dates', type: 'date', autorange: true},
+        yaxis: {title: 'Streamflow (m<sup>3</sup>/s)', autorange: true},
+        showlegend: true
+    });
+}
+
 function get_hydrographs (watershed, subbasin, region, comid) {
 	$('#hydrographs-loading').removeClass('hidden');
 	m_downloaded_historical_streamflow = true;
     $.ajax({
-        url: 'get-hydrographs',
+        url: 'get-hydrograph-data-async',
         type: 'GET',
         data: {
             'watershed': watershed,
@@ -94,13 +264,11 @@ function get_hydrographs (watershed, subbasin, region, comid) {
                 $('#dates').removeClass('hidden');
                 $loading.addClass('hidden');
                 $('#hydrographs-chart').removeClass('hidden');
-                $('#hydrographs-chart').html(data);
-
-                //resize main graph
-                Plotly.Plots.resize($("#hydrographs-chart .js-plotly-plot")[0]);
-                Plotly.relayout($("#hydrographs-chart .js-plotly-plot")[0], {
-                	'xaxis.autorange': true,
-                	'yaxis.autorange': true
+                plot_hydrograph(data, {
+                    watershed: watershed,
+                    subbasin: subbasin,
+                    region: region,
+                    comid: comid
                 });
 
                 var params_sim = {
@@ -141,7 +309,7 @@ function get_time_series(watershed, subbasin, region, comid, startdate) {
     $('#dates').addClass('hidden');
     $.ajax({
     	type: 'GET',
-        url: 'get-time-series/',
+        url: 'get-time-series-data-async/',
         data: {
             'watershed': watershed,
             'subbasin': subbasin,
@@ -167,14 +335,7 @@ function get_time_series(watershed, subbasin, region, comid, startdate) {
                 $('#dates').removeClass('hidden');
                 //$loading.addClass('hidden');
                 $('#forecast-chart').removeClass('hidden');
-                $('#forecast-chart').html(data);
-
-                //resize main graph
-                Plotly.Plots.resize($("#forecast-chart .js-plotly-plot")[0]);
-                Plotly.relayout($("#forecast-chart .js-plotly-plot")[0], {
-                	'xaxis.autorange': true,
-                	'yaxis.autorange': true
-                });
+                plot_forecast(data);
 
                 var params = {
                     watershed: watershed,
@@ -232,6 +393,20 @@ function map_events() {
 		map.getTargetElement().style.cursor = hit ? 'pointer' : '';
 	});
 
+	function show_reach(properties) {
+		watershed = properties["watershed"];
+		subbasin = properties["subbasin"];
+		region = properties["region"];
+		comid = properties["COMID"];
+		var startdate = '';
+		$("#stream-info").append('<h3 id="Watershed-Tab">Watershed: '+ watershed
+					+ '</h3><h5 id="Subbasin-Tab">Subbassin: '
+					+ subbasin + '</h3><h5 id="Region-Tab">Region: '
+					+ region+ '</h5><h5>COMID: '+ comid + '</h5>');
+		get_hydrographs (watershed, subbasin, region, comid);
+		get_time_series(watershed, subbasin, region, comid, startdate);
+	}
+
 	map.on("singleclick", function(evt) {
 
 	    if (map.getTargetElement().style.cursor == "pointer") {
@@ -239,37 +414,47 @@ function map_events() {
 	        var view = map.getView();
 			var viewResolution = view.getResolution();
 			var wms_url = current_layer.getSource().getGetFeatureInfoUrl(evt.coordinate, viewResolution, view.getProjection(), { 'INFO_FORMAT': 'application/json' });
-
-			if (wms_url) {
-			    $("#obsgraph").modal('show');
-			    $('#hydrographs-chart').addClass('hidden');
-			    $('#hydrographs-loading').removeClass('hidden');
-			    $('#download_simulated_discharge').addClass('hidden');
-			    $("#stream-info").empty()
-
-			    $.ajax({
-					type: "GET",
-					url: wms_url,
-					dataType: 'json',
-					success: function (result) {
-					    watershed = result["features"][0]["properties"]["watershed"];
-		         		subbasin = result["features"][0]["properties"]["subbasin"];
-		         		region = result["features"][0]["properties"]["region"];
-		         		comid = result["features"][0]["properties"]["COMID"];
-		         		var startdate = '';
-		         		$("#stream-info").append('<h3 id="Watershed-Tab">Watershed: '+ watershed
-                        			+ '</h3><h5 id="Subbasin-Tab">Subbassin: '
-                        			+ subbasin + '</h3><h5 id="Region-Tab">Region: '
-                        			+ region+ '</h5><h5>COMID: '+ comid + '</h5>');
-                        get_hydrographs (watershed, subbasin, region, comid);
-                        get_time_series(watershed, subbasin, region, comid, startdate);
-					},
-					error: function(e){
-                      console.log(e);
-                    }
-				});
-
-			}
+			var lonlat = ol.proj.toLonLat(evt.coordinate, view.getProjection());
+			// about 5 pixels at the current zoom, in degrees
+			var tolerance = 5 * viewResolution / 111320;
+
+		    $("#obsgraph").modal('show');
+		    $('#hydrographs-chart').addClass('hidden');
+		    $('#hydrographs-loading').removeClass('hidden');
+		    $('#download_simulated_discharge').addClass('hidden');
+		    $("#stream-info").empty()
+
+			// the local spatial index answers without a GeoServer round trip, GetFeatureInfo is the fallback
+		    $.ajax({
+				type: "GET",
+				url: 'get-reach-at/',
+				data: {lon: lonlat[0], lat: lonlat[1], tolerance: tolerance},
+				dataType: 'json',
+				success: function (result) {
+					if (result["error"]) {
+						this.error(result);
+					} else {
+						show_reach(result);
+					}
+				},
+				error: function(e){
+					if (!wms_url) {
+						console.log(e);
+						return;
+					}
+					$.ajax({
+						type: "GET",
+						url: wms_url,
+						dataType: 'json',
+						success: function (result) {
+							show_reach(result["features"][0]["properties"]);
+						},
+						error: function(e){
+	                      console.log(e);
+	                    }
+					});
+				}
+			});
 
 	    }
 
@@ -283,6 +468,7 @@ $(function() {
 
     init_map();
     map_events();
+    showFloodExceedance('');
 
     $('#datesSelect').change(function() { //when date is changed
 
@@ -296,42 +482,113 @@ $(function() {
 
         $loading.removeClass('hidden');
         get_time_series(watershed, subbasin, region, comid, startdate)
+        showFloodExceedance(startdate);
 
     });
 });
 
-function getRegionGeoJsons() {
+var region_bounds = null;
 
-    let geojsons = region_index[$("#regions").val()]['geojsons'];
-    for (let i in geojsons) {
-        var regionsSource = new ol.source.Vector({
-           url: staticGeoJSON + geojsons[i],
-           format: new ol.format.GeoJSON()
-        });
+function showRegion(region) {
+    // zoom to the precomputed extent first, then load the boundary simplified for the resulting zoom
+    var extent = ol.proj.transformExtent(region_bounds[region], 'EPSG:4326', map.getView().getProjection());
+    map.getView().fit(extent, map.getSize());
+
+    var regionsSource = new ol.source.Vector({
+        url: 'get-region-boundary/?' + jQuery.param({region: region, zoom: Math.round(map.getView().getZoom())}),
+        format: new ol.format.TopoJSON()
+    });
+
+    var regionStyle = new ol.style.Style({
+        stroke: new ol.style.Stroke({
+            color: 'red',
+            width: 3
+        })
+    });
+
+    var regionsLayer = new ol.layer.Vector({
+        name: 'myRegion',
+        source: regionsSource,
+        style: regionStyle
+    });
 
-        var regionStyle = new ol.style.Style({
-            stroke: new ol.style.Stroke({
-                color: 'red',
-                width: 3
-            })
+    map.getLayers().forEach(function(layer) {
+        if (layer && layer.get('name') == 'myRegion')
+            map.removeLayer(layer);
+    });
+    map.addLayer(regionsLayer);
+}
+
+function showRegionSummary(region) {
+    $('#region-summary').empty();
+    $.getJSON('get-region-summary/', {region: region, n: 5}, function(summary) {
+        if (summary['error']) {
+            return;
+        }
+        var counts = summary['classes'].slice(1).map(function(name, i) {
+            return name + ': ' + summary['severity_counts'][i + 1];
         });
+        var rows = summary['comids'].map(function(comid, i) {
+            return '<tr><td>' + comid + '</td><td>' + summary['classes'][summary['severity'][i]] + '</td><td>'
+                + summary['peak_ratio'][i] + '</td></tr>';
+        });
+        $('#region-summary').append('<p>' + summary['reaches'] + ' reaches, ' + counts.join(', ') + '</p>'
+            + '<table class="table table-condensed"><tr><th>COMID</th><th>Severity</th><th>Peak / 2.33 Year</th></tr>'
+            + rows.join('') + '</table>');
+    });
+}
+
+// marker colors of the severity classes, as in the return period bands of the charts
+var severity_colors = [null, 'rgb(243, 255, 0)', 'rgb(255, 165, 0)', 'rgb(255, 0, 0)'];
 
-        var regionsLayer = new ol.layer.Vector({
-            name: 'myRegion',
-            source: regionsSource,
-            style: regionStyle
+function showFloodExceedance(startdate) {
+    // one request styles every reach whose forecast reaches a return period, drawn over the drainage lines
+    $.getJSON('get-flood-exceedance/', {startdate: startdate || '', min_severity: 1, coordinates: 1}, function(data) {
+        if (data['error']) {
+            return;
+        }
+        var projection = map.getView().getProjection();
+        var features = data['comids'].map(function(comid, i) {
+            return new ol.Feature({
+                geometry: new ol.geom.Point(ol.proj.fromLonLat([data['lon'][i], data['lat'][i]], projection)),
+                comid: comid,
+                severity: data['severity'][i]
+            });
+        });
+        var styles = severity_colors.map(function(color) {
+            return color && new ol.style.Style({
+                image: new ol.style.Circle({
+                    radius: 4,
+                    fill: new ol.style.Fill({color: color}),
+                    stroke: new ol.style.Stroke({color: 'rgba(0, 0, 0, .6)', width: 1})
+                })
+            });
         });
 
-        map.getLayers().forEach(function(regionsLayer) {
-        if (regionsLayer.get('name')=='myRegion')
-            map.removeLayer(regionsLayer);
+        map.getLayers().forEach(function(layer) {
+            if (layer && layer.get('name') == 'floodExceedance')
+                map.removeLayer(layer);
         });
-        map.addLayer(regionsLayer)
+        map.addLayer(new ol.layer.Vector({
+            name: 'floodExceedance',
+            source: new ol.source.Vector({features: features}),
+            style: function(feature) {
+                return styles[feature.get('severity')];
+            }
+        }));
+    });
+}
 
-        setTimeout(function() {
-            var myExtent = regionsLayer.getSource().getExtent();
-            map.getView().fit(myExtent, map.getSize());
-        }, 500);
+function getRegionGeoJsons() {
+    let region = $("#regions").val();
+    showRegionSummary(region);
+    if (region_bounds) {
+        showRegion(region);
+    } else {
+        $.getJSON('get-region-bounds/', function(bounds) {
+            region_bounds = bounds;
+            showRegion(region);
+        });
     }
 }
 
@@ -0,0 +1,81 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+# attributes of the drainage lines returned for a reach, as named in the GeoServer layer
+REACH_ATTRIBUTES = ('COMID', 'watershed', 'subbasin', 'region')
+
+# search radius in degrees when the request gives none, about 1 km
+DEFAULT_TOLERANCE = 0.01
+
+
+def _read_drainage_lines(path):
+	"""
+	Returns the geometries and properties of a drainage line file, GeoJSON read directly and any other format through
+	geopandas.
+	"""
+	from shapely.geometry import shape
+
+	if path.endswith(('.json', '.geojson')):
+		with open(path) as f:
+			features = json.load(f)['features']
+		return [shape(feature['geometry']) for feature in features], [feature['properties'] for feature in features]
+
+	import geopandas as gpd
+
+	frame = gpd.read_file(path).to_crs(epsg=4326)
+	return list(frame.geometry), frame.drop(columns='geometry').to_dict('records')
+
+
+class ReachIndex(object):
+	"""
+	STRtree over the drainage line geometries, answering which reach is nearest to a lon/lat.
+	"""
+
+	def __init__(self, geometries, properties):
+		from shapely.strtree import STRtree
+
+		self.tree = STRtree(geometries)
+		self.attributes = {name: np.array([row.get(name) for row in properties], dtype=object)
+						   for name in REACH_ATTRIBUTES}
+
+	@classmethod
+	def load(cls, path):
+		return cls(*_read_drainage_lines(path))
+
+	def __len__(self):
+		return len(self.tree)
+
+	def nearest(self, lon, lat, tolerance=DEFAULT_TOLERANCE):
+		"""
+		Returns the attributes of the reach nearest to lon/lat and its distance in degrees, or None when no reach is
+		within tolerance degrees.
+		"""
+		from shapely.geometry import Point
+
+		index, distance = self.tree.query_nearest(Point(lon, lat), max_distance=tolerance, return_distance=True)
+		if len(index) == 0:
+			return None
+		reach = {name: values[index[0]] for name, values in self.attributes.items()}
+		# geopandas gives numpy scalars, which are not JSON serializable
+		reach = {name: value.item() if isinstance(value, np.generic) else value for name, value in reach.items()}
+		reach['distance'] = float(distance[0])
+		return reach
+
+
+_index = (None, None, None)
+_index_lock = threading.Lock()
+
+
+def load_reach_index(path):
+	"""
+	Returns the process-wide index of the drainage line file at path, reloaded when the file changes.
+	"""
+	global _index
+	mtime = os.path.getmtime(path)
+	with _index_lock:
+		if _index[:2] != (path, mtime):
+			_index = (path, mtime, ReachIndex.load(path))
+		return _index[2]
@@ -0,0 +1,163 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+GEOJSON_DIR = os.path.join(os.path.dirname(__file__), 'public', 'geojson')
+
+
+_region_index = (None, None)
+_region_index_lock = threading.Lock()
+
+
+def load_region_index():
+	"""
+	Returns the parsed public/geojson/index.json, reread only when the file changes.
+	"""
+	global _region_index
+	path = os.path.join(GEOJSON_DIR, 'index.json')
+	mtime = os.path.getmtime(path)
+	with _region_index_lock:
+		if _region_index[0] != mtime:
+			with open(path) as f:
+				_region_index = (mtime, json.load(f))
+		return _region_index[1]
+
+
+def region_geometries(region):
+	"""
+	Returns the polygons of a region of public/geojson/index.json as prepared shapely geometries.
+	"""
+	import shapely
+	from shapely.geometry import shape
+
+	region_index = load_region_index()
+	if region not in region_index:
+		raise KeyError('Unknown region {0}'.format(region))
+
+	geometries = []
+	for geojson in region_index[region]['geojsons']:
+		with open(os.path.join(GEOJSON_DIR, geojson)) as f:
+			collection = json.load(f)
+		for feature in collection.get('features', [collection]):
+			geometry = feature.get('geometry', feature)
+			if geometry['type'] in ('Polygon', 'MultiPolygon'):
+				geometries.append(shape(geometry))
+	shapely.prepare(geometries)
+	return geometries
+
+
+def points_in_region(lon, lat, geometries):
+	"""
+	Returns a boolean mask of the points that fall inside any of the geometries, holes excluded.
+	"""
+	import shapely
+
+	lon = np.asarray(lon, dtype=float)
+	lat = np.asarray(lat, dtype=float)
+	mask = np.zeros(lon.shape, dtype=bool)
+	for geometry in geometries:
+		mask |= shapely.contains_xy(geometry, lon, lat)
+	return mask
+
+
+def reach_coordinates(dataset):
+	"""
+	Returns the lon and lat arrays of the reaches of a forecast dataset.
+	"""
+	for lon_name, lat_name in (('lon', 'lat'), ('longitude', 'latitude')):
+		if lon_name in dataset.variables and lat_name in dataset.variables:
+			return dataset[lon_name].values, dataset[lat_name].values
+	raise ValueError('The forecast file has no reach coordinates')
+
+
+class RegionMembership(object):
+	"""
+	Positions along the comid dimension of the reaches inside every region of public/geojson/index.json, computed
+	once with a shapely point in polygon join and stored as int32 arrays.
+	"""
+
+	def __init__(self, comids, positions):
+		self.comids = comids
+		self.positions = positions
+
+	@classmethod
+	def build(cls, dataset):
+		lon, lat = reach_coordinates(dataset)
+		positions = {region: np.flatnonzero(points_in_region(lon, lat, region_geometries(region))).astype(np.int32)
+					 for region in load_region_index()}
+		return cls(dataset['comid'].values, positions)
+
+	def save(self, path):
+		tmp_path = path + '.tmp.npz'
+		np.savez(tmp_path, comids=self.comids, **{'region/' + region: p for region, p in self.positions.items()})
+		os.replace(tmp_path, path)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as table:
+			positions = {name[len('region/'):]: table[name] for name in table.files if name.startswith('region/')}
+			return cls(table['comids'], positions)
+
+
+def membership_path(workspace):
+	return os.path.join(workspace, 'regions', 'membership.npz')
+
+
+def build_region_membership(nc_file, workspace):
+	"""
+	Ingest step: joins the reaches of nc_file to the regions and stores their positions in the workspace. The drainage
+	network is the same in every forecast file, so the join only reruns when the comids or the region index change.
+	"""
+	from .datasets import open_forecast
+
+	path = membership_path(workspace)
+	dataset = open_forecast(nc_file)
+	if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(os.path.join(GEOJSON_DIR, 'index.json')):
+		membership = load_region_membership(workspace)
+		if np.array_equal(membership.comids, dataset['comid'].values):
+			return membership
+
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	membership = RegionMembership.build(dataset)
+	membership.save(path)
+	return membership
+
+
+_membership = (None, None)
+_membership_lock = threading.Lock()
+
+
+def load_region_membership(workspace):
+	"""
+	Returns the stored region membership, reread only when the file changes, or None when the ingest step has not
+	run yet.
+	"""
+	global _membership
+	path = membership_path(workspace)
+	try:
+		mtime = os.path.getmtime(path)
+	except FileNotFoundError:
+		return None
+	with _membership_lock:
+		if _membership[0] != mtime:
+			_membership = (mtime, RegionMembership.load(path))
+		return _membership[1]
+
+
+def region_positions(region, dataset, workspace):
+	"""
+	Returns the positions along the comid dimension of dataset of the reaches inside region, from the membership
+	stored by the ingest step, or None while it is missing or older than the network or the region index.
+	Raises:
+	  KeyError: region is not in public/geojson/index.json
+	"""
+	if region not in load_region_index():
+		raise KeyError('Unknown region {0}'.format(region))
+	membership = load_region_membership(workspace)
+	if membership is None or membership.comids.size != dataset['comid'].size or region not in membership.positions:
+		return None
+	if os.path.getmtime(membership_path(workspace)) < os.path.getmtime(os.path.join(GEOJSON_DIR, 'index.json')):
+		return None
+	return membership.positions[region]
@@ -0,0 +1,304 @@
+import os
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .datasets import open_forecast
+
+RETURN_PERIODS = (10, 5, 2.33)
+RETURN_PERIOD_NAMES = ('return_period_10', 'return_period_5', 'return_period_2_33')
+
+# comids read from the forecast file per vectorized block
+BLOCK_SIZE = 2048
+
+
+def gve_1(loc: float, scale: float, shape: float, rp: int or float) -> float:
+	"""
+	Solves the Gumbel Type I probability distribution function (pdf) = exp(-exp(-b)) where b is the covariate. Provide
+	the standard deviation and mean of the list of annual maximum flows. Compare scipy.stats.gumbel_r
+	Args:
+	  std (float): the standard deviation of the series
+	  xbar (float): the mean of the series
+	  skew (float): the skewness of the series
+	  rp (int or float): the return period in years
+	Returns:
+	  float, the flow corresponding to the return period specified
+	"""
+
+	return ((scale / shape) * (1 - math.exp(shape * (math.log(-math.log(1 - (1 / rp))))))) + loc
+
+
+def annual_maxima(values, times):
+	"""
+	Annual maximum of every row of values.
+	Args:
+	  values (np.ndarray): flows shaped (comid, time)
+	  times (np.ndarray): sorted datetime64 values of the time axis
+	Returns:
+	  tuple, (years, maxima) where maxima is shaped (comid, year)
+	"""
+	years = times.astype('datetime64[Y]').astype(int) + 1970
+	starts = np.concatenate(([0], np.flatnonzero(np.diff(years)) + 1))
+	return years[starts], np.fmax.reduceat(values, starts, axis=1)
+
+
+def lmom_ratios(maxima):
+	"""
+	Sample L-moments l1, l2 and the L-skewness t3 of every row, same estimators as lmoments3.lmom_ratios.
+	"""
+	x = np.sort(maxima, axis=1)
+	n = x.shape[1]
+	j = np.arange(n, dtype=float)
+	b0 = x.mean(axis=1)
+	b1 = (x * (j / (n - 1))).sum(axis=1) / n
+	b2 = (x * (j * (j - 1) / ((n - 1) * (n - 2)))).sum(axis=1) / n
+	l1 = b0
+	l2 = 2 * b1 - b0
+	l3 = 6 * b2 - 6 * b1 + b0
+	with np.errstate(divide='ignore', invalid='ignore'):
+		t3 = l3 / l2
+	return l1, l2, t3
+
+
+def gev_lmom_fit(maxima):
+	"""
+	Vectorized version of lmoments3 distr.gev.lmom_fit, fitting every row of maxima at once.
+	Args:
+	  maxima (np.ndarray): annual maxima shaped (comid, year)
+	Returns:
+	  tuple, (loc, scale, c) arrays, NaN where the L-moments are invalid
+	"""
+	from scipy import special
+
+	l1, l2, t3 = lmom_ratios(np.asarray(maxima, dtype=float))
+	g = np.full(l1.shape, np.nan)
+	valid = (l2 > 0) & (np.abs(t3) < 1)
+
+	# rational approximations from Hosking, accurate to 1e-6 for -0.8 < t3 < 1
+	neg = valid & (t3 <= 0)
+	t = t3[neg]
+	g[neg] = (0.28377530 + t * (-1.21096399 + t * (-2.50728214 + t * (-1.13455566 + t * -0.07138022)))) / \
+		(1 + t * (2.06189696 + t * (1.31912239 + t * 0.25077104)))
+
+	pos = valid & (t3 > 0)
+	z = 1 - t3[pos]
+	g[pos] = (-1 + z * (1.59921491 + z * (-0.48832213 + z * 0.01573152))) / (1 + z * (-0.64363929 + z * 0.08985247))
+
+	# Newton-Raphson for the strongly negative skews
+	newton = neg & (t3 < -0.8)
+	if newton.any():
+		dl2, dl3 = math.log(2), math.log(3)
+		t = t3[newton]
+		gn = np.where(t <= -0.97, 1 - np.log1p(t) / dl2, g[newton])
+		t0 = (t + 3) * 0.5
+		for _ in range(20):
+			x2, x3 = 2 ** -gn, 3 ** -gn
+			xx2, xx3 = 1 - x2, 1 - x3
+			deriv = (xx2 * x3 * dl3 - xx3 * x2 * dl2) / xx2 ** 2
+			step = (xx3 / xx2 - t0) / deriv
+			gn = gn - step
+			if np.all(np.abs(step) <= 1e-6 * np.abs(gn)):
+				break
+		g[newton] = gn
+
+	gumbel = valid & (np.abs(g) < 1e-5)
+	g[gumbel] = 0
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		gam = special.gamma(1 + g)
+		scale = l2 * g / (gam * (1 - 2 ** -g))
+		loc = l1 - scale * (1 - gam) / g
+	scale[gumbel] = l2[gumbel] / math.log(2)
+	loc[gumbel] = l1[gumbel] - np.euler_gamma * scale[gumbel]
+
+	return loc, scale, g
+
+
+def gev_return_levels(loc, scale, shape, return_periods=RETURN_PERIODS):
+	"""
+	Vectorized gve_1, returns an array shaped (comid, return period). Zero shapes use the Gumbel limit.
+	"""
+	y = np.log(-np.log(1 - 1 / np.asarray(return_periods, dtype=float)))
+	loc, scale, shape = (np.asarray(a, dtype=float)[:, None] for a in (loc, scale, shape))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		levels = (scale / shape) * (1 - np.exp(shape * y)) + loc
+	return np.where(shape == 0, loc - scale * y, levels)
+
+
+class ReturnPeriodTable(object):
+	"""
+	Return period thresholds of every comid in one forecast file.
+	"""
+
+	def __init__(self, comids, values):
+		self.comids = comids
+		self.values = values
+		self._positions = {str(comid): i for i, comid in enumerate(comids.tolist())}
+
+	def lookup(self, comid):
+		"""
+		Returns the thresholds of comid as a dict keyed by RETURN_PERIOD_NAMES.
+		"""
+		row = self.values[self._positions[str(comid)]]
+		return dict(zip(RETURN_PERIOD_NAMES, row.tolist()))
+
+	def lookup_many(self, comids):
+		"""
+		Returns the thresholds of comids as an array shaped (comid, return period).
+		"""
+		return self.values[[self._positions[str(comid)] for comid in comids]]
+
+	@classmethod
+	def build(cls, nc_file):
+		"""
+		Fits the GEV distribution to the annual maxima of the qr simulation for every comid in nc_file.
+		"""
+		dataset = open_forecast(nc_file)
+		maxima = full_annual_maxima(dataset)[1]
+		return cls(dataset['comid'].values, gev_return_levels(*gev_lmom_fit(maxima)).astype(np.float32))
+
+	def save(self, path):
+		tmp_path = path + '.tmp.npz'
+		np.savez(tmp_path, comids=self.comids, values=self.values)
+		os.replace(tmp_path, path)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as table:
+			return cls(table['comids'], table['values'])
+
+
+def full_annual_maxima(dataset):
+	"""
+	Annual maxima of the whole qr history of every comid, read in blocks of BLOCK_SIZE comids.
+	"""
+	times = dataset['qr']['time'].values
+	blocks = []
+	for start in range(0, dataset['comid'].size, BLOCK_SIZE):
+		block = dataset['qr'].isel(comid=slice(start, start + BLOCK_SIZE)).transpose('comid', 'time').values
+		years, maxima = annual_maxima(block, times)
+		blocks.append(maxima.astype(np.float32))
+	return years, np.concatenate(blocks)
+
+
+def table_path(nc_file, workspace):
+	name = os.path.splitext(os.path.basename(nc_file))[0]
+	return os.path.join(workspace, 'return_periods', name + '.npz')
+
+
+def maxima_path(workspace):
+	return os.path.join(workspace, 'return_periods', 'annual_maxima.npz')
+
+
+def _load_maxima_state(path):
+	if not os.path.exists(path):
+		return None
+	with np.load(path) as state:
+		return {name: state[name] for name in state.files}
+
+
+def _save_maxima_state(path, **state):
+	tmp_path = path + '.tmp.npz'
+	np.savez(tmp_path, **state)
+	os.replace(tmp_path, path)
+
+
+def build_return_period_table(nc_file, workspace):
+	"""
+	Ingest step: updates the persistent per-comid annual maxima with the qr days of nc_file that are newer than the
+	last ingested file, refits the GEV only for the comids whose annual maxima changed, and stores the return period
+	table of nc_file in the workspace. The full history is only scanned the first time, or when the comids change.
+	"""
+	path = table_path(nc_file, workspace)
+	state_path = maxima_path(workspace)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+
+	dataset = open_forecast(nc_file)
+	comids = dataset['comid'].values
+	times = dataset['qr']['time'].values
+	state = _load_maxima_state(state_path)
+
+	if state is None or not np.array_equal(state['comids'], comids):
+		years, maxima = full_annual_maxima(dataset)
+		levels = gev_return_levels(*gev_lmom_fit(maxima)).astype(np.float32)
+
+	elif times[-1] < state['last_time']:
+		# a file older than the ingested history, fit it on its own without touching the state
+		table = ReturnPeriodTable.build(nc_file)
+		table.save(path)
+		return table
+
+	else:
+		years, maxima, levels = state['years'], state['maxima'], state['levels']
+		start = np.searchsorted(times, state['last_time'], side='right')
+
+		if start < times.size:
+			block = dataset['qr'].isel(time=slice(start, None)).transpose('comid', 'time').values
+			new_years, new_maxima = annual_maxima(block, times[start:])
+
+			added = np.setdiff1d(new_years, years)
+			if added.size:
+				years = np.concatenate((years, added))
+				maxima = np.concatenate((maxima, np.full((comids.size, added.size), np.nan, np.float32)), axis=1)
+
+			columns = np.searchsorted(years, new_years)
+			updated = np.fmax(maxima[:, columns], new_maxima)
+			changed = np.flatnonzero(np.any(updated != maxima[:, columns], axis=1))
+			maxima[:, columns] = updated
+
+			if changed.size:
+				levels[changed] = gev_return_levels(*gev_lmom_fit(maxima[changed]))
+
+	_save_maxima_state(state_path, comids=comids, years=years, maxima=maxima, levels=levels,
+					   last_time=times[-1])
+
+	table = ReturnPeriodTable(comids, levels)
+	table.save(path)
+	return table
+
+
+_tables = OrderedDict()
+_tables_lock = threading.Lock()
+
+# serializes the loads and builds, which share the annual maxima state, without blocking lookups of loaded tables
+_build_lock = threading.Lock()
+
+
+def _cached_table(path, mtime):
+	with _tables_lock:
+		entry = _tables.get(path)
+		if entry is not None and entry[0] == mtime:
+			_tables.move_to_end(path)
+			return entry[1]
+	return None
+
+
+def load_return_period_table(nc_file, workspace, max_tables=4):
+	"""
+	Returns the return period table of nc_file, building it on first use when the ingest step has not run yet.
+	"""
+	path = table_path(nc_file, workspace)
+	mtime = os.path.getmtime(nc_file)
+	table = _cached_table(path, mtime)
+	if table is not None:
+		return table
+
+	with _build_lock:
+		# another request may have loaded it while this one waited
+		table = _cached_table(path, mtime)
+		if table is not None:
+			return table
+
+		if os.path.exists(path) and os.path.getmtime(path) >= mtime:
+			table = ReturnPeriodTable.load(path)
+		else:
+			table = build_return_period_table(nc_file, workspace)
+
+		with _tables_lock:
+			_tables[path] = (mtime, table)
+			while len(_tables) > max_tables:
+				_tables.popitem(last=False)
+
+	return table
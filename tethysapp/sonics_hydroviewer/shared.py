@@ -0,0 +1,117 @@
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from .datasets import ReachSeries, REACH_VARIABLES
+from .store import open_reach_store
+from .versions import pointer_path, new_version, publish_version, read_pointer
+
+COORDINATES = ('comid', 'time', 'time_eta', 'time_gfs')
+
+# comids copied from the store per block while writing the arrays
+BLOCK_SIZE = 1024
+
+
+def shared_directory(workspace):
+	return os.path.join(workspace, 'shared')
+
+
+def shared_path(nc_file, workspace):
+	"""
+	Returns the pointer file naming the directory that holds the current arrays of nc_file.
+	"""
+	return pointer_path(shared_directory(workspace), os.path.splitext(os.path.basename(nc_file))[0])
+
+
+class SharedForecast(object):
+	"""
+	Flows of one forecast file as flat .npy arrays laid out (comid, time), opened memory mapped. The pages live in
+	the OS page cache, so every worker process attached to the same directory shares one copy, and reach reads are
+	NumPy views without a copy or a NetCDF decode.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+				  for name in COORDINATES + REACH_VARIABLES}
+		self.comids = np.asarray(arrays['comid'])
+		self.coordinates = {name: np.asarray(arrays[name]) for name in COORDINATES[1:]}
+		self.flows = {name: arrays[name] for name in REACH_VARIABLES}
+		self._positions = {str(comid): i for i, comid in enumerate(self.comids.tolist())}
+
+	def read_reach(self, comid):
+		"""
+		Returns the ReachSeries of comid as read-only views of the mapped arrays.
+		Raises:
+		  KeyError: comid is not in the forecast
+		"""
+		position = self._positions.get(str(comid))
+		if position is None:
+			raise KeyError('comid {0} not found'.format(comid))
+		flows = {name: self.flows[name][position] for name in REACH_VARIABLES}
+		return ReachSeries(str(comid), self.coordinates['time'], flows['qr'], self.coordinates['time_eta'],
+						   flows['qr_eta'], self.coordinates['time_gfs'], flows['qr_gfs'])
+
+
+def build_shared_forecast(nc_file, workspace, block_size=BLOCK_SIZE):
+	"""
+	Ingest step: writes the coordinates and flows of nc_file as .npy arrays in a new versioned directory, then points
+	the pointer file of nc_file to it with os.replace, so workers always find a complete forecast. The earlier
+	versions and the arrays of older forecast files are removed afterwards; workers still mapping them keep their
+	pages until they swap to the new directory.
+	"""
+	directory = shared_directory(workspace)
+	name = os.path.splitext(os.path.basename(nc_file))[0]
+	path = new_version(directory, name)
+
+	try:
+		dataset = open_reach_store(nc_file, workspace)
+		comids = dataset['comid'].values
+		for coordinate in COORDINATES:
+			np.save(os.path.join(path, coordinate + '.npy'), dataset[coordinate].values)
+
+		for variable_name in REACH_VARIABLES:
+			variable = dataset[variable_name].transpose('comid', ...)
+			out = np.lib.format.open_memmap(os.path.join(path, variable_name + '.npy'), mode='w+', dtype=np.float32,
+											shape=variable.shape)
+			for start in range(0, comids.size, block_size):
+				out[start:start + block_size] = variable.isel(comid=slice(start, start + block_size)).values
+			out.flush()
+			del out
+	except BaseException:
+		shutil.rmtree(path, ignore_errors=True)
+		raise
+
+	publish_version(directory, name, path)
+	return path
+
+
+_shared = (None, None, None)
+_shared_lock = threading.Lock()
+
+
+def open_shared_forecast(nc_file, workspace):
+	"""
+	Returns the SharedForecast of nc_file, or None when the ingest step has not written it since nc_file last changed.
+	The process keeps the mapping of the latest version it was pointed to and swaps it when the pointer changes.
+	"""
+	global _shared
+	pointer = shared_path(nc_file, workspace)
+	try:
+		mtime = os.stat(pointer).st_mtime_ns
+	except FileNotFoundError:
+		return None
+	if mtime < os.stat(nc_file).st_mtime_ns:
+		# the forecast was reissued under the same date, serve it from the file until ingest runs again
+		return None
+
+	with _shared_lock:
+		if _shared[:2] != (pointer, mtime):
+			try:
+				_shared = (pointer, mtime, SharedForecast(read_pointer(pointer)))
+			except FileNotFoundError:
+				# replaced by a newer ingest while being opened
+				return None
+		return _shared[2]
@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+
+from .datasets import open_forecast
+
+# comids copied from the forecast file per block while converting
+BLOCK_SIZE = 1024
+
+
+def store_path(nc_file, workspace):
+	return os.path.join(workspace, 'stores', os.path.basename(nc_file))
+
+
+def convert_to_comid_major(nc_file, out_path, block_size=BLOCK_SIZE):
+	"""
+	Rewrites a SONICS forecast file as a NetCDF4 store whose comid variables are laid out comid-major, with one chunk
+	per reach, so the full history of a single comid is one contiguous read. The copy is done in blocks of comids to
+	keep memory bounded and written to a temporary file that replaces out_path when complete. The qr of a compacted
+	file is copied from its history store.
+	"""
+	import netCDF4 as nc
+	from .archive import open_history_variables, compression, HISTORY_ATTRS
+
+	os.makedirs(os.path.dirname(out_path), exist_ok=True)
+	tmp_path = out_path + '.tmp'
+
+	with nc.Dataset(nc_file) as src, nc.Dataset(tmp_path, 'w', format='NETCDF4') as dst:
+		src.set_auto_maskandscale(False)
+		history, history_times = open_history_variables(src, nc_file)
+		dst.setncatts({attr: src.getncattr(attr) for attr in src.ncattrs() if attr not in HISTORY_ATTRS})
+		for name, dimension in src.dimensions.items():
+			dst.createDimension(name, None if dimension.isunlimited() else len(dimension))
+		sizes = {name: len(dimension) for name, dimension in src.dimensions.items()}
+
+		# (variable, slice of its time dimension) pairs, the whole dimension for the variables of src
+		variables = [(variable, slice(None)) for variable in src.variables.values()]
+		if history is not None:
+			sizes['time'] = history_times.stop - history_times.start
+			dst.createDimension('time', sizes['time'])
+			variables += [(history.variables[name], history_times) for name in ('time', 'qr')]
+
+		n_comids = len(src.dimensions['comid'])
+
+		for variable, time_slice in variables:
+			name = variable.name
+			attrs = {attr: variable.getncattr(attr) for attr in variable.ncattrs() if attr != '_FillValue'}
+			fill_value = getattr(variable, '_FillValue', None)
+			index = [time_slice if d == 'time' else slice(None) for d in variable.dimensions]
+
+			if 'comid' not in variable.dimensions or variable.ndim == 1:
+				out = dst.createVariable(name, variable.datatype, variable.dimensions, fill_value=fill_value)
+				out.setncatts(attrs)
+				out[:] = variable[tuple(index)]
+				continue
+
+			axis = variable.dimensions.index('comid')
+			dimensions = ('comid',) + tuple(d for d in variable.dimensions if d != 'comid')
+			chunksizes = (1,) + tuple(sizes[d] for d in dimensions[1:])
+			out = dst.createVariable(name, variable.datatype, dimensions, fill_value=fill_value,
+									 chunksizes=chunksizes, **compression(variable))
+			out.setncatts(attrs)
+
+			for start in range(0, n_comids, block_size):
+				index[axis] = slice(start, start + block_size)
+				out[start:start + block_size] = np.moveaxis(variable[tuple(index)], axis, 0)
+
+		if history is not None:
+			history.close()
+
+	os.replace(tmp_path, out_path)
+	return out_path
+
+
+def build_reach_store(nc_file, workspace):
+	"""
+	Ingest step: converts nc_file to its comid-major store in the workspace, then removes the stores of older forecast
+	files, which are read from the forecast files themselves.
+	"""
+	path = convert_to_comid_major(nc_file, store_path(nc_file, workspace))
+	name = os.path.basename(path)
+	for entry in os.scandir(os.path.dirname(path)):
+		if entry.name < name and not entry.name.endswith('.tmp'):
+			os.remove(entry.path)
+	return path
+
+
+def open_reach_store(nc_file, workspace):
+	"""
+	Returns the comid-major store of nc_file when it has been converted, otherwise the forecast file itself. Both
+	expose the same variables, so reach reads with .sel(comid=comid) work on either.
+	"""
+	path = store_path(nc_file, workspace)
+	if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(nc_file):
+		return open_forecast(path)
+	return open_forecast(nc_file)
@@ -0,0 +1,432 @@
+"""
+Benchmarks for the SONICS Hydroviewer data path. They do not need a configured Tethys portal: the controllers and
+concurrency benchmarks import the controllers, so they need the Tethys SDK installed, and run on a minimal Django
+configuration unless DJANGO_SETTINGS_MODULE names one.
+
+Usage:
+    python -m tethysapp.sonics_hydroviewer.tests.benchmarks store <forecast_file.nc> [--reaches N]
+    python -m tethysapp.sonics_hydroviewer.tests.benchmarks startup <forecast_file.nc>
+    python -m tethysapp.sonics_hydroviewer.tests.benchmarks controllers [--comids N] [--years N] [--requests N]
+    python -m tethysapp.sonics_hydroviewer.tests.benchmarks concurrency [--comids N] [--requests N] [--clients N]
+        [--sync-workers N] [--blocking-workers N]
+    python -m tethysapp.sonics_hydroviewer.tests.benchmarks gev [--comids N] [--years N]
+    python -m tethysapp.sonics_hydroviewer.tests.benchmarks spatial <drainage_lines_file> [--lookups N]
+    python -m tethysapp.sonics_hydroviewer.tests.benchmarks archive [--comids N] [--years N] [--days N] [--reaches N]
+
+The controllers, concurrency, gev and archive benchmarks run on synthetic forecast files written by tests/synthetic.py.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import datetime as dt
+from types import SimpleNamespace
+from unittest import mock
+from contextlib import contextmanager
+
+
+def timed(func, *args, repeat=1):
+	"""
+	Returns the result of the last call and the wall time of every call in milliseconds.
+	"""
+	timings = []
+	result = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = func(*args)
+		timings.append((time.perf_counter() - start) * 1000)
+	return result, timings
+
+
+def traced(func, *args):
+	"""
+	Returns the result of one call and the peak memory it allocated in MB, as seen by tracemalloc.
+	"""
+	tracemalloc.start()
+	try:
+		result = func(*args)
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return result, peak / 2 ** 20
+
+
+def report(name, timings, peak=None):
+	line = '{0:<40} median {1:>10.2f} ms   p95 {2:>10.2f} ms   n={3}'.format(
+		name, statistics.median(timings), sorted(timings)[int(0.95 * (len(timings) - 1))], len(timings))
+	if peak is not None:
+		line += '   peak {0:.1f} MB'.format(peak)
+	print(line)
+
+
+def benchmark_store(nc_file, reaches=50):
+	"""
+	Times the comid-major conversion of nc_file and compares single-reach full history reads on the raw file against
+	the converted store.
+	"""
+	import xarray as xr
+	from ..store import convert_to_comid_major
+
+	with tempfile.TemporaryDirectory() as workspace:
+		out_path = os.path.join(workspace, os.path.basename(nc_file))
+		_, timings = timed(convert_to_comid_major, nc_file, out_path)
+		report('convert to comid-major store', timings)
+		print('{0:<40} raw {1:.1f} MB   store {2:.1f} MB'.format(
+			'size', os.path.getsize(nc_file) / 2 ** 20, os.path.getsize(out_path) / 2 ** 20))
+
+		for label, path in (('raw file', nc_file), ('comid-major store', out_path)):
+			with xr.open_dataset(path) as dataset:
+				comids = random.Random(0).sample(dataset['comid'].values.tolist(), min(reaches, dataset['comid'].size))
+				timings = [timed(lambda c: dataset['qr'].sel(comid=c).values, comid)[1][0] for comid in comids]
+			report('qr history read, ' + label, timings)
+
+
+# modules the controllers used to import at load time, now imported by the endpoints that need them
+DEFERRED_IMPORTS = ('xarray', 'pandas', 'netCDF4', 'scipy.special', 'plotly.graph_objs', 'geoglows', 'requests')
+
+
+def import_time(module):
+	"""
+	Returns the wall time in milliseconds of importing module in a fresh interpreter.
+	"""
+	code = 'import time; start = time.perf_counter(); import {0}; print((time.perf_counter() - start) * 1000)'
+	output = subprocess.run([sys.executable, '-c', code.format(module)], capture_output=True, text=True, check=True)
+	return float(output.stdout.strip())
+
+
+def benchmark_startup(nc_file, repeat=3):
+	"""
+	Times the imports a worker pays at boot, and the first reach lookup on nc_file with and without the warm-up
+	preloading the comid coordinate.
+	"""
+	for module in DEFERRED_IMPORTS + ('tethysapp.sonics_hydroviewer.regions', 'tethysapp.sonics_hydroviewer.datasets'):
+		try:
+			report('import ' + module, [import_time(module) for _ in range(repeat)])
+		except subprocess.CalledProcessError:
+			print('{0:<40} not installed'.format('import ' + module))
+
+	from ..datasets import DatasetPool, comid_positions, select_reaches
+	from ..regions import load_region_index
+
+	_, timings = timed(load_region_index, repeat=repeat)
+	report('region index, first then cached', timings)
+
+	pool = DatasetPool()
+	dataset, timings = timed(pool.get, nc_file)
+	comid = str(dataset['comid'].values[-1])
+	_, cold = timed(select_reaches, dataset, [comid])
+	report('open forecast file', timings)
+	report('first reach lookup, cold', cold)
+	pool.clear()
+
+	dataset = pool.get(nc_file)
+	_, warm_up = timed(comid_positions, dataset)
+	_, warm = timed(select_reaches, dataset, [comid])
+	report('warm-up comid coordinate', warm_up)
+	report('first reach lookup, warmed up', warm)
+	pool.clear()
+
+
+# forecast dates of the synthetic archive
+SYNTHETIC_DATES = (dt.date(2021, 3, 1), dt.date(2021, 3, 2))
+
+REACH_CONTROLLERS = ('get_hydrographs', 'get_simulated_discharge_csv', 'get_time_series', 'get_forecast_data_csv',
+					 'get_hydrograph_data', 'get_time_series_data')
+
+
+def _consume(response):
+	if response.streaming:
+		content = b''.join(response.streaming_content)
+	else:
+		content = response.content
+	if content.startswith(b'{"error"'):
+		raise RuntimeError(content.decode())
+	return len(content)
+
+
+def configure_django():
+	"""
+	Sets Django up with the settings module named by DJANGO_SETTINGS_MODULE, or with a minimal configuration without
+	a database, which is all the controllers need once the app settings and workspace are patched.
+	"""
+	import django
+	from django.conf import settings
+
+	if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+		settings.configure(
+			DEBUG=False,
+			SECRET_KEY='sonics-hydroviewer-benchmarks',
+			ALLOWED_HOSTS=['*'],
+			INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth'],
+			DATABASES={},
+			USE_TZ=True,
+		)
+	django.setup()
+
+
+@contextmanager
+def synthetic_app(comids, years, requests, **settings):
+	"""
+	Writes a synthetic archive and patches the custom settings and the app workspace of the app, so the controllers can
+	be called directly without a portal database or a forecast archive. The response cache is disabled so every call
+	does the full work.
+	Yields:
+	  tuple, (controllers module, sample of comids, request builder taking a comid)
+	"""
+	configure_django()
+	from django.test import RequestFactory
+	from .synthetic import write_forecast
+	from ..app import SonicsHydroviewer
+
+	with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as workspace:
+		for date in SYNTHETIC_DATES:
+			write_forecast(folder, date, comids, years)
+
+		settings = dict({'folder': folder, 'response_cache': 'none', 'response_cache_size': 0,
+						 'max_batch_comids': 500, 'max_blocking_workers': 8}, **settings)
+		with mock.patch.object(SonicsHydroviewer, 'get_custom_setting', new=lambda name: settings.get(name)), \
+				mock.patch.object(SonicsHydroviewer, 'get_app_workspace', new=lambda: SimpleNamespace(path=workspace)):
+			from .. import controllers
+			from ..datasets import open_forecast
+
+			dataset = open_forecast(os.path.join(folder, os.listdir(folder)[0]))
+			sample = random.Random(0).sample(dataset['comid'].values.tolist(), min(requests, comids))
+			factory = RequestFactory()
+
+			def build_request(comid):
+				return factory.get('/', {'comid': comid, 'region': 'peru', 'subbasin': 'peru', 'watershed': 'peru',
+										 'startdate': SYNTHETIC_DATES[-1].strftime('%Y%m%d')})
+
+			yield controllers, sample, build_request
+
+
+def benchmark_controllers(comids=5000, years=20, requests=30):
+	"""
+	Times every reach controller on a synthetic archive, calling the views directly with a Django RequestFactory.
+	"""
+	with synthetic_app(comids, years, requests) as (controllers, sample, build_request):
+		def call(view, comid):
+			return _consume(view(build_request(comid)))
+
+		for name in REACH_CONTROLLERS:
+			view = getattr(controllers, name)
+			# the first call builds the return period table of the file
+			_, first = timed(call, view, sample[0])
+			timings = [timed(call, view, comid)[1][0] for comid in sample]
+			_, peak = traced(call, view, sample[-1])
+			report(name + ' (first call {0:.0f} ms)'.format(first[0]), timings, peak)
+
+
+def benchmark_concurrency(comids=5000, years=20, requests=200, clients=32, sync_workers=4, blocking_workers=8):
+	"""
+	Compares the throughput of the hydrograph and forecast views a map click requests, under clients concurrent
+	clicks: the sync views served by sync_workers worker threads, against the async views served by one event loop
+	with blocking_workers executor threads.
+	"""
+	import asyncio
+	from concurrent.futures import ThreadPoolExecutor
+
+	with synthetic_app(comids, years, requests, max_blocking_workers=blocking_workers) as \
+			(controllers, sample, build_request):
+		pairs = [('get_hydrograph_data', 'get_time_series_data'), ('get_hydrographs', 'get_time_series')]
+		for views in pairs:
+			# build the return period table before timing
+			for name in views:
+				_consume(getattr(controllers, name)(build_request(sample[0])))
+
+			def click(comid):
+				return [_consume(getattr(controllers, name)(build_request(comid))) for name in views]
+
+			start = time.perf_counter()
+			with ThreadPoolExecutor(sync_workers) as pool:
+				list(pool.map(click, sample))
+			elapsed = time.perf_counter() - start
+			print('{0:<40} {1:>8.1f} req/s'.format('sync ' + ' + '.join(views), 2 * len(sample) / elapsed))
+
+			async def clicks():
+				semaphore = asyncio.Semaphore(clients)
+
+				async def async_click(comid):
+					async with semaphore:
+						responses = await asyncio.gather(
+							*(getattr(controllers, name + '_async')(build_request(comid)) for name in views))
+					return [_consume(response) for response in responses]
+
+				await asyncio.gather(*(async_click(comid) for comid in sample))
+
+			start = time.perf_counter()
+			asyncio.run(clicks())
+			elapsed = time.perf_counter() - start
+			print('{0:<40} {1:>8.1f} req/s'.format('async ' + ' + '.join(views), 2 * len(sample) / elapsed))
+
+
+def benchmark_gev(comids=20000, years=30, seed=0):
+	"""
+	Times the return period computation on synthetic annual maxima: the former per comid lmoments3 fit with gve_1,
+	when lmoments3 is installed, against the vectorized fit, and the full table build from a synthetic forecast file.
+	"""
+	import numpy as np
+	from ..return_periods import gev_lmom_fit, gev_return_levels, gve_1, ReturnPeriodTable, RETURN_PERIODS
+	from .synthetic import write_forecast
+
+	rng = np.random.default_rng(seed)
+	maxima = rng.gumbel(rng.lognormal(3, 1, (comids, 1)), 20, (comids, years))
+
+	def vectorized():
+		return gev_return_levels(*gev_lmom_fit(maxima))
+
+	_, timings = timed(vectorized, repeat=5)
+	report('vectorized GEV fit, {0} comids'.format(comids), timings, traced(vectorized)[1])
+
+	try:
+		from lmoments3 import distr
+	except ImportError:
+		print('{0:<40} lmoments3 not installed'.format('per comid lmoments3 fit'))
+	else:
+		def per_comid(rows):
+			levels = []
+			for row in rows:
+				params = distr.gev.lmom_fit(row.tolist())
+				levels.append([gve_1(params['loc'], params['scale'], params['c'], rp) for rp in RETURN_PERIODS])
+			return levels
+
+		subset = maxima[:min(comids, 1000)]
+		_, timings = timed(per_comid, subset)
+		report('per comid lmoments3 fit, {0} comids'.format(len(subset)), timings, traced(per_comid, subset)[1])
+
+	with tempfile.TemporaryDirectory() as folder:
+		nc_file = write_forecast(folder, SYNTHETIC_DATES[-1], min(comids, 5000), years)
+		_, timings = timed(ReturnPeriodTable.build, nc_file)
+		report('return period table build, {0} comids'.format(min(comids, 5000)), timings,
+			   traced(ReturnPeriodTable.build, nc_file)[1])
+
+
+def benchmark_spatial(path, lookups=1000, seed=0):
+	"""
+	Times the drainage line index build and the nearest reach lookups at random points within the network bounds.
+	"""
+	import shapely
+	from ..reaches import ReachIndex
+
+	index, timings = timed(ReachIndex.load, path)
+	report('reach index build, {0} reaches'.format(len(index)), timings, traced(ReachIndex.load, path)[1])
+
+	rng = random.Random(seed)
+	min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(index.tree.geometries)
+
+	timings = []
+	found = 0
+	for _ in range(lookups):
+		lon, lat = rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+		reach, timing = timed(index.nearest, lon, lat)
+		timings.extend(timing)
+		found += reach is not None
+	report('nearest reach lookup, {0} found'.format(found), timings)
+
+
+def benchmark_archive(comids=5000, years=20, days=30, reaches=50):
+	"""
+	Compares a synthetic archive of days daily files in the legacy layout against the same archive compacted into a
+	history store: disk size, compaction time, full history reads of single reaches and the scan of every file the
+	verification job does.
+	"""
+	import shutil
+	import xarray as xr
+	from ..archive import compact_archive, open_archived, history_path
+	from .synthetic import write_forecast
+
+	with tempfile.TemporaryDirectory() as legacy, tempfile.TemporaryDirectory() as compacted:
+		dates = [SYNTHETIC_DATES[-1] - dt.timedelta(days=day) for day in range(days - 1, -1, -1)]
+		paths = [os.path.basename(write_forecast(legacy, date, comids, years)) for date in dates]
+		for name in paths:
+			shutil.copy2(os.path.join(legacy, name), compacted)
+
+		result, timings = timed(compact_archive, compacted)
+		report('compact {0} daily files'.format(days), timings)
+		for name, reason in sorted(result['skipped'].items()):
+			print('{0:<40} skipped: {1}'.format(name, reason))
+		print('{0:<40} legacy {1:.1f} MB   compacted {2:.1f} MB (history store {3:.1f} MB)   saved {4:.0%}'.format(
+			'archive size', result['bytes_before'] / 2 ** 20, result['bytes_after'] / 2 ** 20,
+			os.path.getsize(history_path(compacted)) / 2 ** 20, 1 - result['bytes_after'] / result['bytes_before']))
+
+		for label, folder in (('legacy', legacy), ('compacted', compacted)):
+			latest = os.path.join(folder, paths[-1])
+			with open_archived(latest) as dataset:
+				sample = random.Random(0).sample(range(comids), min(reaches, comids))
+				timings = [timed(lambda p: dataset['qr'].isel(comid=p).values, position)[1][0] for position in sample]
+			report('qr history read, ' + label, timings)
+
+			# the forecast variables of every file, opened as the verification job does without the history store
+			def scan():
+				for name in paths:
+					with xr.open_dataset(os.path.join(folder, name)) as dataset:
+						dataset['qr_eta'].values, dataset['qr_gfs'].values
+
+			_, timings = timed(scan, repeat=3)
+			report('forecast scan of {0} files, {1}'.format(days, label), timings)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='SONICS Hydroviewer benchmarks.')
+	subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+	store = subparsers.add_parser('store', help='comid-major store conversion and reach reads')
+	store.add_argument('nc_file')
+	store.add_argument('--reaches', type=int, default=50)
+
+	startup = subparsers.add_parser('startup', help='worker import time and first request latency')
+	startup.add_argument('nc_file')
+
+	controllers = subparsers.add_parser('controllers', help='latency and peak memory of the reach controllers')
+	controllers.add_argument('--comids', type=int, default=5000)
+	controllers.add_argument('--years', type=int, default=20)
+	controllers.add_argument('--requests', type=int, default=30)
+
+	concurrency = subparsers.add_parser('concurrency', help='throughput of the sync and async views under load')
+	concurrency.add_argument('--comids', type=int, default=5000)
+	concurrency.add_argument('--years', type=int, default=20)
+	concurrency.add_argument('--requests', type=int, default=200)
+	concurrency.add_argument('--clients', type=int, default=32)
+	concurrency.add_argument('--sync-workers', type=int, default=4)
+	concurrency.add_argument('--blocking-workers', type=int, default=8)
+
+	gev = subparsers.add_parser('gev', help='return period fit')
+	gev.add_argument('--comids', type=int, default=20000)
+	gev.add_argument('--years', type=int, default=30)
+
+	spatial = subparsers.add_parser('spatial', help='drainage line index build and map click lookups')
+	spatial.add_argument('drainage_lines')
+	spatial.add_argument('--lookups', type=int, default=1000)
+
+	archive = subparsers.add_parser('archive', help='legacy against compacted archive size and reads')
+	archive.add_argument('--comids', type=int, default=5000)
+	archive.add_argument('--years', type=int, default=20)
+	archive.add_argument('--days', type=int, default=30)
+	archive.add_argument('--reaches', type=int, default=50)
+
+	args = parser.parse_args(argv)
+
+	if args.benchmark == 'store':
+		benchmark_store(args.nc_file, args.reaches)
+	elif args.benchmark == 'startup':
+		benchmark_startup(args.nc_file)
+	elif args.benchmark == 'controllers':
+		benchmark_controllers(args.comids, args.years, args.requests)
+	elif args.benchmark == 'concurrency':
+		benchmark_concurrency(args.comids, args.years, args.requests, args.clients, args.sync_workers,
+							  args.blocking_workers)
+	elif args.benchmark == 'gev':
+		benchmark_gev(args.comids, args.years)
+	elif args.benchmark == 'spatial':
+		benchmark_spatial(args.drainage_lines, args.lookups)
+	elif args.benchmark == 'archive':
+		benchmark_archive(args.comids, args.years, args.days, args.reaches)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
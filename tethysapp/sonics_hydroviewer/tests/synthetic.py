@@ -0,0 +1,108 @@
+"""
+Writes synthetic SONICS forecast files with the layout of PISCO_HyD_ARNOVIC_v1.0_YYYYMMDD.nc, for tests and
+benchmarks that must run without the real forecast archive.
+
+Usage:
+    python -m tethysapp.sonics_hydroviewer.tests.synthetic <folder> <YYYYMMDD> [<YYYYMMDD> ...]
+        [--comids N] [--years N] [--eta-days N] [--gfs-days N]
+"""
+import os
+import sys
+import argparse
+import datetime as dt
+
+import numpy as np
+
+FILE_NAME = 'PISCO_HyD_ARNOVIC_v1.0_{0}.nc'
+
+# days of history written per block, to keep memory bounded for large comid counts
+BLOCK_DAYS = 365
+
+# bounding box of the synthetic reaches, roughly Peru
+BBOX = (-81.3, -18.4, -68.6, -0.03)
+
+
+def _flows(rng, base, days):
+	"""
+	Seasonal flows with a rainy season peak around day 60 and multiplicative noise, shaped (day, comid).
+	"""
+	season = 1 + 0.8 * np.cos(2 * np.pi * (days[:, None] - 60) / 365.25)
+	noise = rng.gamma(4, 0.25, size=(days.size, base.size))
+	return (base[None, :] * season * noise).astype(np.float32)
+
+
+def write_forecast(folder, date, comids=1000, years=20, eta_days=3, gfs_days=10, seed=0):
+	"""
+	Writes the synthetic forecast file of date to folder and returns its path.
+	Args:
+	  date (datetime.date): forecast date, the last day of the qr simulation
+	  comids (int): number of reaches
+	  years (int): length of the qr simulation history
+	  eta_days (int): ETA forecast days after date
+	  gfs_days (int): GFS forecast days after date
+	  seed (int): the same seed and comid count give the same network and base flows in every file
+	"""
+	import netCDF4 as nc
+
+	rng = np.random.default_rng(seed)
+	comid_values = np.sort(rng.choice(np.arange(100000, 100000 + comids * 10), comids, replace=False))
+	base = rng.lognormal(2, 1.2, comids)
+	lon = rng.uniform(BBOX[0], BBOX[2], comids)
+	lat = rng.uniform(BBOX[1], BBOX[3], comids)
+
+	epoch = dt.date(1970, 1, 1)
+	last_day = (date - epoch).days
+	history = np.arange(last_day - int(years * 365.25) + 1, last_day + 1)
+	rng = np.random.default_rng([seed, last_day])
+
+	os.makedirs(folder, exist_ok=True)
+	path = os.path.join(folder, FILE_NAME.format(date.strftime('%Y%m%d')))
+	with nc.Dataset(path, 'w', format='NETCDF4') as out:
+		out.createDimension('comid', comids)
+		out.createVariable('comid', 'i4', ('comid',))[:] = comid_values
+		out.createVariable('lon', 'f4', ('comid',))[:] = lon
+		out.createVariable('lat', 'f4', ('comid',))[:] = lat
+
+		for suffix, days in (('', history), ('_eta', last_day + np.arange(1, eta_days + 1)),
+							 ('_gfs', last_day + np.arange(1, gfs_days + 1))):
+			time_dim = 'time' + suffix
+			out.createDimension(time_dim, days.size)
+			time = out.createVariable(time_dim, 'f8', (time_dim,))
+			time.units = 'days since 1970-01-01 00:00:00'
+			time.calendar = 'standard'
+			time[:] = days
+
+			qr = out.createVariable('qr' + suffix, 'f4', (time_dim, 'comid'), zlib=True, complevel=1)
+			qr.units = 'm3/s'
+			if suffix:
+				qr[:] = _flows(rng, base, days)
+				continue
+			# the history of a day is the same in every file, as in the real archive, so blocks are aligned to
+			# BLOCK_DAYS since the epoch and seeded by their position
+			for block in range(days[0] // BLOCK_DAYS, days[-1] // BLOCK_DAYS + 1):
+				block_days = block * BLOCK_DAYS + np.arange(BLOCK_DAYS)
+				flows = _flows(np.random.default_rng([seed, block]), base, block_days)
+				kept = (block_days >= days[0]) & (block_days <= days[-1])
+				start = block_days[kept][0] - days[0]
+				qr[start:start + np.count_nonzero(kept)] = flows[kept]
+
+	return path
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Write synthetic SONICS forecast files.')
+	parser.add_argument('folder')
+	parser.add_argument('dates', nargs='+', help='forecast dates as YYYYMMDD')
+	parser.add_argument('--comids', type=int, default=1000)
+	parser.add_argument('--years', type=int, default=20)
+	parser.add_argument('--eta-days', type=int, default=3)
+	parser.add_argument('--gfs-days', type=int, default=10)
+	args = parser.parse_args(argv)
+
+	for date in args.dates:
+		print(write_forecast(args.folder, dt.datetime.strptime(date, '%Y%m%d').date(), args.comids, args.years,
+							 args.eta_days, args.gfs_days))
+
+
+if __name__ == '__main__':
+	sys.exit(main())
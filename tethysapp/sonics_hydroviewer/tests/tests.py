@@ -162,4 +162,472 @@ class SonicsHydroviewerTestCase(TethysTestCase):
 
         context = response.context
         self.assertEqual(context['my_integer'], 10)
-        '''
\ No newline at end of file
+        '''
+
+class ReturnPeriodsTestCase(TethysTestCase):
+    """
+    Checks the vectorized GEV fit against the lmoments3 fit previously used by the controllers.
+    """
+
+    def test_gev_lmom_fit_matches_lmoments3(self):
+        import numpy as np
+        from lmoments3 import distr
+        from ..return_periods import gev_lmom_fit, gev_return_levels, gve_1, RETURN_PERIODS
+
+        rng = np.random.default_rng(0)
+        maxima = np.stack([
+            rng.gumbel(100, 30, 40),
+            rng.lognormal(3, 0.8, 40),
+            rng.normal(500, 50, 40),
+        ])
+        levels = gev_return_levels(*gev_lmom_fit(maxima))
+
+        for row, expected_row in zip(maxima, levels):
+            params = distr.gev.lmom_fit(row.tolist())
+            expected = [gve_1(params['loc'], params['scale'], params['c'], rp) for rp in RETURN_PERIODS]
+            np.testing.assert_allclose(expected_row, expected, rtol=1e-5)
+
+    def test_incremental_update_matches_full_build(self):
+        import os
+        import tempfile
+        import datetime as dt
+        import numpy as np
+        from ..return_periods import build_return_period_table, maxima_path, ReturnPeriodTable
+        from .synthetic import write_forecast
+
+        with tempfile.TemporaryDirectory() as folder:
+            workspace = os.path.join(folder, 'workspace')
+            old_file = write_forecast(folder, dt.date(2020, 12, 30), comids=40, years=5)
+            # the next file crosses into 2021, its history starting on the same day as the older one
+            new_file = write_forecast(folder, dt.date(2021, 1, 2), comids=40, years=5 + 3 / 365.25)
+
+            build_return_period_table(old_file, workspace)
+            with np.load(maxima_path(workspace)) as state:
+                self.assertEqual(state['years'][-1], 2020)
+            updated = build_return_period_table(new_file, workspace)
+            with np.load(maxima_path(workspace)) as state:
+                self.assertEqual(state['years'][-1], 2021)
+
+            expected = ReturnPeriodTable.build(new_file)
+            np.testing.assert_array_equal(updated.comids, expected.comids)
+            np.testing.assert_allclose(updated.values, expected.values, rtol=1e-5)
+
+
+class ForecastCatalogTestCase(TethysTestCase):
+    """
+    Checks the forecast folder catalog used instead of globbing on every request.
+    """
+
+    def test_catalog_dates_and_refresh(self):
+        import os
+        import tempfile
+        import datetime as dt
+        from ..catalog import ForecastCatalog
+
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ('PISCO_HyD_ARNOVIC_v1.0_20210102.nc', 'PISCO_HyD_ARNOVIC_v1.0_20210101.nc', 'notes.nc'):
+                open(os.path.join(folder, name), 'w').close()
+
+            catalog = ForecastCatalog(folder)
+            self.assertEqual(catalog.bounds(), (dt.date(2021, 1, 1), dt.date(2021, 1, 2)))
+            self.assertEqual(catalog.resolve(''), os.path.join(folder, 'PISCO_HyD_ARNOVIC_v1.0_20210102.nc'))
+
+            new_file = os.path.join(folder, 'PISCO_HyD_ARNOVIC_v1.0_20210103.nc')
+            open(new_file, 'w').close()
+            os.utime(folder, (0, 0))
+            self.assertEqual(catalog.latest(), new_file)
+            self.assertEqual(catalog.resolve('20210101'), os.path.join(folder, 'PISCO_HyD_ARNOVIC_v1.0_20210101.nc'))
+
+
+class ReadReachTestCase(TethysTestCase):
+    """
+    Checks the single selection reach reader shared by the chart and CSV controllers.
+    """
+
+    def test_read_reach_returns_float32_arrays(self):
+        import numpy as np
+        import xarray as xr
+        from ..datasets import read_reach
+
+        time = np.arange('2000-01-01', '2000-01-11', dtype='datetime64[D]').astype('datetime64[ns]')
+        time_eta = np.arange('2000-01-11', '2000-01-14', dtype='datetime64[D]').astype('datetime64[ns]')
+        time_gfs = np.arange('2000-01-11', '2000-01-16', dtype='datetime64[D]').astype('datetime64[ns]')
+        dataset = xr.Dataset({
+            'qr': (('time', 'comid'), np.arange(20, dtype=float).reshape(10, 2)),
+            'qr_eta': (('time_eta', 'comid'), np.ones((3, 2))),
+            'qr_gfs': (('time_gfs', 'comid'), np.zeros((5, 2))),
+        }, coords={'comid': [101, 102], 'time': time, 'time_eta': time_eta, 'time_gfs': time_gfs})
+
+        reach = read_reach(dataset, '102')
+        self.assertEqual(reach.qr.dtype, np.float32)
+        np.testing.assert_array_equal(reach.qr, np.arange(1, 20, 2))
+        np.testing.assert_array_equal(reach.time_gfs, time_gfs)
+        self.assertEqual(reach.qr_eta.shape, (3,))
+        self.assertRaises(KeyError, read_reach, dataset, '103')
+
+
+class ForecastSkillTestCase(TethysTestCase):
+    """
+    Checks the skill metrics computed from the sums accumulated by the verification job.
+    """
+
+    def test_skill_metrics(self):
+        import numpy as np
+        from ..verification import accumulate, skill_metrics, SUMS
+
+        observed = np.array([[1.0, 10.0], [2.0, 20.0], [3.0, 30.0], [4.0, np.nan]])
+        threshold = np.array([2.5, 25.0])
+
+        sums = np.zeros((len(SUMS), 2))
+        accumulate(sums, observed, observed, threshold)
+        perfect = skill_metrics(sums)
+        np.testing.assert_allclose(perfect['nse'], 1)
+        np.testing.assert_allclose(perfect['kge'], 1)
+        np.testing.assert_allclose(perfect['bias'], 0, atol=1e-12)
+        np.testing.assert_allclose(perfect['hit_rate'], 1)
+        self.assertEqual(sums[0].tolist(), [4, 3])
+
+        sums = np.zeros((len(SUMS), 2))
+        accumulate(sums, observed * 2, observed, threshold)
+        doubled = skill_metrics(sums)
+        np.testing.assert_allclose(doubled['bias'], 1)
+        np.testing.assert_allclose(doubled['false_alarm_ratio'], [1 / 3, 1 / 2])
+
+
+class DownsampleTestCase(TethysTestCase):
+    """
+    Checks the LTTB downsampling of the historical simulation keeps the annual peaks.
+    """
+
+    def test_downsample_keeps_annual_peaks(self):
+        import numpy as np
+        from ..downsample import downsample, lttb
+
+        rng = np.random.default_rng(0)
+        times = np.arange('1981-01-01', '2021-01-01', dtype='datetime64[D]')
+        flows = rng.gamma(2, 10, times.size)
+        flows[rng.choice(times.size, 50, replace=False)] = np.nan
+
+        shown = downsample(times, flows, 500)
+        self.assertLessEqual(shown.size, 500)
+        self.assertTrue(np.all(np.diff(shown) > 0))
+        self.assertFalse(np.isnan(flows[shown]).any())
+
+        years = times.astype('datetime64[Y]')
+        for year in np.unique(years):
+            in_year = years == year
+            self.assertIn(np.nanmax(flows[in_year]), flows[shown][years[shown] == year])
+
+        self.assertEqual(lttb(np.arange(5.0), np.ones(5), 10).tolist(), [0, 1, 2, 3, 4])
+
+    def test_downsample_budget_below_annual_peaks(self):
+        import numpy as np
+        from ..downsample import downsample, annual_peaks
+
+        rng = np.random.default_rng(0)
+        times = np.arange('1981-01-01', '2021-01-01', dtype='datetime64[D]')
+        flows = rng.gamma(2, 10, times.size)
+        peaks = annual_peaks(times, flows)
+
+        for budget in (10, peaks.size, peaks.size + 2, peaks.size + 3):
+            shown = downsample(times, flows, budget)
+            self.assertLessEqual(shown.size, budget)
+            self.assertEqual(shown[[0, -1]].tolist(), [0, times.size - 1])
+
+        # the highest annual peaks are the ones kept
+        shown = downsample(times, flows, 10)
+        highest = peaks[np.argsort(-flows[peaks])[:8]]
+        self.assertTrue(np.isin(highest, shown).all())
+
+
+class ClimatologyTestCase(TethysTestCase):
+    """
+    Checks the vectorized day of year percentiles against np.nanpercentile.
+    """
+
+    def test_daily_percentiles_match_numpy(self):
+        import numpy as np
+        from ..climatology import daily_percentiles, day_of_year, PERCENTILES
+
+        rng = np.random.default_rng(0)
+        times = np.arange('2000-01-01', '2010-01-01', dtype='datetime64[D]')
+        values = rng.gamma(2, 10, (3, times.size)).astype(np.float32)
+        values[1, :400] = np.nan
+
+        result = daily_percentiles(values, times, window=2)
+        doy = day_of_year(times)
+        for day in (0, 100, 364):
+            distance = np.abs(doy - day)
+            pooled = np.minimum(distance, 366 - distance) <= 2
+            expected = np.nanpercentile(values[:, pooled], PERCENTILES, axis=1).T
+            np.testing.assert_allclose(result[:, day], expected, rtol=1e-5)
+
+    def test_tables_are_published_whole(self):
+        import os
+        import tempfile
+        import datetime as dt
+        import numpy as np
+        from ..climatology import build_climatology, load_climatology, table_directory
+        from .synthetic import write_forecast
+
+        with tempfile.TemporaryDirectory() as folder:
+            old_file = write_forecast(folder, dt.date(2021, 1, 1), comids=5, years=2)
+            new_file = write_forecast(folder, dt.date(2021, 1, 2), comids=5, years=2)
+            self.assertIsNone(load_climatology(folder))
+
+            build_climatology(old_file, folder)
+            built = build_climatology(new_file, folder)
+            loaded = load_climatology(folder)
+            np.testing.assert_array_equal(loaded.comids, built.comids)
+            np.testing.assert_array_equal(loaded.values, built.values)
+            # one pointer and one version directory, the older forecast file pruned
+            self.assertEqual(len(os.listdir(table_directory(folder))), 2)
+
+
+class SharedForecastTestCase(TethysTestCase):
+    """
+    Checks the memory mapped arrays shared by the workers match the forecast file and are swapped for newer dates.
+    """
+
+    def test_shared_forecast_matches_file(self):
+        import os
+        import tempfile
+        import datetime as dt
+        import numpy as np
+        from ..datasets import open_forecast, read_reach
+        from ..shared import build_shared_forecast, open_shared_forecast, shared_path
+        from .synthetic import write_forecast
+
+        with tempfile.TemporaryDirectory() as folder:
+            old_file = write_forecast(folder, dt.date(2021, 1, 1), comids=20, years=2)
+            new_file = write_forecast(folder, dt.date(2021, 1, 2), comids=20, years=2)
+            self.assertIsNone(open_shared_forecast(old_file, folder))
+
+            build_shared_forecast(old_file, folder)
+            shared = open_shared_forecast(old_file, folder)
+            comid = str(open_forecast(old_file)['comid'].values[7])
+            expected = read_reach(open_forecast(old_file), comid)
+            for actual, wanted in zip(read_reach(shared, comid), expected):
+                np.testing.assert_array_equal(actual, wanted)
+
+            build_shared_forecast(new_file, folder)
+            self.assertFalse(os.path.exists(shared_path(old_file, folder)))
+            self.assertIsNot(open_shared_forecast(new_file, folder), shared)
+            np.testing.assert_array_equal(read_reach(open_shared_forecast(new_file, folder), comid).qr,
+                                          read_reach(open_forecast(new_file), comid).qr)
+
+            # a forecast reissued under the same date is not served from the older arrays
+            previous = open_shared_forecast(new_file, folder).path
+            os.utime(new_file, (os.path.getmtime(new_file) + 60,) * 2)
+            self.assertIsNone(open_shared_forecast(new_file, folder))
+
+            # ingesting it again publishes a new version through the pointer and removes the previous one
+            os.utime(new_file, (os.path.getmtime(new_file) - 120,) * 2)
+            current = build_shared_forecast(new_file, folder)
+            self.assertEqual(open_shared_forecast(new_file, folder).path, current)
+            self.assertFalse(os.path.exists(previous))
+
+
+class FloodExceedanceTestCase(TethysTestCase):
+    """
+    Checks forecast peaks are classified at the return period thresholds, with missing values handled.
+    """
+
+    def test_severity_classes(self):
+        import numpy as np
+        from ..exceedance import severity
+
+        nan = np.nan
+        # thresholds in RETURN_PERIODS order: 10, 5 and 2.33 years
+        thresholds = np.array([[100, 50, 20]] * 6 + [[100, nan, 20], [nan, nan, nan], [100, 50, 0]], dtype=np.float32)
+        peaks = np.array([19.9, 20, 50, 99, 100, nan, 60, 60, 5], dtype=np.float32)
+
+        classes, ratios = severity(peaks, thresholds)
+        self.assertEqual(classes.tolist(), [0, 1, 2, 2, 3, 0, 1, 0, 1])
+        np.testing.assert_allclose(ratios[:5], peaks[:5] / 20)
+        self.assertTrue(np.isnan(ratios[5]) and np.isnan(ratios[7]))
+        self.assertEqual(ratios[8], np.inf)
+
+    def test_build_matches_forecast_peaks(self):
+        import tempfile
+        import datetime as dt
+        import numpy as np
+        from ..datasets import open_forecast
+        from ..exceedance import ExceedanceTable, severity
+        from ..return_periods import load_return_period_table
+        from .synthetic import write_forecast
+
+        with tempfile.TemporaryDirectory() as folder:
+            nc_file = write_forecast(folder, dt.date(2021, 1, 1), comids=30, years=5)
+            table = ExceedanceTable.build(nc_file, folder)
+            dataset = open_forecast(nc_file)
+            peaks = np.fmax(dataset['qr_eta'].max('time_eta').values, dataset['qr_gfs'].max('time_gfs').values)
+            classes, ratios = severity(peaks, load_return_period_table(nc_file, folder).values)
+
+            np.testing.assert_array_equal(table.comids, dataset['comid'].values)
+            np.testing.assert_array_equal(table.classes, classes)
+            np.testing.assert_allclose(table.ratios, ratios, rtol=1e-6)
+
+
+class RegionSummaryTestCase(TethysTestCase):
+    """
+    Checks the reaches of a region are ranked by severity class, then by peak ratio.
+    """
+
+    def test_top_reaches(self):
+        import numpy as np
+        from ..exceedance import ExceedanceTable, top_reaches
+
+        table = ExceedanceTable(
+            np.arange(100, 106),
+            np.array([3, 1, 3, 0, 2, 3], dtype=np.int8),
+            np.array([9.0, 1.5, 12.0, np.nan, 3.0, 15.0], dtype=np.float32),
+        )
+        positions = np.array([0, 1, 2, 3, 4], dtype=np.int32)
+
+        self.assertEqual(top_reaches(table, positions, 3).tolist(), [2, 0, 4])
+        self.assertEqual(top_reaches(table, positions, 10).tolist(), [2, 0, 4, 1, 3])
+
+
+class SingleFlightTestCase(TethysTestCase):
+    """
+    Checks concurrent calls with the same key share one computation, its result and its exception.
+    """
+
+    def test_concurrent_calls_share_result(self):
+        import threading
+        from ..coalesce import SingleFlight
+
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'response'
+
+        def follower():
+            results.append(flights.do('key', compute, timeout=5))
+
+        leader = threading.Thread(target=lambda: results.append(flights.do('key', compute)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=follower) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('response', False)] + [('response', True)] * 3)
+
+    def test_errors_and_timeouts(self):
+        import threading
+        from ..coalesce import SingleFlight
+
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('read failed')
+
+        def call():
+            try:
+                flights.do('key', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        self.assertRaises(TimeoutError, flights.do, 'key', fail, 0.01)
+        follower = threading.Thread(target=call)
+        follower.start()
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(flights.do('key', lambda: 'next'), ('next', False))
+
+
+class ResponseCacheTestCase(TethysTestCase):
+    """
+    Checks the response cache backends evict the least recently used responses past their byte budget.
+    """
+
+    def test_memory_backend_bytes(self):
+        from ..cache import MemoryBackend
+
+        backend = MemoryBackend(max_entries=10, max_bytes=250)
+        for key in 'abc':
+            backend.set(key, (b'x' * 100, {}))
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.size, 200)
+        backend.set('b', (b'x' * 10, {}))
+        self.assertEqual(backend.size, 110)
+        self.assertIsNotNone(backend.get('c'))
+
+    def test_file_backend_bytes(self):
+        import os
+        import tempfile
+        from ..cache import FileBackend
+
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FileBackend(directory, max_entries=10, max_bytes=2 ** 11)
+            for key in range(3):
+                backend.set(key, (b'x' * 2 ** 10, {}))
+            self.assertIsNone(backend.get(0))
+            self.assertEqual(backend.get(2)[0], b'x' * 2 ** 10)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertEqual(FileBackend(directory, max_entries=10, max_bytes=2 ** 11).size, backend.size)
+
+
+class ArchiveCompactionTestCase(TethysTestCase):
+    """
+    Checks compacted forecast files read back like the legacy files they replace.
+    """
+
+    def test_compacted_files_match_legacy(self):
+        import os
+        import tempfile
+        import datetime as dt
+        import numpy as np
+        from ..archive import compact_archive, compact_file, open_archived
+        from ..store import convert_to_comid_major
+        from .synthetic import write_forecast
+
+        with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as legacy:
+            paths = []
+            for day in (1, 2, 3):
+                date = dt.date(2021, 1, day)
+                paths.append(write_forecast(folder, date, comids=30, years=2))
+                write_forecast(legacy, date, comids=30, years=2)
+
+            report = compact_archive(folder)
+            self.assertEqual(report['skipped'], {})
+            self.assertLess(report['bytes_after'], report['bytes_before'])
+            self.assertEqual(compact_file(paths[0]), 'already compacted')
+
+            # a later run only appends the new days of the next file
+            paths.append(write_forecast(folder, dt.date(2021, 1, 4), comids=30, years=2))
+            write_forecast(legacy, dt.date(2021, 1, 4), comids=30, years=2)
+            self.assertIsNone(compact_file(paths[-1]))
+
+            for path in paths:
+                with open_archived(path) as compacted, open_archived(os.path.join(legacy, os.path.basename(path))) \
+                        as original:
+                    self.assertNotIn('history_store', compacted.attrs)
+                    for name in ('qr', 'qr_eta', 'qr_gfs', 'time', 'time_gfs'):
+                        np.testing.assert_array_equal(compacted[name].values, original[name].values)
+
+            store = convert_to_comid_major(paths[1], os.path.join(folder, 'store', 'store.nc'))
+            with open_archived(store) as converted, open_archived(paths[1]) as compacted:
+                np.testing.assert_array_equal(converted['qr'].transpose('time', 'comid').values,
+                                              compacted['qr'].transpose('time', 'comid').values)
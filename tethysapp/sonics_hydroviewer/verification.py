@@ -0,0 +1,237 @@
+"""
+Batch verification of the archived ETA and GFS forecasts against the qr simulation of the latest forecast file.
+
+For every lead day it computes, per comid, the Nash-Sutcliffe efficiency, the Kling-Gupta efficiency, the relative
+bias and the hit rate and false alarm ratio of 2.33 year return period exceedances.
+
+Usage:
+    python -m tethysapp.sonics_hydroviewer.verification <forecast_folder> <app_workspace> [--processes N]
+"""
+import os
+import sys
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .archive import open_archived
+from .catalog import ForecastCatalog
+from .return_periods import load_return_period_table, RETURN_PERIOD_NAMES
+
+MODELS = ('eta', 'gfs')
+
+# lead days verified, counted from the forecast date of the file
+MAX_LEAD_DAYS = 16
+
+# comids verified per task, each task streams the whole archive for its block
+BLOCK_SIZE = 4096
+
+SUMS = ('n', 'f', 'o', 'ff', 'oo', 'fo', 'hits', 'misses', 'false_alarms')
+
+METRICS = ('nse', 'kge', 'bias', 'hit_rate', 'false_alarm_ratio')
+
+
+def accumulate(sums, forecast, observed, threshold):
+	"""
+	Adds the sums of paired forecast and observed flows, shaped (time, comid), to sums shaped (SUMS, comid). Pairs
+	with a missing value are skipped.
+	"""
+	valid = ~(np.isnan(forecast) | np.isnan(observed))
+	f = np.where(valid, forecast, 0).astype(float)
+	o = np.where(valid, observed, 0).astype(float)
+	forecast_event = valid & (forecast >= threshold)
+	observed_event = valid & (observed >= threshold)
+
+	sums[0] += valid.sum(axis=0)
+	sums[1] += f.sum(axis=0)
+	sums[2] += o.sum(axis=0)
+	sums[3] += (f * f).sum(axis=0)
+	sums[4] += (o * o).sum(axis=0)
+	sums[5] += (f * o).sum(axis=0)
+	sums[6] += (forecast_event & observed_event).sum(axis=0)
+	sums[7] += (~forecast_event & observed_event).sum(axis=0)
+	sums[8] += (forecast_event & ~observed_event).sum(axis=0)
+
+
+def skill_metrics(sums):
+	"""
+	Computes METRICS from sums shaped (SUMS, ...), NaN where they are undefined.
+	"""
+	n, sf, so, sff, soo, sfo, hits, misses, false_alarms = sums
+	with np.errstate(divide='ignore', invalid='ignore'):
+		mean_f, mean_o = sf / n, so / n
+		var_f = np.maximum(sff / n - mean_f ** 2, 0)
+		var_o = np.maximum(soo / n - mean_o ** 2, 0)
+		cov = sfo / n - mean_f * mean_o
+
+		nse = 1 - (sff - 2 * sfo + soo) / (n * var_o)
+		r = cov / np.sqrt(var_f * var_o)
+		alpha = np.sqrt(var_f / var_o)
+		beta = mean_f / mean_o
+		kge = 1 - np.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+
+		hit_rate = hits / (hits + misses)
+		false_alarm_ratio = false_alarms / (hits + false_alarms)
+
+	return dict(zip(METRICS, (nse, kge, beta - 1, hit_rate, false_alarm_ratio)))
+
+
+def verify_block(files, reference, start, stop, threshold):
+	"""
+	Verifies the comids at positions start:stop of the reference file against every archived forecast file, opening
+	one file at a time.
+	Args:
+	  files (list): (path, forecast date as datetime64[D]) pairs
+	  reference (str): forecast file whose qr simulation is the observation
+	  threshold (np.ndarray): 2.33 year return period of the comids of the block
+	Returns:
+	  tuple, (start, sums shaped (model, lead day, SUMS, comid))
+	"""
+	import xarray as xr
+
+	sums = np.zeros((len(MODELS), MAX_LEAD_DAYS, len(SUMS), stop - start))
+
+	with open_archived(reference) as observation:
+		comids = observation['comid'].values
+		observed_times = observation['time'].values
+
+		for path, forecast_date in files:
+			with xr.open_dataset(path) as forecast:
+				if not np.array_equal(forecast['comid'].values, comids):
+					print('skipping {0}: different drainage network than {1}'.format(path, reference))
+					continue
+
+				for m, model in enumerate(MODELS):
+					times = forecast['time_' + model].values
+					index = np.minimum(np.searchsorted(observed_times, times), observed_times.size - 1)
+					matched = observed_times[index] == times
+					lead = (times.astype('datetime64[D]') - forecast_date).astype(int)
+					matched &= (lead >= 0) & (lead < MAX_LEAD_DAYS)
+					if not matched.any():
+						continue
+
+					flows = forecast['qr_' + model].isel(comid=slice(start, stop)) \
+						.transpose('time_' + model, 'comid').values[matched]
+					observed = observation['qr'].isel(comid=slice(start, stop), time=index[matched]) \
+						.transpose('time', 'comid').values
+					for day in np.unique(lead[matched]):
+						rows = lead[matched] == day
+						accumulate(sums[m, day], flows[rows], observed[rows], threshold)
+
+	return start, sums
+
+
+def _verify_task(args):
+	# reduce the sums to metrics in the worker, so the parent only holds the compact table
+	start, sums = verify_block(*args)
+	metrics = {name: values.astype(np.float32) for name, values in skill_metrics(np.moveaxis(sums, 2, 0)).items()}
+	return start, metrics, sums[:, :, 0].astype(np.int32)
+
+
+class SkillTable(object):
+	"""
+	Forecast skill METRICS of every comid, shaped (model, lead day, comid), with the number of verified pairs.
+	"""
+
+	def __init__(self, comids, lead_days, metrics, pairs, files):
+		self.comids = comids
+		self.lead_days = lead_days
+		self.metrics = metrics
+		self.pairs = pairs
+		self.files = files
+		self._positions = {str(comid): i for i, comid in enumerate(comids.tolist())}
+
+	def lookup(self, comid):
+		"""
+		Returns the skill of comid as a dict keyed by model, each holding a list per metric indexed like lead_days.
+		"""
+		i = self._positions[str(comid)]
+		skill = {}
+		for m, model in enumerate(MODELS):
+			skill[model] = {name: values[m, :, i] for name, values in self.metrics.items()}
+			skill[model]['pairs'] = self.pairs[m, :, i]
+		return skill
+
+	def save(self, path):
+		tmp_path = path + '.tmp.npz'
+		np.savez(tmp_path, comids=self.comids, lead_days=self.lead_days, pairs=self.pairs, files=self.files,
+				 **self.metrics)
+		os.replace(tmp_path, path)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as table:
+			return cls(table['comids'], table['lead_days'], {name: table[name] for name in METRICS}, table['pairs'],
+					   table['files'])
+
+
+def table_path(workspace):
+	return os.path.join(workspace, 'verification', 'skill.npz')
+
+
+def run_verification(folder, workspace, processes=None, block_size=BLOCK_SIZE):
+	"""
+	Verifies every archived forecast file of folder against the latest one and stores the SkillTable in the workspace.
+	Tasks are blocks of comids, so memory stays bounded by the block size whatever the length of the archive.
+	"""
+	catalog = ForecastCatalog(folder)
+	reference = catalog.latest()
+	files = [(catalog.path_for(date), np.datetime64(date, 'D')) for date in catalog.dates[:-1]]
+
+	with open_archived(reference) as observation:
+		comids = observation['comid'].values
+	thresholds = load_return_period_table(reference, workspace).values
+	threshold = thresholds[:, RETURN_PERIOD_NAMES.index('return_period_2_33')]
+
+	shape = (len(MODELS), MAX_LEAD_DAYS, comids.size)
+	metrics = {name: np.full(shape, np.nan, dtype=np.float32) for name in METRICS}
+	pairs = np.zeros(shape, dtype=np.int32)
+
+	tasks = [(files, reference, start, min(start + block_size, comids.size), threshold[start:start + block_size])
+			 for start in range(0, comids.size, block_size)]
+	with ProcessPoolExecutor(processes) as executor:
+		for start, block_metrics, block_pairs in executor.map(_verify_task, tasks):
+			stop = start + block_pairs.shape[-1]
+			pairs[..., start:stop] = block_pairs
+			for name, values in block_metrics.items():
+				metrics[name][..., start:stop] = values
+
+	lead_days = np.flatnonzero(pairs.any(axis=(0, 2)))
+	table = SkillTable(comids, lead_days, {name: values[:, lead_days] for name, values in metrics.items()},
+					   pairs[:, lead_days], np.array([os.path.basename(path) for path, _ in files]))
+	path = table_path(workspace)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	table.save(path)
+	return table
+
+
+_table = (None, None)
+_table_lock = threading.Lock()
+
+
+def load_skill_table(workspace):
+	"""
+	Returns the SkillTable written by the last verification run, reloaded when the job rewrites it.
+	"""
+	global _table
+	path = table_path(workspace)
+	mtime = os.path.getmtime(path)
+	with _table_lock:
+		if _table[0] != mtime:
+			_table = (mtime, SkillTable.load(path))
+		return _table[1]
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Verify the archived SONICS forecasts against the latest simulation.')
+	parser.add_argument('folder', help='SONICS forecast folder')
+	parser.add_argument('workspace', help='app workspace directory')
+	parser.add_argument('--processes', type=int, default=None, help='worker processes, defaults to the CPU count')
+	args = parser.parse_args(argv)
+
+	run_verification(args.folder, args.workspace, args.processes)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
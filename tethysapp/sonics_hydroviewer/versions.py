@@ -0,0 +1,71 @@
+"""
+Versioned directories published through a pointer file. Ingest steps write each version of a table in a new
+directory and switch the pointer to it with os.replace, so a reader following the pointer always finds a complete
+version, and a failed write leaves the previous one in place.
+"""
+import os
+import time
+import shutil
+
+POINTER_SUFFIX = '.current'
+
+
+def pointer_path(directory, name):
+	return os.path.join(directory, name + POINTER_SUFFIX)
+
+
+def new_version(directory, name):
+	"""
+	Creates and returns an empty version directory of name, named so that later versions sort after it.
+	"""
+	os.makedirs(directory, exist_ok=True)
+	path = os.path.join(directory, '{0}.v{1:020d}-{2}'.format(name, time.time_ns(), os.getpid()))
+	os.makedirs(path)
+	return path
+
+
+def publish_version(directory, name, path):
+	"""
+	Points the pointer of name to the version directory path, then removes the earlier versions of name and every
+	version and pointer of the names that sort before it. Readers still holding those keep their open files.
+	"""
+	pointer = pointer_path(directory, name)
+	tmp_pointer = '{0}.tmp-{1}'.format(pointer, os.getpid())
+	with open(tmp_pointer, 'w') as f:
+		f.write(os.path.basename(path))
+	os.replace(tmp_pointer, pointer)
+
+	version = os.path.basename(path)
+	for entry in os.scandir(directory):
+		if entry.name.startswith(name + '.'):
+			# the pointer and the versions of a later ingest of the same name stay
+			stale = entry.name.startswith(name + '.v') and entry.name < version
+		else:
+			stale = entry.name <= name
+		if stale and entry.is_dir():
+			shutil.rmtree(entry.path, ignore_errors=True)
+		elif stale:
+			try:
+				os.remove(entry.path)
+			except OSError:
+				pass
+
+
+def read_pointer(pointer):
+	"""
+	Returns the version directory a pointer file points to.
+	Raises:
+	  FileNotFoundError: the pointer does not exist
+	"""
+	with open(pointer) as f:
+		return os.path.join(os.path.dirname(pointer), f.read().strip())
+
+
+def latest_pointer(directory):
+	"""
+	Returns the pointer of the name that sorts last in directory, or None when there is none.
+	"""
+	if not os.path.isdir(directory):
+		return None
+	pointers = sorted(entry.name for entry in os.scandir(directory) if entry.name.endswith(POINTER_SUFFIX))
+	return os.path.join(directory, pointers[-1]) if pointers else None
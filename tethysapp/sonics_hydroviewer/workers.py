@@ -0,0 +1,65 @@
+"""
+Worker start hooks that preload the data of the app in the background, so the first request served by a worker does
+not pay for it. They run from the server rather than at import, so management commands, test runs and the ingest CLI
+never start a warm-up.
+
+gunicorn, in gunicorn.conf.py:
+    from tethysapp.sonics_hydroviewer.workers import post_fork
+
+uWSGI, in the ini file:
+    import = tethysapp.sonics_hydroviewer.workers
+
+Other servers, daphne included, start it on the first request the process serves, through the request_started
+signal connected by connect_request_started.
+"""
+import threading
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def _warm_up():
+	from .app import SonicsHydroviewer as app
+
+	try:
+		app.warm_up()
+	except Exception as e:
+		print("warm up error: " + str(e))
+
+
+def start_warm_up():
+	"""
+	Starts the warm-up thread of this process, once.
+	"""
+	global _started
+	with _started_lock:
+		if _started:
+			return
+		_started = True
+	threading.Thread(target=_warm_up, name='sonics-hydroviewer-warm-up', daemon=True).start()
+
+
+def post_fork(server, worker):
+	# gunicorn server hook
+	start_warm_up()
+
+
+def _on_request_started(sender, **kwargs):
+	start_warm_up()
+
+
+def connect_request_started():
+	"""
+	Starts the warm-up when the process serves its first request, for servers without a post-fork hook.
+	"""
+	from django.core.signals import request_started
+
+	request_started.connect(_on_request_started, dispatch_uid='sonics_hydroviewer_warm_up')
+
+
+try:
+	from uwsgidecorators import postfork
+except ImportError:
+	pass
+else:
+	postfork(start_warm_up)